@@ -0,0 +1,166 @@
+import asyncio
+import heapq
+import itertools
+import time
+from enum import IntEnum
+from typing import Dict, List, Tuple
+
+from starlette.responses import JSONResponse
+
+from api.metrics import metrics
+from api.settings import Settings
+
+# リクエストの種類（値が小さいほど優先して受け付ける）
+class RequestClass(IntEnum):
+    READ = 0
+    WRITE = 1
+    HEAVY = 2
+
+# 1リクエストで複数の更新をまとめて行う重い処理（メソッド, パス）
+HEAVY_ROUTES = {
+    ("POST", "/mylist/batch"),
+    ("POST", "/auth/migrate"),
+}
+# 流量制御の対象外のパス（DB接続を使わない、または長時間接続を維持するもの）
+EXEMPT_PREFIXES = ("/metrics", "/docs", "/redoc", "/openapi.json", "/mylist/events/")
+
+def classify(method: str, path: str) -> RequestClass:
+    if (method, path) in HEAVY_ROUTES:
+        return RequestClass.HEAVY
+    if method in ("GET", "HEAD"):
+        return RequestClass.READ
+    return RequestClass.WRITE
+
+class Waiter:
+    def __init__(self, requestClass: RequestClass):
+        self.requestClass = requestClass
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+# DBの接続数に合わせて同時に処理するリクエスト数を制限し、超えた分は優先度順の待ち行列に入れる
+# 待ち行列が一杯の場合や待ち時間の上限を超えた場合は受け付けない（503）。受け付けたリクエストの遅延を抑えるため。
+class AdmissionController:
+    def __init__(self, capacity: int, limits: Dict[RequestClass, int], queueSize: int, maxWait: float):
+        self.capacity = capacity
+        self.limits = limits
+        self.queueSize = queueSize
+        self.maxWait = maxWait
+        self.active = 0
+        self.activeByClass: Dict[RequestClass, int] = {requestClass: 0 for requestClass in RequestClass}
+        self._waiters: List[Tuple[int, int, Waiter]] = []
+        self._sequence = itertools.count()
+        metrics.gauge("admission_in_flight", lambda: self.active)
+        metrics.gauge("admission_queue_depth", lambda: len(self._waiters))
+
+    # 接続プールのサイズから上限を決める（更新は読み取りより少なくし、重い処理はさらに絞る）
+    @classmethod
+    def fromSettings(cls, settings: Settings) -> "AdmissionController":
+        capacity = settings.db_pool_size + settings.db_max_overflow
+        limits = {
+            RequestClass.READ: capacity,
+            RequestClass.WRITE: max(1, capacity // 2),
+            RequestClass.HEAVY: max(1, capacity // 4),
+        }
+        return cls(capacity, limits, settings.admission_queue_size, settings.admission_max_wait)
+
+    def canAdmit(self, requestClass: RequestClass) -> bool:
+        return self.active < self.capacity and self.activeByClass[requestClass] < self.limits[requestClass]
+
+    # 受け付けた場合はTrue（処理後にrelease()を呼ぶこと）
+    async def acquire(self, requestClass: RequestClass) -> bool:
+        label = requestClass.name
+        waitingAhead = any(priority <= requestClass for priority, _, _ in self._waiters)
+        if self.canAdmit(requestClass) and not waitingAhead:
+            self._admit(requestClass)
+            metrics.inc("admission_requests_total", result="admitted", request_class=label)
+            return True
+
+        if len(self._waiters) >= self.queueSize and not self._evictFor(requestClass):
+            metrics.inc("admission_requests_total", result="rejected", request_class=label)
+            return False
+
+        waiter = Waiter(requestClass)
+        heapq.heappush(self._waiters, (requestClass, next(self._sequence), waiter))
+        # 待ち行列に入った件数は別の系列にする（admission_requests_totalは1リクエストにつき結果を1回だけ数える）
+        metrics.inc("admission_queued_total", request_class=label)
+        startedAt = time.monotonic()
+        try:
+            admitted = await asyncio.wait_for(asyncio.shield(waiter.future), self.maxWait)
+        except asyncio.TimeoutError:
+            admitted = False
+        except asyncio.CancelledError:
+            # 受け付けた直後に切断された場合は枠を返す
+            if waiter.future.done() and waiter.future.result():
+                self.release(requestClass)
+            else:
+                self._remove(waiter)
+            raise
+        if not admitted and not waiter.future.done():
+            self._remove(waiter)
+        elif not admitted and waiter.future.result():
+            # タイムアウトと同時に受け付けられた場合
+            admitted = True
+        metrics.observe("admission_wait_seconds", time.monotonic() - startedAt, request_class=label)
+        metrics.inc("admission_requests_total", result="admitted" if admitted else "rejected", request_class=label)
+        return admitted
+
+    def release(self, requestClass: RequestClass):
+        self.active -= 1
+        self.activeByClass[requestClass] -= 1
+        self._wake()
+
+    def _admit(self, requestClass: RequestClass):
+        self.active += 1
+        self.activeByClass[requestClass] += 1
+
+    # 空きができた種類の待ち行列の先頭から受け付ける
+    def _wake(self):
+        blocked = []
+        while self._waiters and self.active < self.capacity:
+            entry = heapq.heappop(self._waiters)
+            waiter = entry[2]
+            if waiter.future.done():
+                continue
+            if self.canAdmit(waiter.requestClass):
+                self._admit(waiter.requestClass)
+                waiter.future.set_result(True)
+            else:
+                blocked.append(entry)
+        for entry in blocked:
+            heapq.heappush(self._waiters, entry)
+
+    # 待ち行列が一杯の場合、より優先度の低いリクエストがあれば押し出す
+    def _evictFor(self, requestClass: RequestClass) -> bool:
+        lowest = max(self._waiters, key=lambda entry: (entry[0], entry[1]))
+        if lowest[0] <= requestClass:
+            return False
+        self._waiters.remove(lowest)
+        heapq.heapify(self._waiters)
+        lowest[2].future.set_result(False)
+        return True
+
+    def _remove(self, waiter: Waiter):
+        self._waiters = [entry for entry in self._waiters if entry[2] is not waiter]
+        heapq.heapify(self._waiters)
+
+# 流量制御のASGIミドルウェア
+class AdmissionMiddleware:
+    def __init__(self, app, controller: AdmissionController, retryAfter: int):
+        self.app = app
+        self.controller = controller
+        self.retryAfter = retryAfter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        requestClass = classify(scope["method"], scope["path"])
+        if not await self.controller.acquire(requestClass):
+            response = JSONResponse(
+                status_code=503, content={"detail": "Server is busy"}, headers={"Retry-After": str(self.retryAfter)}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(requestClass)
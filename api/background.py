@@ -0,0 +1,108 @@
+import asyncio
+import itertools
+import logging
+import time
+from enum import IntEnum
+from typing import Awaitable, Callable, Optional, Set
+
+from api.metrics import metrics
+
+logger = logging.getLogger('uvicorn')
+
+# ワーカー数
+WORKERS = 4
+# キューに溜められるタスク数の上限
+QUEUE_SIZE = 1000
+# キューを通さずに同時に実行するタスク数の上限（キューが一杯の場合の逃げ道も無制限にしない）
+DIRECT_LIMIT = 100
+# 終了時にキューに残ったタスクの完了を待つ時間（秒）
+DRAIN_TIMEOUT = 10.0
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+# レスポンスに必要ない後処理をリクエストの外で実行するためのキュー
+# キューが一杯の場合、LOWのタスクは破棄し、それ以外はDIRECT_LIMITまでキューを通さずに実行する。
+# それも超えた場合は破棄して、メモリとタスク数が際限なく増えないようにする（件数はメトリクスで確認する）。
+class BackgroundExecutor:
+    def __init__(self, workers: int = WORKERS, queue_size: int = QUEUE_SIZE, direct_limit: int = DIRECT_LIMIT):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.direct_limit = direct_limit
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: Set[asyncio.Task] = set()
+        # キューを通さずに実行したタスク（停止時に完了を待つ）
+        self._direct: Set[asyncio.Task] = set()
+        self._sequence = itertools.count()
+
+    @property
+    def running(self) -> bool:
+        return len(self._workers) != 0
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue(self.queue_size)
+        self._workers = {asyncio.create_task(self._work()) for _ in range(self.workers)}
+
+    # キューに投入する。キューを通さずに実行した場合や破棄した場合はFalseを返す
+    def submit(self, function: Callable[..., Awaitable[None]], *args, priority: Priority = Priority.NORMAL) -> bool:
+        if self.running:
+            try:
+                self._queue.put_nowait((priority, next(self._sequence), time.monotonic(), function, args))
+                metrics.inc("background_tasks_total", status="queued", priority=priority.name)
+                return True
+            except asyncio.QueueFull:
+                if priority == Priority.LOW:
+                    metrics.inc("background_tasks_total", status="dropped", priority=priority.name)
+                    return False
+        if len(self._direct) >= self.direct_limit:
+            metrics.inc("background_tasks_total", status="rejected", priority=priority.name)
+            logger.error("background queue is full, rejected %s", getattr(function, '__name__', function))
+            return False
+        # 起動前（テストなど）やキューが一杯の場合は、その場でタスクとして実行する
+        metrics.inc("background_tasks_total", status="direct", priority=priority.name)
+        task = asyncio.get_running_loop().create_task(self._run(function, args, priority, time.monotonic()))
+        self._direct.add(task)
+        task.add_done_callback(self._direct.discard)
+        return False
+
+    # キューに残ったタスクを実行し終えてから停止する（キューとキューを通さずに実行したタスクを合わせてtimeout秒まで待つ）
+    async def stop(self, timeout: float = DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        if self.running:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.error("background queue was not drained in %s seconds (%s tasks left)", timeout, self._queue.qsize())
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            self._workers = set()
+        if len(self._direct) != 0:
+            await asyncio.wait(self._direct, timeout=max(deadline - time.monotonic(), 0))
+
+    async def _work(self):
+        while True:
+            priority, _, enqueuedAt, function, args = await self._queue.get()
+            try:
+                await self._run(function, args, Priority(priority), enqueuedAt)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, function: Callable[..., Awaitable[None]], args: tuple, priority: Priority, enqueuedAt: float):
+        startedAt = time.monotonic()
+        metrics.observe("background_task_wait_seconds", startedAt - enqueuedAt, priority=priority.name)
+        try:
+            await function(*args)
+            metrics.inc("background_tasks_total", status="completed", priority=priority.name)
+        except Exception:
+            metrics.inc("background_tasks_total", status="failed", priority=priority.name)
+            logger.exception("background task %s failed", getattr(function, '__name__', function))
+        finally:
+            metrics.observe("background_task_run_seconds", time.monotonic() - startedAt, priority=priority.name)
@@ -0,0 +1,115 @@
+import argparse
+import asyncio
+import datetime
+import json
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+import api.cruds.mylist as mylist_crud
+import api.models.mylist as mylist_model
+import api.models.user as user_model
+from api.db import Base, createEngine
+from api.routers.mylist import MYLISTS_RESPONSE, validateMylists
+from api.settings import Settings
+
+# 計測用のDB（MySQLに接続しない）
+BENCH_DB_URL = "sqlite+aiosqlite:///:memory:"
+
+# 1ユーザーにrows件（トピックはtopics件ずつ）のマイリストを作成し、user_idを返す
+async def seed(engine: AsyncEngine, rows: int, topics: int) -> int:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    now = datetime.datetime.now()
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        user = user_model.User(created_at=now, updated_at=now)
+        session.add(user)
+        await session.flush()
+        session.add_all([
+            mylist_model.MyList(
+                user_id=user.user_id, title=f"マイリスト{i}", theme_type="001",
+                topic={"topic": [f"トピック{i}-{j}" for j in range(topics)]}, is_private=i % 2 == 0,
+                created_at=now, updated_at=now
+            )
+            for i in range(rows)
+        ])
+        await session.commit()
+        return user.user_id
+
+# 変更前の経路（ORMのselectで取得し、serialize_responseで検証・jsonable_encoderでエンコードする）
+async def ormPath(session: AsyncSession, user_id: int) -> bytes:
+    rows = await mylist_crud.retrieveAllMyListsByUserId(session, user_id)
+    return JSONResponse(await serialize_response(field=MYLISTS_RESPONSE, response_content=rows)).body
+
+# 高速経路（事前に作成した文をORMを経由せずに実行し、__slots__の行オブジェクトを検証してそのままエンコードする）
+async def fastPath(session: AsyncSession, user_id: int) -> bytes:
+    return JSONResponse(validateMylists(await mylist_crud.retrieveAllMylistRows(session, user_id))).body
+
+PATHS: Dict[str, Callable[[AsyncSession, int], Awaitable[bytes]]] = {"orm": ormPath, "fast": fastPath}
+
+# 1リクエストあたりのCPU時間（ミリ秒）と、確保したメモリの最大量（KiB）を計測する
+# tracemallocは処理を遅くするため、CPU時間とは別に計測する。
+async def measure(engine: AsyncEngine, path, user_id: int, repeat: int) -> dict:
+    async def run() -> bytes:
+        async with AsyncSession(engine) as session:
+            return await path(session, user_id)
+    body = await run()
+
+    cpu = 0.0
+    for _ in range(repeat):
+        startedAt = time.process_time()
+        await run()
+        cpu += time.process_time() - startedAt
+
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(repeat):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            await run()
+            peak += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return {"cpu_ms": cpu / repeat * 1000, "peak_kib": peak / repeat / 1024, "bytes": len(body), "body": body}
+
+async def benchmarkAsync(rows: int, topics: int, repeat: int) -> dict:
+    engine = createEngine(Settings(db_url=BENCH_DB_URL))
+    try:
+        user_id = await seed(engine, rows, topics)
+        results = {name: await measure(engine, path, user_id, repeat) for name, path in PATHS.items()}
+    finally:
+        await engine.dispose()
+    # 両方の経路が同じレスポンスを返すことを確認する
+    if len({result.pop("body") for result in results.values()}) != 1:
+        raise RuntimeError("The fast path returned a different response from the ORM path")
+    return {"rows": rows, "topics": topics, "repeat": repeat, "paths": results}
+
+def benchmark(rows: int, topics: int, repeat: int) -> dict:
+    return asyncio.run(benchmarkAsync(rows, topics, repeat))
+
+def printReport(report: dict):
+    print(f"GET /mylist/retrieve/all ({report['rows']} rows x {report['topics']} topics, {report['repeat']} requests)")
+    print(f"  {'path':<8}{'cpu ms':>10}{'peak KiB':>12}{'bytes':>12}")
+    for name, result in report["paths"].items():
+        print(f"  {name:<8}{result['cpu_ms']:>10.2f}{result['peak_kib']:>12.1f}{result['bytes']:>12}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="マイリスト一覧取得の高速経路とORM経路の比較（1リクエストあたりのCPU時間とメモリ確保量）")
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--topics", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+    report = benchmark(args.rows, args.topics, args.repeat)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        printReport(report)
+
+if __name__ == "__main__":
+    main()
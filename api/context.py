@@ -0,0 +1,37 @@
+from api.background import BackgroundExecutor
+from api.cruds.feed import PublicFeed
+from api.cruds.idempotency import IdempotencyCache
+from api.events import EventHub
+from api.invalidation import InvalidationBus
+from api.logconfig import QueueLogging
+from api.metrics import metrics
+from api.responsecache import ResponseCache
+from api.settings import Settings
+from api.transport import createTransport
+
+# アプリケーションごとのインメモリの状態とバックグラウンド処理（create_appで作成し、app.state.contextに保持する）
+# cruds はセッションのinfoから取得する（common.appContext参照）。停止時は自分が作成したものだけを停止する。
+class AppContext:
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.publicFeed = PublicFeed()
+        # 複数ワーカー間で通知を共有する場合は、TOPICK_EVENT_SOCKET_DIRにUnixソケットのディレクトリを指定する
+        self.eventHub = EventHub(createTransport(settings.event_socket_dir))
+        self.backgroundExecutor = BackgroundExecutor()
+        self.queueLogging = QueueLogging()
+        self.idempotencyCache = IdempotencyCache()
+        self.responseCache = ResponseCache.fromSettings(settings)
+        self.invalidationBus = InvalidationBus(self.eventHub.transport, self.responseCache, self.publicFeed)
+        metrics.gauge("background_queue_depth", self.backgroundExecutor.depth)
+
+    # DBのエンジンを作成した後に呼び出す（ログのキューはエンジンより先に開始する）
+    async def start(self):
+        await self.backgroundExecutor.start()
+        await self.eventHub.transport.start()
+        await self.invalidationBus.start()
+
+    # バックグラウンド処理はDBを使うため、エンジンを破棄する前に呼び出す
+    async def stop(self):
+        await self.invalidationBus.stop()
+        await self.eventHub.transport.stop()
+        await self.backgroundExecutor.stop()
@@ -1,10 +1,16 @@
 import logging
 import random, string
-from sqlalchemy import select
+from typing import Optional
+from sqlalchemy import select, insert, update, delete, literal
 from sqlalchemy.ext.asyncio import AsyncSession
+import api.cruds.common as common
+import api.cruds.summary as summary_crud
 from api.cruds.common import setCreateDate
+from api.responsecache import userTag
 import api.schemas.auth as auth_schema
 import api.models.auth as auth_model
+import api.models.mylist as mylist_model
+import api.models.user as user_model
 from datetime import datetime, timedelta
 from fastapi import HTTPException
 
@@ -19,36 +25,86 @@ async def createAuthCode(db: AsyncSession, body: auth_schema.createAuthCodeParam
     newData.auth_code = newCode
     setCreateDate(newData)
     db.add(newData)
-    await db.commit()
-    await db.refresh(newData)
+    # 採番された認証IDを返すためにフラッシュする
+    await db.flush()
     return newData
 
 # 認証
 async def authenticate(db: AsyncSession, body: auth_schema.authenticateParam) -> auth_schema.authenticateResponse:
     authInDb = await db.get(auth_model.Auth, body.auth_id)
+    checkAuth(authInDb, body)
+    # 上記全てに当てはまらない場合のみ、認証済フラグを立て、userIdを返却する。
+    authInDb.is_authenticated = True
+    return auth_schema.authenticateResponse(user_id=authInDb.user_id)
+    # TODO 更新日三日経過後のデータや認証済みのデータは定期削除を検討。何らかの理由でデータ移行失敗した時用の問い合わせ動線も必要。
+
+# 認証データが使用可能かチェック
+def checkAuth(authInDb: Optional[auth_model.Auth], body: auth_schema.Auth):
     if not authInDb:
-        logger.error(f"Auth with id {body.auth_id} not found")
+        logger.error("Auth with id %s not found", body.auth_id)
         raise HTTPException(status_code=404, detail=f"Auth with id {body.auth_id} not found")
     elif authInDb.auth_code != body.auth_code:
         # 認証コードが誤っている場合
-        logger.error(f"Wrong auth_code for Auth with id {body.auth_id}")
+        logger.error("Wrong auth_code for Auth with id %s", body.auth_id)
         raise HTTPException(status_code=401, detail=f"Wrong auth_code for Auth with id {body.auth_id}")
     elif (authInDb.created_at + timedelta(days=30)) < datetime.now():
         # 作成日から30日経過していた場合、認証期限切れ（レコードの削除は定期実行）
-        logger.error(f"Auth with id {body.auth_id} has expired")
+        logger.error("Auth with id %s has expired", body.auth_id)
         raise HTTPException(status_code=401, detail=f"Auth with id {body.auth_id} has expired")
     elif authInDb.is_authenticated:
         # 認証済の場合、再認証は不可
-        logger.error(f"Auth with id {body.auth_id} has already been used")
+        logger.error("Auth with id %s has already been used", body.auth_id)
         raise HTTPException(status_code=401, detail=f"Auth with id {body.auth_id} has already been used")
+
+# 認証した上で、新端末の仮ユーザーのマイリストを全て認証したユーザーへ移行する
+# 件数に関係なく一括のUPDATEで移し、認証データの使用済み化と同じトランザクションで確定させる。
+async def migrateMylists(db: AsyncSession, body: auth_schema.migrateParam) -> auth_schema.migrateResponse:
+    # 同じ認証データでの同時実行を防ぐため、行ロックを取って確認する
+    authInDb = await db.get(auth_model.Auth, body.auth_id, with_for_update=True)
+    checkAuth(authInDb, body)
+    user_id = authInDb.user_id
+    if body.from_user_id == user_id:
+        raise HTTPException(status_code=400, detail=f"User with id {user_id} cannot be migrated to itself")
+    await common.checkIfUserExist(db, body.from_user_id)
+    # 他のユーザーのマイリストを移行（削除）できないよう、移行元の端末であることを確認する
+    common.checkDeviceToken(await db.get(user_model.User, body.from_user_id), body.from_device_token)
+
+    now = datetime.now()
+    authInDb.is_authenticated = True
+    if not body.delete_source_user:
+        # 移行元のユーザーの端末には、差分同期で削除として通知する
+        await db.execute(
+            insert(mylist_model.MyListDeletion).from_select(
+                ["user_id", "my_list_id", "deleted_at"],
+                select(literal(body.from_user_id), mylist_model.MyList.my_list_id, literal(now))
+                .filter(mylist_model.MyList.user_id == body.from_user_id)
+            )
+        )
+    result = await db.execute(
+        update(mylist_model.MyList)
+        .where(mylist_model.MyList.user_id == body.from_user_id)
+        .values(user_id=user_id, updated_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    # 集計は移行後のマイリストから両ユーザー分を再集計する
+    await summary_crud.rebuildUserSummary(db, user_id)
+    if body.delete_source_user:
+        # 移行元のユーザーを参照しているデータを先に削除する
+        for model in (mylist_model.MyListDeletion, auth_model.Auth, user_model.UserSummary):
+            await db.execute(delete(model).where(model.user_id == body.from_user_id))
+        await db.execute(delete(user_model.User).where(user_model.User.user_id == body.from_user_id))
     else:
-        # 上記全てに当てはまらない場合のみ、認証済フラグを立て、userIdを返却する。
-        authInDb.is_authenticated = True
-        db.add(authInDb)
-        await db.commit()
-        await db.refresh(authInDb)
-        return auth_schema.authenticateResponse(user_id=authInDb.user_id)
-    # TODO 更新日三日経過後のデータや認証済みのデータは定期削除を検討。何らかの理由でデータ移行失敗した時用の問い合わせ動線も必要。
+        await summary_crud.rebuildUserSummary(db, body.from_user_id)
+
+    migratedCount = result.rowcount
+    context = common.appContext(db)
+    def callback():
+        # 一括で移行したため、フィードは次回取得時に再構築し、両ユーザーの端末には再同期を促す
+        context.eventHub.publish(body.from_user_id, {"type": "resync"})
+        context.eventHub.publish(user_id, {"type": "resync"})
+        context.invalidationBus.invalidate([userTag(body.from_user_id), userTag(user_id)], feed=[{"type": "reset"}])
+    common.afterCommit(db, callback)
+    return auth_schema.migrateResponse(user_id=user_id, migrated_count=migratedCount)
 
 
 async def checkUser(db: AsyncSession, user_id: int):
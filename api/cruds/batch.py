@@ -0,0 +1,121 @@
+import datetime
+from typing import Dict, List, Optional, Union
+from sqlalchemy import select, insert, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import api.cruds.common as common
+import api.cruds.mylist as mylist_crud
+import api.cruds.summary as summary_crud
+import api.models.mylist as mylist_model
+import api.models.pick as pick_model
+import api.schemas.mylist as mylist_schema
+from api.genericCode import BatchOperationType
+
+UPDATABLE_FIELDS = ("title", "theme_type", "topic", "is_private")
+
+# オフライン中に溜まった操作を1トランザクションでまとめて適用する
+# 対象のマイリストは1回のSELECTでまとめて取得し、書き込みは最後に1回のflushでまとめて発行する。
+# 存在しないマイリストへの操作などはその操作だけエラーとして返し、残りの操作は適用する。
+async def applyBatch(db: AsyncSession, body: mylist_schema.batchSyncParam) -> mylist_schema.batchSyncResponse:
+    await common.checkIfUserExist(db, body.user_id)
+
+    # 他のユーザーのマイリストは存在しないものとして扱う
+    targetIds = {operation.my_list_id for operation in body.operations if operation.my_list_id is not None}
+    lists: Dict[Union[int, str], mylist_model.MyList] = {}
+    if len(targetIds) != 0:
+        result = await db.execute(
+            select(mylist_model.MyList).filter(
+                mylist_model.MyList.my_list_id.in_(targetIds),
+                mylist_model.MyList.user_id == body.user_id
+            )
+        )
+        lists = {mylist.my_list_id: mylist for mylist in result.scalars().all()}
+
+    created: Dict[str, mylist_model.MyList] = {}
+    updated: Dict[int, mylist_model.MyList] = {}
+    deleted: Dict[int, mylist_model.MyList] = {}
+    topicChanged = set()
+    delta = summary_crud.SummaryDelta()
+    results: List[mylist_schema.batchOperationResult] = []
+
+    for index, operation in enumerate(body.operations):
+        key = operation.my_list_id if operation.my_list_id is not None else operation.temp_id
+        if operation.op == BatchOperationType.CREATE:
+            if operation.temp_id in created:
+                results.append(errorResult(index, operation, f"temp_id {operation.temp_id} is already used"))
+                continue
+            newList = mylist_model.MyList(
+                user_id=body.user_id,
+                title=operation.title,
+                theme_type=operation.theme_type,
+                topic=operation.topic if operation.topic is not None else {"topic": []},
+                is_private=operation.is_private if operation.is_private is not None else False
+            )
+            common.setCreateDate(newList)
+            db.add(newList)
+            delta.add(newList)
+            created[operation.temp_id] = newList
+            lists[operation.temp_id] = newList
+            results.append(mylist_schema.batchOperationResult(index=index, op=operation.op, status="ok", temp_id=operation.temp_id))
+            continue
+
+        target: Optional[mylist_model.MyList] = lists.get(key)
+        if target is None:
+            results.append(errorResult(index, operation, f"Mylist with id {key} not found"))
+            continue
+
+        delta.remove(target)
+        if operation.op == BatchOperationType.UPDATE:
+            for field in UPDATABLE_FIELDS:
+                value = getattr(operation, field)
+                if value is not None:
+                    setattr(target, field, value)
+            delta.add(target)
+            if target.my_list_id is not None:
+                updated[target.my_list_id] = target
+                if operation.topic is not None:
+                    topicChanged.add(target.my_list_id)
+        else:
+            del lists[key]
+            if target.my_list_id is None:
+                # 同じバッチ内で作成したマイリストはINSERT自体を取りやめる
+                db.expunge(target)
+                del created[operation.temp_id]
+            else:
+                await db.delete(target)
+                updated.pop(target.my_list_id, None)
+                topicChanged.discard(target.my_list_id)
+                deleted[target.my_list_id] = target
+        results.append(mylist_schema.batchOperationResult(index=index, op=operation.op, status="ok", my_list_id=target.my_list_id, temp_id=operation.temp_id))
+
+    await summary_crud.applyDelta(db, body.user_id, delta)
+    await db.flush()
+
+    if len(deleted) != 0:
+        now = datetime.datetime.now()
+        await db.execute(
+            insert(mylist_model.MyListDeletion),
+            [{"user_id": body.user_id, "my_list_id": my_list_id, "deleted_at": now} for my_list_id in deleted]
+        )
+    if len(topicChanged) != 0:
+        await db.execute(delete(pick_model.PickState).where(pick_model.PickState.my_list_id.in_(topicChanged)))
+
+    for newList in created.values():
+        mylist_crud.notifySaved(db, newList, "created")
+    for mylist in updated.values():
+        mylist_crud.notifySaved(db, mylist, "updated")
+    for my_list_id in deleted:
+        mylist_crud.notifyDeleted(db, body.user_id, my_list_id)
+
+    idMap = {temp_id: newList.my_list_id for temp_id, newList in created.items()}
+
+    # 作成した操作の結果に採番されたIDを反映（後から削除した仮IDは含まれない）
+    for result in results:
+        if result.status == "ok" and result.my_list_id is None and result.temp_id in idMap:
+            result.my_list_id = idMap[result.temp_id]
+    return mylist_schema.batchSyncResponse(results=results, id_map=idMap)
+
+def errorResult(index: int, operation: mylist_schema.batchOperation, detail: str) -> mylist_schema.batchOperationResult:
+    return mylist_schema.batchOperationResult(
+        index=index, op=operation.op, status="error", my_list_id=operation.my_list_id, temp_id=operation.temp_id, detail=detail
+    )
@@ -1,7 +1,20 @@
 import datetime
+import hashlib
+import hmac
+import logging
+import secrets
+from typing import TYPE_CHECKING
 from fastapi import HTTPException
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
 import api.models.user as user_model
+from api.background import Priority
+
+if TYPE_CHECKING:
+    from api.context import AppContext
+
+logger = logging.getLogger('uvicorn')
 
 def setCreateDate(model):
     now = datetime.datetime.now()
@@ -14,4 +27,50 @@ async def checkIfUserExist(db: AsyncSession, user_id: int):
     if not userInDb:
         raise HTTPException(
             status_code=404, detail=f"User with id {user_id} not found")
-    return
\ No newline at end of file
+    return
+
+# ユーザーの作成時に端末へ発行するトークン（DBにはハッシュだけを保存する）
+def issueDeviceToken(user: user_model.User) -> str:
+    token = secrets.token_urlsafe(32)
+    user.device_token_hash = hashToken(token)
+    return token
+
+def hashToken(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# 端末のトークンがユーザーに発行したものか確認する
+def checkDeviceToken(user: user_model.User, token: str):
+    if user.device_token_hash is None or not hmac.compare_digest(user.device_token_hash, hashToken(token)):
+        logger.error("Wrong device_token for User with id %s", user.user_id)
+        raise HTTPException(status_code=403, detail=f"Wrong device_token for User with id {user.user_id}")
+
+# リクエストを処理しているアプリケーションの状態（create_appでセッションのinfoに設定される）
+def appContext(db: AsyncSession) -> "AppContext":
+    return db.sync_session.info["context"]
+
+# コミット成功後に実行する処理を登録（ロールバックされた場合は破棄される）
+# フィードなどのインメモリの状態は、DBに確定した変更だけを反映させるためにこれを経由して更新する。
+def afterCommit(db: AsyncSession, callback):
+    db.sync_session.info.setdefault("after_commit", []).append(callback)
+
+@event.listens_for(Session, "after_commit")
+def _runAfterCommit(session: Session):
+    for callback in session.info.pop("after_commit", []):
+        try:
+            callback()
+        except Exception:
+            # コミット済みのデータには影響しないため、ログだけ残してリクエストは成功させる
+            logger.exception("after commit callback failed")
+
+@event.listens_for(Session, "after_rollback")
+def _discardAfterCommit(session: Session):
+    session.info.pop("after_commit", None)
+
+# コミット成功後に、レスポンスに必要ない処理をバックグラウンドのキューへ渡す
+def deferAfterCommit(db: AsyncSession, function, *args, priority: Priority = Priority.NORMAL):
+    executor = appContext(db).backgroundExecutor
+    afterCommit(db, lambda: executor.submit(function, *args, priority=priority))
+
+# リクエストのセッションと同じ接続先で、バックグラウンド処理用のセッションを作成
+def backgroundSession(db: AsyncSession) -> AsyncSession:
+    return AsyncSession(bind=db.bind, expire_on_commit=False, info={"context": appContext(db)})
@@ -0,0 +1,89 @@
+import asyncio
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import api.models.mylist as mylist_model
+
+# フィードに保持する公開マイリストの最大件数
+FEED_CAPACITY = 1000
+
+# 最近更新された公開マイリストのIDを新しい順に保持するフィード
+# 書き込みのたびに差分で更新し、リクエスト時にはテーブル全体のソートを行わない。
+# 起動直後など未ロードの場合のみ、(is_private, updated_at)のインデックスを使うクエリで再構築する。
+class PublicFeed:
+    def __init__(self, capacity: int = FEED_CAPACITY):
+        self.capacity = capacity
+        # 末尾が最新。move_to_end / popitem で追加・削除ともにO(1)
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+        # ページ取得用のスナップショット（新しい順）。書き込みがあるまで使い回す
+        self._snapshot: Optional[Tuple[int, ...]] = None
+        self._loaded = False
+        self._loading: Optional[asyncio.Lock] = None
+        # 再構築中に発生した書き込み（再構築完了後に適用する）
+        self._pending: List[Tuple[int, bool]] = []
+
+    def touch(self, my_list_id: int, is_private: bool):
+        if not self._loaded:
+            if self._loading is not None and self._loading.locked():
+                self._pending.append((my_list_id, is_private))
+            return
+        if is_private:
+            self.discard(my_list_id)
+            return
+        self._ids.pop(my_list_id, None)
+        self._ids[my_list_id] = None
+        if len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+        self._snapshot = None
+
+    def discard(self, my_list_id: int):
+        if not self._loaded:
+            if self._loading is not None and self._loading.locked():
+                self._pending.append((my_list_id, True))
+            return
+        if self._ids.pop(my_list_id, False) is None:
+            self._snapshot = None
+
+    # 他のワーカーを含む書き込みの通知を反映する（InvalidationBus.invalidate参照）
+    def apply(self, event: dict):
+        if event["type"] == "touch":
+            self.touch(event["my_list_id"], event["is_private"])
+        elif event["type"] == "discard":
+            self.discard(event["my_list_id"])
+        elif event["type"] == "reset":
+            self.reset()
+
+    def reset(self):
+        self._ids.clear()
+        self._snapshot = None
+        self._loaded = False
+        self._loading = None
+        self._pending.clear()
+
+    async def page(self, db: AsyncSession, offset: int, limit: int) -> Tuple[int, ...]:
+        if not self._loaded:
+            await self.rebuild(db)
+        if self._snapshot is None:
+            self._snapshot = tuple(reversed(self._ids))
+        return self._snapshot[offset:offset + limit]
+
+    async def rebuild(self, db: AsyncSession):
+        if self._loading is None:
+            self._loading = asyncio.Lock()
+        async with self._loading:
+            if self._loaded:
+                return
+            result = await db.execute(
+                select(mylist_model.MyList.my_list_id)
+                .filter(mylist_model.MyList.is_private == False)
+                .order_by(mylist_model.MyList.updated_at.desc(), mylist_model.MyList.my_list_id.desc())
+                .limit(self.capacity)
+            )
+            self._ids = OrderedDict((my_list_id, None) for my_list_id in reversed(result.scalars().all()))
+            self._snapshot = None
+            self._loaded = True
+            pending, self._pending = self._pending, []
+        for my_list_id, is_private in pending:
+            self.touch(my_list_id, is_private)
@@ -0,0 +1,147 @@
+import datetime
+import hashlib
+import itertools
+import json
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple, Type
+from fastapi import HTTPException
+from pydantic import BaseModel
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import api.cruds.common as common
+import api.models.idempotency as idempotency_model
+from api.background import Priority
+from api.db import retryTransaction
+
+logger = logging.getLogger('uvicorn')
+
+# 保存したレスポンスを再利用する期間
+IDEMPOTENCY_TTL = datetime.timedelta(hours=24)
+# 処理中の記録がこの時間を過ぎても完了しない場合は、異常終了したとみなして再実行を許可する
+IN_PROGRESS_TIMEOUT = datetime.timedelta(seconds=60)
+# プロセス内に保持する件数の上限
+CACHE_SIZE = 10000
+# DBの記録には保存しない項目（端末のトークンはDBにハッシュだけを保存するため、プロセス内のキャッシュからのみ再送する）
+SECRET_FIELDS = {"device_token"}
+# この件数の予約ごとに、期限切れの記録の削除をバックグラウンドで行う
+PURGE_INTERVAL = 100
+reservationCounter = itertools.count(1)
+
+# 完了済みのレスポンスのプロセス内LRU（DBへの問い合わせを省略する）
+class IdempotencyCache:
+    def __init__(self, size: int = CACHE_SIZE):
+        self.size = size
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[datetime.datetime, str, dict]]" = OrderedDict()
+
+    # (リクエストのハッシュ, レスポンス)を返す
+    def get(self, key: Tuple[str, str]) -> Optional[Tuple[str, dict]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        createdAt, requestHash, response = entry
+        if createdAt + IDEMPOTENCY_TTL < datetime.datetime.now():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return requestHash, response
+
+    def put(self, key: Tuple[str, str], createdAt: datetime.datetime, requestHash: str, response: dict):
+        self._entries[key] = (createdAt, requestHash, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+# リクエストボディのハッシュ（/mylist/createではuser_idも含まれる）
+def requestHash(body: BaseModel) -> str:
+    return hashlib.sha256(json.dumps(body.dict(), sort_keys=True, default=str).encode()).hexdigest()
+
+# 同じキーで内容の異なるリクエスト（別のユーザーなど）には保存済みのレスポンスを返さない
+def checkRequestHash(key: str, stored: str, requested: str):
+    if stored != requested:
+        logger.error("Idempotency-Key %s was used for a different request", key)
+        raise HTTPException(status_code=422, detail=f"Idempotency-Key {key} was used for a different request")
+
+# Idempotency-Keyが指定されていれば、同じキーでの再送には保存済みのレスポンスを返し、処理は一度だけ実行する
+# キーの予約・処理・レスポンスの保存はリクエストの1トランザクションで確定する（失敗した場合は予約ごとロールバックされる）。
+async def runIdempotent(
+    db: AsyncSession,
+    key: Optional[str],
+    endpoint: str,
+    body: BaseModel,
+    handler: Callable[[], Awaitable[object]],
+    response_model: Type[BaseModel]
+):
+    if key is None:
+        return await handler()
+
+    cacheKey = (endpoint, key)
+    fingerprint = requestHash(body)
+    cache = common.appContext(db).idempotencyCache
+    cached = cache.get(cacheKey)
+    if cached is not None:
+        checkRequestHash(key, cached[0], fingerprint)
+        return cached[1]
+
+    createdAt, stored = await reserve(db, endpoint, key, fingerprint)
+    if stored is not None:
+        cache.put(cacheKey, createdAt, fingerprint, stored)
+        return stored
+
+    result = await handler()
+    response = response_model.from_orm(result).dict()
+    await db.execute(
+        update(idempotency_model.IdempotencyKey)
+        .where(
+            idempotency_model.IdempotencyKey.endpoint == endpoint,
+            idempotency_model.IdempotencyKey.idempotency_key == key
+        )
+        .values(response={name: value for name, value in response.items() if name not in SECRET_FIELDS})
+    )
+    common.afterCommit(db, lambda: cache.put(cacheKey, createdAt, fingerprint, response))
+    return response
+
+# キーを予約する。既に完了済みの記録がある場合は保存済みのレスポンスを返す
+async def reserve(db: AsyncSession, endpoint: str, key: str, fingerprint: str) -> Tuple[datetime.datetime, Optional[dict]]:
+    now = datetime.datetime.now()
+    record = await db.get(idempotency_model.IdempotencyKey, (endpoint, key))
+    if record is not None:
+        if record.created_at + IDEMPOTENCY_TTL < now or (record.response is None and record.created_at + IN_PROGRESS_TIMEOUT < now):
+            # 期限切れの記録は新しいリクエストとして扱う
+            record.request_hash = fingerprint
+            record.response = None
+            record.created_at = now
+            return now, None
+        checkRequestHash(key, record.request_hash, fingerprint)
+        if record.response is None:
+            logger.error("Request with Idempotency-Key %s is in progress", key)
+            raise HTTPException(status_code=409, detail=f"Request with Idempotency-Key {key} is in progress")
+        return record.created_at, record.response
+
+    db.add(idempotency_model.IdempotencyKey(endpoint=endpoint, idempotency_key=key, request_hash=fingerprint, created_at=now))
+    if next(reservationCounter) % PURGE_INTERVAL == 0:
+        common.deferAfterCommit(db, purgeExpired, common.backgroundSession(db), priority=Priority.LOW)
+    try:
+        # 同じキーの同時リクエストは、先のリクエストがコミットするまでここで待たされる
+        await db.flush()
+    except IntegrityError:
+        # 同じキーのリクエストが同時に届いた場合
+        await db.rollback()
+        logger.error("Request with Idempotency-Key %s is in progress", key)
+        raise HTTPException(status_code=409, detail=f"Request with Idempotency-Key {key} is in progress")
+    return now, None
+
+# 期限切れの記録を削除
+@retryTransaction
+async def purgeExpired(db: AsyncSession):
+    async with db:
+        await db.execute(
+            delete(idempotency_model.IdempotencyKey)
+            .where(idempotency_model.IdempotencyKey.created_at < datetime.datetime.now() - IDEMPOTENCY_TTL)
+        )
+        await db.commit()
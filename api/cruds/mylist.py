@@ -1,20 +1,155 @@
+import datetime
+import itertools
 import logging
 from typing import List, Tuple, Optional
 import api.cruds.common as common
 from api.genericCode import UpdateTargetType
-from sqlalchemy import select
+from fastapi import HTTPException
+from sqlalchemy import bindparam, delete, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.engine import Result
 
 import api.models.mylist as mylist_model
 import api.schemas.mylist as mylist_schema
 import api.models.user as user_model
+from api.background import Priority
+from api.cruds.pick import resetPickState
+import api.cruds.summary as summary_crud
+from api.db import retryTransaction
+from api.responsecache import userTag
 
 logger = logging.getLogger('uvicorn')
 
+# 差分同期で、カーソルより前にさかのぼって再送する時間
+# updated_atはコミット時ではなくフラッシュ時の時刻のため、長いトランザクション（一括同期、ロック待ち）の変更は
+# カーソルより前の時刻でコミットされることがある。処理時間の上限（HEAVYで30秒）より長く取り、取りこぼさない。
+CURSOR_MARGIN = datetime.timedelta(seconds=60)
+# 差分同期のカーソルの有効期間（これより古いカーソルは、削除の記録が残っていないため全件の同期からやり直させる）
+CURSOR_MAX_AGE = datetime.timedelta(days=30)
+# この件数の削除ごとに、有効期間を過ぎた削除の記録の削除をバックグラウンドで行う
+PURGE_INTERVAL = 100
+deletionCounter = itertools.count(1)
+
 # 全マイリストを取得
-async def retrieveAllMyListsByUserId(db: AsyncSession, user_id: int) -> List[Tuple[int, str, str, dict, bool]]:
+async def retrieveAllMyListsByUserId(
+    db: AsyncSession,
+    user_id: int,
+    fields: Optional[List[str]] = None,
+    sort: Optional[str] = None,
+    min_topics: Optional[int] = None,
+    max_topics: Optional[int] = None
+) -> List[Tuple[int, str, str, dict, bool]]:
+    await common.checkIfUserExist(db, user_id)
+    if fields is None:
+        fields = DEFAULT_FIELDS
+    query = select(*[SELECTABLE_COLUMNS[field] for field in fields]).filter(mylist_model.MyList.user_id == user_id)
+    # トピック数での絞り込み・並び替えは (user_id, topic_count) のインデックスを使う
+    if min_topics is not None:
+        query = query.filter(mylist_model.MyList.topic_count >= min_topics)
+    if max_topics is not None:
+        query = query.filter(mylist_model.MyList.topic_count <= max_topics)
+    if sort is not None:
+        query = query.order_by(SORT_ORDERS[sort])
+    # (user_id, updated_at)のインデックスが使われても作成順で返るように明示する
+    result: Result = await db.execute(query.order_by(mylist_model.MyList.my_list_id))
+    return result.all()
+
+# 全マイリスト取得の高速経路（項目・並び順・絞り込みの指定がない場合）
+# 事前に作成した文をORMを経由せずに実行し、Resultの行から__slots__の行オブジェクトを作ってそのまま検証・エンコードへ渡す。
+async def retrieveAllMylistRows(db: AsyncSession, user_id: int) -> List["MylistRow"]:
+    await common.checkIfUserExist(db, user_id)
+    connection = await db.connection()
+    result = await connection.execute(RETRIEVE_ALL_STATEMENT, {"user_id": user_id})
+    return [MylistRow(*row) for row in result]
+
+class MylistRow:
+    __slots__ = ("my_list_id", "title", "theme_type", "topic", "is_private")
+
+    def __init__(self, my_list_id: int, title: str, theme_type: str, topic: dict, is_private: bool):
+        self.my_list_id = my_list_id
+        self.title = title
+        self.theme_type = theme_type
+        self.topic = topic
+        self.is_private = is_private
+
+_table = mylist_model.MyList.__table__
+RETRIEVE_ALL_STATEMENT = (
+    select(_table.c.my_list_id, _table.c.title, _table.c.theme_type, _table.c.topic, _table.c.is_private)
+    .where(_table.c.user_id == bindparam("user_id"))
+    .order_by(_table.c.my_list_id)
+)
+
+# 一覧取得で指定できる項目（指定された項目だけをSELECTするので、topicを除けばJSON列を読まない）
+SELECTABLE_COLUMNS = {
+    "my_list_id": mylist_model.MyList.my_list_id,
+    "title": mylist_model.MyList.title,
+    "theme_type": mylist_model.MyList.theme_type,
+    "topic": mylist_model.MyList.topic,
+    "is_private": mylist_model.MyList.is_private,
+    "topic_count": mylist_model.MyList.topic_count,
+}
+DEFAULT_FIELDS = ["my_list_id", "title", "theme_type", "topic", "is_private"]
+# 一覧取得で指定できる並び順（先頭に-を付けると降順）
+SORT_ORDERS = {
+    "topic_count": mylist_model.MyList.topic_count.asc(),
+    "-topic_count": mylist_model.MyList.topic_count.desc(),
+}
+
+# fieldsパラメータ（カンマ区切り）を項目名のリストに変換
+def parseFields(fields: str) -> List[str]:
+    names = list(dict.fromkeys(name.strip() for name in fields.split(",") if name.strip() != ""))
+    unknown = [name for name in names if name not in SELECTABLE_COLUMNS]
+    if len(names) == 0 or len(unknown) != 0:
+        raise HTTPException(status_code=400, detail=f"Invalid fields: {','.join(unknown)}")
+    return names
+
+# 差分同期: カーソル（前回取得時の更新日時）以降に作成・更新・削除されたマイリストを取得
+async def retrieveChangesByUserId(db: AsyncSession, user_id: int, since: Optional[datetime.datetime]) -> mylist_schema.mylistChangesResponse:
+    if since is not None and since < datetime.datetime.now() - CURSOR_MAX_AGE:
+        logger.error("Cursor %s is too old for User with id %s", since, user_id)
+        raise HTTPException(status_code=410, detail="Cursor is too old, sync again without since")
     await common.checkIfUserExist(db, user_id)
+    query = select(
+        mylist_model.MyList.my_list_id,
+        mylist_model.MyList.title,
+        mylist_model.MyList.theme_type,
+        mylist_model.MyList.topic,
+        mylist_model.MyList.is_private,
+        mylist_model.MyList.created_at,
+        mylist_model.MyList.updated_at
+    ).filter(mylist_model.MyList.user_id == user_id)
+    # カーソルと同時刻（MySQLのDATETIMEは秒単位）や、カーソルより前の時刻でコミットされた変更も取りこぼさないよう、
+    # CURSOR_MARGINだけさかのぼって取得する（クライアント側はmy_list_idで上書きするので重複しても問題ない）
+    after = since - CURSOR_MARGIN if since is not None else None
+    if after is not None:
+        query = query.filter(mylist_model.MyList.updated_at >= after)
+    lists = (await db.execute(query.order_by(mylist_model.MyList.updated_at))).all()
+
+    deletions = []
+    if since is not None:
+        # カーソルがない（初回同期）場合は削除の通知は不要
+        deletions = (await db.execute(
+            select(mylist_model.MyListDeletion.my_list_id, mylist_model.MyListDeletion.deleted_at)
+            .filter(
+                mylist_model.MyListDeletion.user_id == user_id,
+                mylist_model.MyListDeletion.deleted_at >= after
+            )
+        )).all()
+
+    # さかのぼって取得した変更だけの場合も、カーソルは前回より戻さない
+    timestamps = [row.updated_at for row in lists] + [row.deleted_at for row in deletions] + ([since] if since is not None else [])
+    return mylist_schema.mylistChangesResponse(
+        created=[row for row in lists if since is None or row.created_at >= since],
+        updated=[row for row in lists if since is not None and row.created_at < since],
+        deleted=[row.my_list_id for row in deletions],
+        cursor=max(timestamps, default=None)
+    )
+
+# 最近更新された公開マイリストを取得（新しい順）
+async def retrievePublicFeed(db: AsyncSession, offset: int, limit: int) -> List[Tuple[int, str, str, dict, bool]]:
+    ids = await common.appContext(db).publicFeed.page(db, offset, limit)
+    if len(ids) == 0:
+        return []
     result: Result = await db.execute(
         select(
             mylist_model.MyList.my_list_id,
@@ -22,24 +157,33 @@ async def retrieveAllMyListsByUserId(db: AsyncSession, user_id: int) -> List[Tup
             mylist_model.MyList.theme_type,
             mylist_model.MyList.topic,
             mylist_model.MyList.is_private
-        ).filter(mylist_model.MyList.user_id == user_id)
+        ).filter(
+            mylist_model.MyList.my_list_id.in_(ids),
+            mylist_model.MyList.is_private == False
+        )
     )
-    return result.all()
+    rows = {row.my_list_id: row for row in result.all()}
+    # 主キー検索なので順序が保証されないため、フィードの順に並べ直す
+    return [rows[my_list_id] for my_list_id in ids if my_list_id in rows]
 
 async def createUserAndNewList(db: AsyncSession, body: mylist_schema.createUserThenMylistParam) -> mylist_schema.createUserThenMylistResponse:
     # 新規ユーザー作成
     newUser = user_model.User()
     common.setCreateDate(newUser)
+    deviceToken = common.issueDeviceToken(newUser)
     db.add(newUser)
-    await db.commit()
-    await db.refresh(newUser)
+    # 採番されたユーザーIDを使うためにフラッシュする
+    await db.flush()
     # 作成したユーザーのIDでマイリスト作成
     newList = createNewListFromBody(body, newUser.user_id)
     common.setCreateDate(newList)
     db.add(newList)
-    await db.commit()
-    await db.refresh(newList)
-    return newList
+    summary_crud.createUserSummary(db, newUser.user_id, summary_crud.SummaryDelta().add(newList))
+    notifySaved(db, newList, "created")
+    await db.flush()
+    return mylist_schema.createUserThenMylistResponse(
+        **mylist_schema.Mylist.from_orm(newList).dict(), user_id=newList.user_id, device_token=deviceToken
+    )
 
 async def createNewList(db: AsyncSession, body: mylist_schema.createMylistParam) -> mylist_model.MyList:
     user_id = body.dict()["user_id"]
@@ -47,36 +191,54 @@ async def createNewList(db: AsyncSession, body: mylist_schema.createMylistParam)
     newList = mylist_model.MyList(**body.dict())
     common.setCreateDate(newList)
     db.add(newList)
-    await db.commit()
-    await db.refresh(newList)
+    await summary_crud.applyDelta(db, user_id, summary_crud.SummaryDelta().add(newList))
+    notifySaved(db, newList, "created")
+    # レスポンスに採番されたIDを含めるためにフラッシュする（コミットはリクエストの終了時）
+    await db.flush()
     return newList
 
+# 主キーで取得する（同じセッションで取得済みならSELECTしない。更新するのでエンティティで返す）
 async def getMylistById(db: AsyncSession, mylist_id: int) -> Optional[mylist_model.MyList]:
-    result: Result = await db.execute(
-        select(mylist_model.MyList).filter(mylist_model.MyList.my_list_id == mylist_id)
-    )
-    mylist: Optional[Tuple[mylist_model.MyList]] = result.first()
-    return mylist[0] if mylist is not None else None  # 要素が一つであってもtupleで返却されるので１つ目の要素を取り出す
+    return await db.get(mylist_model.MyList, mylist_id)
 
 async def updateMyList(db: AsyncSession, body: any, original: mylist_model.MyList, target: UpdateTargetType) -> mylist_model.MyList:
+    before = summary_crud.snapshot(original)
     if target == UpdateTargetType.TITLE:
         original.title = body.title
     elif target == UpdateTargetType.THEME:
         original.theme_type = body.theme_type
     elif target == UpdateTargetType.TOPIC:
         original.topic = body.topic
+        # トピックが変わるので重複なし抽選の周回をやり直す
+        await resetPickState(db, original.my_list_id)
     elif target == UpdateTargetType.PRIVATE_FLAG:
         original.is_private = body.is_private
     else:
-        logger.error(f"UpdateTargetType with id {target} not found")
+        logger.error("UpdateTargetType with id %s not found", target)
     db.add(original)
-    await db.commit()
-    await db.refresh(original)
+    await summary_crud.applyDelta(db, original.user_id, summary_crud.SummaryDelta().remove(before).add(original))
+    notifySaved(db, original, "updated")
     return original
 
 async def deleteMylist(db: AsyncSession, original: mylist_model.MyList) -> None:
+    my_list_id = original.my_list_id
     await db.delete(original)
-    await db.commit()
+    await summary_crud.applyDelta(db, original.user_id, summary_crud.SummaryDelta().remove(original))
+    # 差分同期用に削除を記録（カーソルの有効期間を過ぎた記録は定期的に削除する）
+    db.add(mylist_model.MyListDeletion(user_id=original.user_id, my_list_id=my_list_id, deleted_at=datetime.datetime.now()))
+    if next(deletionCounter) % PURGE_INTERVAL == 0:
+        common.deferAfterCommit(db, purgeDeletions, common.backgroundSession(db), priority=Priority.LOW)
+    notifyDeleted(db, original.user_id, my_list_id)
+
+# カーソルの有効期間を過ぎた削除の記録を削除（有効期間内のカーソルでさかのぼって取得する分は残す）
+@retryTransaction
+async def purgeDeletions(db: AsyncSession):
+    async with db:
+        await db.execute(
+            delete(mylist_model.MyListDeletion)
+            .where(mylist_model.MyListDeletion.deleted_at < datetime.datetime.now() - CURSOR_MAX_AGE - CURSOR_MARGIN)
+        )
+        await db.commit()
 
 def createNewListFromBody(body: mylist_schema.createUserThenMylistParam, user_id: int) -> mylist_model.MyList:
     dict = body.dict()
@@ -85,4 +247,19 @@ def createNewListFromBody(body: mylist_schema.createUserThenMylistParam, user_id
     newList = mylist_model.MyList(**dict)
     return newList
 
+# コミット後にフィードと変更通知、全ワーカーのレスポンスのキャッシュへ反映する（非公開に変更された場合はフィードから除外される）
+def notifySaved(db: AsyncSession, mylist: mylist_model.MyList, event_type: str):
+    context = common.appContext(db)
+    def callback():
+        context.eventHub.publish(mylist.user_id, {"type": event_type, "my_list_id": mylist.my_list_id})
+        context.invalidationBus.invalidate(
+            [userTag(mylist.user_id)], feed=[{"type": "touch", "my_list_id": mylist.my_list_id, "is_private": mylist.is_private}]
+        )
+    common.afterCommit(db, callback)
 
+def notifyDeleted(db: AsyncSession, user_id: int, my_list_id: int):
+    context = common.appContext(db)
+    def callback():
+        context.eventHub.publish(user_id, {"type": "deleted", "my_list_id": my_list_id})
+        context.invalidationBus.invalidate([userTag(user_id)], feed=[{"type": "discard", "my_list_id": my_list_id}])
+    common.afterCommit(db, callback)
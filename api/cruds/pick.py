@@ -0,0 +1,108 @@
+import datetime
+import heapq
+import random
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import select, delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import api.cruds.common as common
+import api.models.mylist as mylist_model
+import api.models.pick as pick_model
+import api.schemas.mylist as mylist_schema
+
+# マイリストからトピックを抽選する
+# トピック配列全体は取得せず、要素数（topic_count列）と選ばれたインデックスの要素だけをDBから取り出す。
+async def pickTopics(db: AsyncSession, mylist_id: int, count: int, weights: Optional[List[float]], no_repeat: bool) -> mylist_schema.pickTopicResponse:
+    result = await db.execute(
+        select(mylist_model.MyList.topic_count)
+        .filter(mylist_model.MyList.my_list_id == mylist_id)
+    )
+    row = result.first()
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Mylist with id {mylist_id} not found")
+    length = row[0] or 0
+
+    remaining = None
+    if no_repeat:
+        if weights is not None:
+            raise HTTPException(status_code=400, detail="weights cannot be used with no_repeat")
+        indexes, remaining = await nextFromPermutation(db, mylist_id, length, count)
+    elif weights is not None:
+        indexes = weightedSample(weights, length, count)
+    else:
+        indexes = random.sample(range(length), min(count, length))
+
+    return mylist_schema.pickTopicResponse(
+        my_list_id=mylist_id,
+        topic=await getTopicsAt(db, mylist_id, indexes),
+        remaining=remaining
+    )
+
+# 指定したインデックスのトピックだけを取得
+async def getTopicsAt(db: AsyncSession, mylist_id: int, indexes: List[int]) -> list:
+    if len(indexes) == 0:
+        return []
+    result = await db.execute(
+        select(*[mylist_model.MyList.topic[("topic", index)] for index in indexes])
+        .filter(mylist_model.MyList.my_list_id == mylist_id)
+    )
+    return list(result.one())
+
+# 重み付き抽選（重複なし）。重みが指定されていないトピックは1.0として扱う。
+def weightedSample(weights: List[float], length: int, count: int) -> List[int]:
+    if any(weight < 0 for weight in weights):
+        raise HTTPException(status_code=400, detail="weights must not be negative")
+    weights = (weights + [1.0] * length)[:length]
+    candidates = [(index, weight) for index, weight in enumerate(weights) if weight > 0]
+    # Efraimidis-Spirakis法: u^(1/w) が大きい順にcount件選ぶ
+    keyed = ((random.random() ** (1 / weight), index) for index, weight in candidates)
+    return [index for _, index in heapq.nlargest(count, keyed)]
+
+# 保存済みのシャッフル順に沿って抽選し、一周するまで同じトピックを返さない
+async def nextFromPermutation(db: AsyncSession, mylist_id: int, length: int, count: int) -> Tuple[List[int], int]:
+    if length == 0:
+        return [], 0
+    state = await db.get(pick_model.PickState, mylist_id, with_for_update=True)
+    if state is None:
+        # 初回の抽選が同時に届いても一意制約違反にならないよう、既に行があれば何もしない挿入をしてからロックを取り直す
+        now = datetime.datetime.now()
+        await db.execute(
+            insert(pick_model.PickState)
+            .prefix_with("IGNORE", dialect="mysql")
+            .prefix_with("OR IGNORE", dialect="sqlite")
+            .values(my_list_id=mylist_id, permutation=shuffledIndexes(length), position=0, created_at=now, updated_at=now)
+        )
+        state = await db.get(pick_model.PickState, mylist_id, with_for_update=True)
+        if state is None:
+            # 挿入の前にマイリストが削除された場合
+            raise HTTPException(status_code=404, detail=f"Mylist with id {mylist_id} not found")
+    if len(state.permutation) != length:
+        # トピック数が変わった場合は新しい周回を始める
+        state.permutation = shuffledIndexes(length)
+        state.position = 0
+
+    permutation, position = state.permutation, state.position
+    picked: List[int] = []
+    for _ in range(min(count, length)):
+        if position >= len(permutation):
+            # 一周したのでシャッフルし直す。今回既に引いたトピックは新しい周回の最後に回す
+            pickedSet = set(picked)
+            permutation = shuffledIndexes(length)
+            permutation.sort(key=lambda index: index in pickedSet)
+            position = 0
+        picked.append(permutation[position])
+        position += 1
+
+    state.permutation = permutation
+    state.position = position
+    return picked, len(permutation) - position
+
+def shuffledIndexes(length: int) -> List[int]:
+    indexes = list(range(length))
+    random.shuffle(indexes)
+    return indexes
+
+# トピック更新時は抽選状態を破棄する
+async def resetPickState(db: AsyncSession, mylist_id: int):
+    await db.execute(delete(pick_model.PickState).where(pick_model.PickState.my_list_id == mylist_id))
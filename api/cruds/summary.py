@@ -0,0 +1,121 @@
+import datetime
+from collections import Counter
+from types import SimpleNamespace
+from typing import Optional
+from sqlalchemy import select, func, case
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import api.cruds.common as common
+import api.models.mylist as mylist_model
+import api.models.user as user_model
+import api.schemas.mylist as mylist_schema
+
+# 集計の差分
+class SummaryDelta:
+    def __init__(self):
+        self.list_count = 0
+        self.private_count = 0
+        self.topic_count = 0
+        self.themes: Counter = Counter()
+
+    def add(self, mylist, sign: int = 1):
+        self.list_count += sign
+        self.private_count += sign if mylist.is_private else 0
+        self.topic_count += sign * topicLength(mylist.topic)
+        self.themes[mylist.theme_type] += sign
+        return self
+
+    def remove(self, mylist):
+        return self.add(mylist, -1)
+
+    def isEmpty(self) -> bool:
+        return self.list_count == 0 and self.private_count == 0 and self.topic_count == 0 and not any(self.themes.values())
+
+def topicLength(topic: Optional[dict]) -> int:
+    if isinstance(topic, dict) and isinstance(topic.get("topic"), list):
+        return len(topic["topic"])
+    return 0
+
+# 更新前のマイリストの値を控えておく（updateの差分計算用）
+def snapshot(mylist: mylist_model.MyList) -> SimpleNamespace:
+    return SimpleNamespace(is_private=mylist.is_private, topic=mylist.topic, theme_type=mylist.theme_type)
+
+# 集計に差分を反映する（書き込みと同じトランザクション内で呼ぶ）
+async def applyDelta(db: AsyncSession, user_id: int, delta: SummaryDelta):
+    if delta.isEmpty():
+        return
+    # 同じユーザーへの同時書き込みで集計が崩れないよう行ロックを取る
+    summary = await db.get(user_model.UserSummary, user_id, with_for_update=True)
+    if summary is None:
+        # 集計がまだないユーザーは、今回の書き込みを含めて再集計する
+        await db.flush()
+        await rebuildUserSummary(db, user_id)
+        return
+    summary.list_count += delta.list_count
+    summary.private_count += delta.private_count
+    summary.topic_count += delta.topic_count
+    histogram = Counter(summary.theme_histogram)
+    histogram.update(delta.themes)
+    # JSON列は再代入しないと変更が検知されない
+    summary.theme_histogram = {theme: count for theme, count in histogram.items() if count > 0}
+    summary.updated_at = datetime.datetime.now()
+
+# 新規ユーザーの集計を作成
+def createUserSummary(db: AsyncSession, user_id: int, delta: SummaryDelta):
+    db.add(user_model.UserSummary(
+        user_id=user_id,
+        list_count=delta.list_count,
+        private_count=delta.private_count,
+        topic_count=delta.topic_count,
+        theme_histogram={theme: count for theme, count in delta.themes.items() if count > 0},
+        updated_at=datetime.datetime.now()
+    ))
+
+# 集計用のクエリ（rebuild_summaryの一括再集計でも使う）
+def countsStatement():
+    return select(
+        mylist_model.MyList.user_id,
+        func.count(),
+        func.coalesce(func.sum(case((mylist_model.MyList.is_private == True, 1), else_=0)), 0),
+        func.coalesce(func.sum(mylist_model.MyList.topic_count), 0)
+    ).group_by(mylist_model.MyList.user_id)
+
+def themesStatement():
+    return select(
+        mylist_model.MyList.user_id,
+        mylist_model.MyList.theme_type,
+        func.count()
+    ).group_by(mylist_model.MyList.user_id, mylist_model.MyList.theme_type)
+
+# 1ユーザー分をDBのマイリストから再集計する
+# 先に集計の行をロックしてから数える（applyDeltaの書き込みがコミットされるまで待ち、その結果を含めて数える）
+async def rebuildUserSummary(db: AsyncSession, user_id: int) -> user_model.UserSummary:
+    summary = await db.get(user_model.UserSummary, user_id, with_for_update=True, populate_existing=True)
+    counts = (await db.execute(countsStatement().filter(mylist_model.MyList.user_id == user_id))).first()
+    themes = (await db.execute(themesStatement().filter(mylist_model.MyList.user_id == user_id))).all()
+    if summary is None:
+        summary = user_model.UserSummary(user_id=user_id)
+        db.add(summary)
+    _, summary.list_count, summary.private_count, summary.topic_count = counts if counts is not None else (user_id, 0, 0, 0)
+    summary.theme_histogram = {theme: count for _, theme, count in themes if theme is not None}
+    summary.updated_at = datetime.datetime.now()
+    return summary
+
+# ユーザーの集計を取得（主キーでの1回の検索）
+async def getUserSummary(db: AsyncSession, user_id: int) -> mylist_schema.userSummaryResponse:
+    summary = await db.get(user_model.UserSummary, user_id)
+    if summary is None:
+        # 集計機能の追加前に作成されたユーザーなど、集計がない場合のみ再集計する
+        await common.checkIfUserExist(db, user_id)
+        return toResponse(await rebuildUserSummary(db, user_id))
+    return toResponse(summary)
+
+def toResponse(summary: user_model.UserSummary) -> mylist_schema.userSummaryResponse:
+    return mylist_schema.userSummaryResponse(
+        user_id=summary.user_id,
+        list_count=summary.list_count,
+        public_count=summary.list_count - summary.private_count,
+        private_count=summary.private_count,
+        topic_count=summary.topic_count,
+        theme_histogram=summary.theme_histogram
+    )
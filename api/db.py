@@ -1,15 +1,372 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+import asyncio
+import functools
+import logging
+import math
+import random
+import time
+from enum import IntEnum
+from typing import Callable, Optional
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from sqlalchemy import event, exc, text
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 
-ASYNC_DB_URL = "mysql+aiomysql://root@db:3306/topickdb?charset=utf8mb4"
+from api.metrics import metrics
+from api.settings import Settings
 
-async_engine = create_async_engine(ASYNC_DB_URL, echo=True)
-async_session = sessionmaker(
-    autocommit=False, autoflush=False, bind=async_engine, class_=AsyncSession
-)
+logger = logging.getLogger('uvicorn')
 
 Base = declarative_base()
 
-async def get_db():
-    async with async_session() as session:
-        yield session
\ No newline at end of file
+class CircuitState(IntEnum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+class CircuitOpenError(Exception):
+    def __init__(self, retryAfter: float):
+        super().__init__("Database circuit is open")
+        self.retryAfter = retryAfter
+
+# DBの障害時に、接続やクエリのタイムアウトを待たずにすぐ失敗させるサーキットブレーカー
+# 接続の失敗・実行時のエラー・遅延（slowThreshold秒以上）が連続してfailureThreshold回に達したら開き、
+# resetTimeoutの間は接続もクエリも行わずにCircuitOpenError（503）で返す。
+# その後は半開状態で1件だけ試行し、成功したら閉じ、失敗したら再び開く。
+class CircuitBreaker:
+    def __init__(self, failureThreshold: int = 5, slowThreshold: float = 2.0, resetTimeout: float = 10.0):
+        self.failureThreshold = failureThreshold
+        self.slowThreshold = slowThreshold
+        self.resetTimeout = resetTimeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.openedAt = 0.0
+        # 半開状態で試行中のクエリの開始時刻
+        self._trialStartedAt: Optional[float] = None
+        metrics.gauge("db_circuit_state", lambda: self.state)
+
+    @classmethod
+    def fromSettings(cls, settings: Settings) -> "CircuitBreaker":
+        return cls(settings.db_circuit_failure_threshold, settings.db_circuit_slow_threshold, settings.db_circuit_reset_timeout)
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN:
+            if now - self.openedAt < self.resetTimeout:
+                return False
+            self._transition(CircuitState.HALF_OPEN)
+        # 結果が通知されないまま（キャンセルなど）resetTimeoutを過ぎた試行は諦めて、次の試行を通す
+        if self._trialStartedAt is not None and now - self._trialStartedAt < self.resetTimeout:
+            return False
+        self._trialStartedAt = now
+        return True
+
+    def check(self):
+        if not self.allow():
+            self._reject()
+
+    def _reject(self):
+        metrics.inc("db_circuit_rejected_total")
+        raise CircuitOpenError(max(0.0, self.openedAt + self.resetTimeout - time.monotonic()))
+
+    def recordSuccess(self, duration: float):
+        if duration >= self.slowThreshold:
+            self.recordFailure()
+            return
+        self.failures = 0
+        if self.state == CircuitState.HALF_OPEN:
+            self._trialStartedAt = None
+            self._transition(CircuitState.CLOSED)
+
+    def recordFailure(self):
+        self.failures += 1
+        if self.state == CircuitState.HALF_OPEN or self.failures >= self.failureThreshold:
+            self._trialStartedAt = None
+            self.openedAt = time.monotonic()
+            if self.state != CircuitState.OPEN:
+                self._transition(CircuitState.OPEN)
+
+    def _transition(self, state: CircuitState):
+        logger.warning("Database circuit %s -> %s", self.state.name, state.name)
+        metrics.inc("db_circuit_transitions_total", from_state=self.state.name, to_state=state.name)
+        self.state = state
+
+    # 新しい接続の作成とクエリの実行の前に確認し、結果を記録する
+    # 試行（半開状態の1件）は文の実行で判定する。接続の作成では試行の枠を使わない（NullPoolや切断後の再接続では、
+    # 試行するリクエストも接続から作成するため）。接続の失敗はhandle_errorで失敗として数える。
+    def attach(self, engine: Engine):
+        event.listen(engine, "do_connect", self._beforeConnect)
+        event.listen(engine, "before_cursor_execute", self._beforeExecute)
+        event.listen(engine, "after_cursor_execute", self._afterExecute)
+        event.listen(engine, "handle_error", self._onError)
+
+    def _beforeConnect(self, dialect, connection_record, cargs, cparams):
+        if self.state == CircuitState.OPEN and time.monotonic() - self.openedAt < self.resetTimeout:
+            self._reject()
+
+    def _beforeExecute(self, conn, cursor, statement, parameters, context, executemany):
+        self.check()
+        context._circuitStartedAt = time.monotonic()
+
+    def _afterExecute(self, conn, cursor, statement, parameters, context, executemany):
+        self.recordSuccess(time.monotonic() - context._circuitStartedAt)
+
+    # 接続できない・切断された・タイムアウトしたなど、DB側の障害だけを数える（制約違反やロックの競合などは数えない）
+    def _onError(self, context):
+        if isinstance(context.original_exception, CircuitOpenError) or retryReason(context.sqlalchemy_exception):
+            return
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, (exc.OperationalError, exc.InterfaceError)):
+            self.recordFailure()
+
+async def circuitOpenHandler(request: Request, error: CircuitOpenError) -> JSONResponse:
+    return JSONResponse(
+        status_code=503, content={"detail": "Database is unavailable"},
+        headers={"Retry-After": str(max(1, math.ceil(error.retryAfter)))}
+    )
+
+# 再実行すれば成功する可能性があるエラー（MySQLのエラー番号）
+RETRYABLE_MYSQL_ERRORS = {1213: "deadlock", 1205: "lock_wait_timeout"}
+# トランザクションを実行する回数の上限と、再実行までの待ち時間（秒）の基準値・上限
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.02
+RETRY_MAX_DELAY = 0.5
+
+# デッドロック・ロック待ちのタイムアウト（SQLiteでは"database is locked"）なら理由を返す。それ以外はNone
+def retryReason(error: Optional[BaseException]) -> Optional[str]:
+    if not isinstance(error, exc.DBAPIError) or error.connection_invalidated:
+        return None
+    orig = error.orig
+    if orig is not None and orig.args and orig.args[0] in RETRYABLE_MYSQL_ERRORS:
+        return RETRYABLE_MYSQL_ERRORS[orig.args[0]]
+    if "database is locked" in str(orig):
+        return "locked"
+    return None
+
+# 再実行の回数をトランザクションの実行回数の一定の割合までに抑える（DBの過負荷時に再実行で負荷を増やさない）
+# 実行ごとにratio、再実行ごとに1を消費し、maxTokensまで貯める。
+class RetryBudget:
+    def __init__(self, ratio: float = 0.1, maxTokens: float = 10.0):
+        self.ratio = ratio
+        self.maxTokens = maxTokens
+        self.tokens = maxTokens
+
+    def deposit(self):
+        self.tokens = min(self.maxTokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+retryBudget = RetryBudget()
+
+# 再実行までの待ち時間（上限を指数的に増やし、同時に失敗したトランザクションが揃って再実行しないよう0から上限までの乱数にする）
+def retryDelay(attempt: int) -> float:
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+# デッドロックやロック待ちのタイムアウトで失敗したトランザクションを、ロールバックしてから最初から実行し直すデコレーター
+# 引数のセッション（AsyncSession、LazySession）をロールバックする。トランザクションの途中からは再実行できないため、
+# トランザクション全体（コミットまで）を実行する関数に使う（UnitOfWorkRoute、purgeExpired、rebuild_summary参照）。
+def retryTransaction(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        retryBudget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return await function(*args, **kwargs)
+            except exc.DBAPIError as error:
+                reason = retryReason(error)
+                if reason is None:
+                    raise
+                attempt += 1
+                if attempt >= RETRY_ATTEMPTS or not retryBudget.withdraw():
+                    cause = "attempts" if attempt >= RETRY_ATTEMPTS else "budget"
+                    metrics.inc("db_retry_giveups_total", reason=reason, cause=cause)
+                    raise
+                metrics.inc("db_retries_total", reason=reason)
+                logger.warning("Retrying %s after %s (attempt %d)", function.__qualname__, reason, attempt)
+                for value in (*args, *kwargs.values()):
+                    if isinstance(value, (AsyncSession, LazySession)):
+                        await value.rollback()
+                await asyncio.sleep(retryDelay(attempt))
+    return wrapper
+
+# エンジンはアプリケーションの起動時に作成する（create_app参照）
+def createEngine(settings: Settings, circuitBreaker: Optional[CircuitBreaker] = None) -> AsyncEngine:
+    options = {}
+    if make_url(settings.db_url).get_backend_name() != "sqlite":
+        # SQLiteは接続プールを使わない（StaticPool/NullPool）
+        options = dict(
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=True,
+        )
+    engine = create_async_engine(settings.db_url, echo=settings.db_echo, **options)
+    event.listen(engine.sync_engine, "checkout", _onCheckout)
+    event.listen(engine.sync_engine, "checkin", _onCheckin)
+    if circuitBreaker is not None:
+        circuitBreaker.attach(engine.sync_engine)
+    return engine
+
+# 接続をプールから取り出してから戻すまでの時間を計測する
+def _onCheckout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info["checked_out_at"] = time.monotonic()
+
+def _onCheckin(dbapi_connection, connection_record):
+    checkedOutAt = connection_record.info.pop("checked_out_at", None)
+    if checkedOutAt is not None:
+        metrics.observe("db_connection_hold_seconds", time.monotonic() - checkedOutAt)
+
+# コミットは1リクエストにつき1回（UnitOfWorkRoute参照）。コミット後にオブジェクトを読み直さないよう失効させない
+# infoは作成するセッションのinfoの初期値（アプリケーションの状態など）
+def createSessionFactory(engine: AsyncEngine, info: Optional[dict] = None) -> sessionmaker:
+    return sessionmaker(
+        autocommit=False, autoflush=False, expire_on_commit=False, bind=engine, class_=AsyncSession, info=info or {}
+    )
+
+# 接続プールに接続を開いておく
+async def warmUp(engine: AsyncEngine, count: int):
+    async def connect():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            # 全ての接続が同時に開かれるまで返却しない
+            await asyncio.sleep(0)
+    await asyncio.gather(*(connect() for _ in range(count)))
+
+# 最初に使われるまでセッションを作成しないAsyncSessionの代理
+# 接続はクエリの実行時にプールから取り出し、complete()またはrelease()（UnitOfWorkRoute参照）で返す。
+# キャッシュの応答やバリデーションエラーなど、DBを使わずに返すリクエストではセッションも接続も使わない。
+class LazySession:
+    def __init__(self, factory: Callable[[], AsyncSession], info: dict):
+        self._factory = factory
+        self._info = info
+        self._session: Optional[AsyncSession] = None
+
+    @property
+    def opened(self) -> bool:
+        return self._session is not None
+
+    @property
+    def session(self) -> AsyncSession:
+        if self._session is None:
+            self._session = self._factory()
+            self._session.sync_session.info.update(self._info)
+            metrics.inc("db_sessions_opened_total")
+        return self._session
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def in_transaction(self) -> bool:
+        return self.opened and self._session.in_transaction()
+
+    # リクエストの処理が成功した場合に、書き込みがあれば一度だけコミットしてから接続を返す
+    # コミットを始めた後に処理時間の上限や切断でキャンセルされても、コミットとコミット後の処理（フィード・キャッシュの
+    # 無効化など）を途中で止めないよう、別のタスクで最後まで実行してからキャンセルを伝える。
+    async def complete(self):
+        if self._session is None:
+            return
+        task = asyncio.ensure_future(self._commitAndClose(self._session))
+        cancelled = False
+        while not task.done():
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                cancelled = True
+        if cancelled:
+            raise asyncio.CancelledError()
+        task.result()
+
+    async def _commitAndClose(self, session: AsyncSession):
+        if session.sync_session.info.get("has_writes") or session.new or session.dirty or session.deleted:
+            await session.commit()
+            metrics.inc("db_commits_total")
+        await session.close()
+
+    # 再実行の前にトランザクションを取り消す（retryTransaction参照）
+    async def rollback(self):
+        if self._session is not None:
+            await self._session.rollback()
+
+    # トランザクションを終了して接続をプールに返す（コミットしていない変更はロールバックされる）
+    async def release(self):
+        if self._session is not None:
+            await self._session.close()
+
+async def get_db(request: Request):
+    # ルートごとの処理時間の上限（DeadlineMiddleware参照）をステートメントタイムアウトにする
+    session = LazySession(
+        request.app.state.sessionFactory,
+        {"statement_timeout": getattr(request.state, "statement_timeout", None)}
+    )
+    try:
+        yield session
+    except asyncio.CancelledError:
+        await invalidate(session)
+        raise
+    finally:
+        await session.release()
+
+# リクエスト単位のトランザクション（Unit of Work）
+# cruds はコミットせず、必要な場合（採番されたIDを使う場合など）だけフラッシュする。エンドポイントの処理が成功したら
+# ここで一度だけコミットし、レスポンスのシリアライズと送信を待たずにDBの接続を返す。
+# 例外の場合はコミットせず、get_dbでロールバックする（キャンセル時の接続の破棄もget_dbで行う）。
+# 書き込みのルートは、デッドロックなどで失敗した場合にエンドポイントの処理からコミットまでを再実行する。
+class UnitOfWorkRoute(APIRoute):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        call = self.dependant.call
+        if not asyncio.iscoroutinefunction(call):
+            return
+
+        async def callAndComplete(**values):
+            result = await call(**values)
+            for value in values.values():
+                if isinstance(value, LazySession):
+                    await value.complete()
+            return result
+        self.dependant.call = callAndComplete if self.methods <= {"GET", "HEAD"} else retryTransaction(callAndComplete)
+
+# 書き込み（フラッシュ、またはSELECT以外の文の実行）があったトランザクションだけをコミットする
+@event.listens_for(Session, "after_flush")
+def _markFlushed(session: Session, flush_context):
+    session.info["has_writes"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _markWrite(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["has_writes"] = True
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _clearWrites(session: Session):
+    session.info.pop("has_writes", None)
+
+# キャンセルされたクエリの結果が接続に残っている可能性があるため、プールに戻さずに破棄する
+async def invalidate(session: AsyncSession):
+    if session.in_transaction():
+        connection = await session.connection()
+        await connection.invalidate()
+        metrics.inc("db_connections_invalidated_total")
+
+# トランザクションの開始時に、接続のステートメントタイムアウトを設定する（値が変わった場合のみ）
+# MAX_EXECUTION_TIMEはSELECTのみが対象のため、更新はロック待ちの時間で制限する。
+@event.listens_for(Session, "after_begin")
+def _applyStatementTimeout(session: Session, transaction, connection):
+    timeout = session.info.get("statement_timeout")
+    if timeout is None or connection.dialect.name != "mysql":
+        return
+    info = connection.connection.info
+    if info.get("statement_timeout") == timeout:
+        return
+    connection.exec_driver_sql(
+        "SET SESSION max_execution_time = %d, innodb_lock_wait_timeout = %d" % (timeout * 1000, max(1, math.ceil(timeout)))
+    )
+    info["statement_timeout"] = timeout
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+
+from starlette.responses import JSONResponse
+
+from api.admission import EXEMPT_PREFIXES, RequestClass, classify
+from api.metrics import metrics
+
+logger = logging.getLogger('uvicorn')
+
+# リクエストの種類ごとの処理時間の上限（秒）（DBのステートメントタイムアウトにも使う）
+ROUTE_TIMEOUTS = {
+    RequestClass.READ: 5.0,
+    RequestClass.WRITE: 10.0,
+    RequestClass.HEAVY: 30.0,
+}
+
+# 処理時間の上限を超えた場合や、クライアントが切断した場合に処理中のリクエストをキャンセルするASGIミドルウェア
+# キャンセルされたリクエストのDB接続はget_dbで破棄する（実行中のクエリの結果が残っている可能性があるため）。
+class DeadlineMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        timeout = ROUTE_TIMEOUTS[classify(scope["method"], scope["path"])]
+        scope.setdefault("state", {})["statement_timeout"] = timeout
+
+        messages: "asyncio.Queue[dict]" = asyncio.Queue()
+        responseStarted = False
+        responseCompleted = False
+
+        async def receiveFromQueue():
+            return await messages.get()
+
+        async def sendAndTrack(message):
+            nonlocal responseStarted, responseCompleted
+            if message["type"] == "http.response.start":
+                responseStarted = True
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                responseCompleted = True
+            await send(message)
+
+        # ボディを最後まで先読みしてアプリケーションに渡し、その後は切断だけを待つ
+        # 切断以外のメッセージが返された場合は、それ以上監視しない（受信を繰り返してループを占有しない）。
+        async def pump():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] != "http.request":
+                    return message["type"] == "http.disconnect"
+                if not message.get("more_body", False):
+                    break
+            message = await receive()
+            messages.put_nowait(message)
+            return message["type"] == "http.disconnect"
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        appTask = asyncio.create_task(self.app(scope, receiveFromQueue, sendAndTrack))
+        pumpTask = asyncio.create_task(pump())
+        try:
+            reason = None
+            while reason is None:
+                waiting = {appTask} if pumpTask.done() else {appTask, pumpTask}
+                done, _ = await asyncio.wait(waiting, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED)
+                if appTask in done:
+                    appTask.result()
+                    return
+                if not done:
+                    reason = "timeout"
+                elif not pumpTask.cancelled() and pumpTask.exception() is None and pumpTask.result() and not responseCompleted:
+                    # レスポンスを返し終えた後の切断（後処理中）はキャンセルしない
+                    reason = "disconnect"
+            metrics.inc("request_cancelled_total", reason=reason)
+            logger.warning("Cancelling %s %s on %s", scope["method"], scope["path"], reason)
+            appTask.cancel()
+            await asyncio.gather(appTask, return_exceptions=True)
+            if reason == "timeout" and not responseStarted:
+                response = JSONResponse(status_code=504, content={"detail": "Request timed out"})
+                await response(scope, receive, send)
+        finally:
+            pumpTask.cancel()
+            if not appTask.done():
+                appTask.cancel()
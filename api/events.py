@@ -0,0 +1,110 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, Set
+from fastapi import HTTPException, Request
+
+from api.transport import LocalTransport
+
+# マイリストの変更通知を配信するチャンネル名
+CHANNEL = "mylist"
+# 購読者ごとのキューの上限（超えた場合は古い通知を捨てて再同期を促す）
+QUEUE_SIZE = 100
+# ユーザーごとの同時接続数の上限
+MAX_SUBSCRIBERS_PER_USER = 5
+# 接続維持のためのコメントを送る間隔（秒）
+KEEPALIVE_INTERVAL = 15.0
+# 通知がないまま接続を維持する時間の上限（秒）
+IDLE_TIMEOUT = 300.0
+# 1接続の最大継続時間（秒）。クライアントは再接続して差分同期する
+MAX_CONNECTION_TIME = 3600.0
+
+# 購読者（SSEの1接続）
+class Subscription:
+    def __init__(self, user_id: int, maxsize: int):
+        self.user_id = user_id
+        self.queue: "asyncio.Queue[dict]" = asyncio.Queue(maxsize)
+        self.closed = False
+
+    def push(self, event: dict):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 受信が追いつかない購読者の通知は破棄し、差分同期APIでの再同期を促す
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({"type": "resync", "user_id": self.user_id})
+
+    # 未送信の通知を破棄して接続を終了させる（クライアントは再接続して差分同期する）
+    def close(self):
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait({"type": "shutdown", "user_id": self.user_id})
+
+# ユーザーごとの変更通知のpub/sub
+class EventHub:
+    def __init__(self, transport: LocalTransport, queue_size: int = QUEUE_SIZE, max_subscribers: int = MAX_SUBSCRIBERS_PER_USER):
+        self.transport = transport
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self.closed = False
+        transport.subscribe(CHANNEL, self._dispatch)
+
+    def publish(self, user_id: int, event: dict):
+        self.transport.publish(CHANNEL, {**event, "user_id": user_id})
+
+    def subscribe(self, user_id: int) -> Subscription:
+        if self.closed:
+            raise HTTPException(status_code=503, detail="Server is shutting down")
+        subscribers = self._subscribers.setdefault(user_id, set())
+        if len(subscribers) >= self.max_subscribers:
+            raise HTTPException(status_code=429, detail=f"Too many event streams for User with id {user_id}")
+        subscription = Subscription(user_id, self.queue_size)
+        subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscription)
+        if len(subscribers) == 0:
+            del self._subscribers[subscription.user_id]
+
+    # ワーカーの停止時に全ての接続を終了させる（SSEの接続が停止を妨げないようにする）
+    def close(self):
+        self.closed = True
+        for subscribers in list(self._subscribers.values()):
+            for subscription in list(subscribers):
+                subscription.close()
+
+    def _dispatch(self, message: dict):
+        for subscription in list(self._subscribers.get(message.get("user_id"), ())):
+            subscription.push(message)
+
+# SSE形式で通知を送り続ける。切断・アイドル・最大継続時間のいずれかで終了する
+async def streamEvents(request: Request, hub: EventHub, subscription: Subscription) -> AsyncIterator[str]:
+    startedAt = lastEventAt = time.monotonic()
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                now = time.monotonic()
+                if await request.is_disconnected() or now - lastEventAt > IDLE_TIMEOUT or now - startedAt > MAX_CONNECTION_TIME:
+                    return
+                yield ": keepalive\n\n"
+                continue
+            if event["type"] == "shutdown":
+                return
+            lastEventAt = time.monotonic()
+            yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            if lastEventAt - startedAt > MAX_CONNECTION_TIME:
+                return
+    finally:
+        hub.unsubscribe(subscription)
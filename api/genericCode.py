@@ -4,4 +4,9 @@ class UpdateTargetType(Enum):
     TITLE = 1
     THEME = 2
     TOPIC = 3
-    PRIVATE_FLAG = 4
\ No newline at end of file
+    PRIVATE_FLAG = 4
+
+class BatchOperationType(str, Enum):
+    CREATE = "create"
+    UPDATE = "update"
+    DELETE = "delete"
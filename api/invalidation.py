@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import uuid
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+
+from api.cruds.feed import PublicFeed
+from api.metrics import metrics
+from api.responsecache import ResponseCache
+from api.transport import LocalTransport
+
+logger = logging.getLogger('uvicorn')
+
+# キャッシュの無効化と公開フィードの更新を全ワーカーに配信するチャンネル名
+CHANNEL = "invalidate"
+# 最後に送った番号を知らせる間隔（秒）（無効化が途切れても、取りこぼしを検知できるようにする）
+HEARTBEAT_INTERVAL = 1.0
+# 番号を記録する送信元のワーカー数の上限（再起動で入れ替わったワーカーの記録は古いものから削除する）
+MAX_ORIGINS = 1000
+
+# ワーカー間のキャッシュの無効化と公開フィードの更新（変更通知と同じトランスポートを使う。外部のブローカーは不要）
+# 送信元のワーカーごとに連番を付けて送り、受信側は番号が飛んだ場合（送信の破棄・受信バッファの溢れなど）に
+# どのタグ・フィードの更新を取りこぼしたか分からないため、キャッシュ全体を破棄し、フィードは次回取得時にDBから再構築する。
+class InvalidationBus:
+    def __init__(self, transport: LocalTransport, cache: ResponseCache, feed: Optional[PublicFeed] = None):
+        self.transport = transport
+        self.cache = cache
+        self.feed = feed
+        self.origin: Optional[str] = None
+        self.seq = 0
+        self._lastSeqs: "OrderedDict[str, int]" = OrderedDict()
+        self._heartbeat: Optional[asyncio.Task] = None
+        transport.subscribe(CHANNEL, self._apply)
+
+    # fork前に作成したインスタンスでもワーカーごとに別の送信元になるよう、起動時に決める
+    async def start(self):
+        if self._heartbeat is not None:
+            return
+        self.origin = uuid.uuid4().hex
+        self.seq = 0
+        self._heartbeat = asyncio.create_task(self._sendHeartbeats())
+
+    async def stop(self):
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            await asyncio.gather(self._heartbeat, return_exceptions=True)
+            self._heartbeat = None
+
+    # 自分のワーカーのキャッシュ・フィードには同期的に反映される（feedはPublicFeed.applyのイベント）
+    def invalidate(self, tags: Iterable[str], feed: Optional[List[dict]] = None):
+        self.seq += 1
+        message = {"origin": self.origin, "seq": self.seq, "tags": list(tags)}
+        if feed:
+            message["feed"] = feed
+        self.transport.publish(CHANNEL, message)
+
+    async def _sendHeartbeats(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if self.seq:
+                self.transport.publish(CHANNEL, {"origin": self.origin, "seq": self.seq, "heartbeat": True})
+
+    def _apply(self, message: dict):
+        origin, seq = message["origin"], message["seq"]
+        tags = message.get("tags", [])
+        if origin != self.origin:
+            self._checkSeq(origin, seq, message.get("heartbeat", False))
+        for tag in tags:
+            self.cache.invalidate(tag)
+        if tags:
+            metrics.inc("cache_invalidations_total", value=len(tags))
+        if self.feed is not None:
+            for event in message.get("feed", []):
+                self.feed.apply(event)
+
+    def _checkSeq(self, origin: str, seq: int, heartbeat: bool):
+        # 無効化は前回の次の番号、ハートビートは前回と同じ番号のはず
+        # 初めての送信元は前回を0とする（起動前の無効化を受け取っていない場合も取りこぼしとして扱う）。
+        lastSeq = self._lastSeqs.pop(origin, 0)
+        expected = lastSeq if heartbeat else lastSeq + 1
+        if seq > expected:
+            logger.warning("Missed cache invalidations from %s (%s -> %s), clearing the cache and the public feed", origin, lastSeq, seq)
+            metrics.inc("cache_invalidation_gaps_total")
+            self.cache.clear()
+            if self.feed is not None:
+                self.feed.reset()
+        self._lastSeqs[origin] = max(seq, lastSeq)
+        while len(self._lastSeqs) > MAX_ORIGINS:
+            self._lastSeqs.popitem(last=False)
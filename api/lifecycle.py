@@ -0,0 +1,39 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger('uvicorn')
+
+# 停止時に処理中のリクエストの完了を確認する間隔（秒）
+DRAIN_POLL_INTERVAL = 0.05
+
+# 処理中のリクエスト数
+class InFlight:
+    def __init__(self):
+        self.count = 0
+
+    # 処理中のリクエストが無くなるまで待つ（タイムアウトした場合はFalse）
+    async def drain(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.count != 0:
+            if time.monotonic() >= deadline:
+                logger.error("%s requests were still in flight after %s seconds", self.count, timeout)
+                return False
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        return True
+
+# 処理中のリクエスト数を数えるASGIミドルウェア
+class InFlightMiddleware:
+    def __init__(self, app, inFlight: InFlight):
+        self.app = app
+        self.inFlight = inFlight
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        self.inFlight.count += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.inFlight.count -= 1
@@ -0,0 +1,104 @@
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Tuple
+
+from api.metrics import metrics
+
+# キューに溜められるログの件数の上限（超えた分は破棄する）
+QUEUE_SIZE = 10000
+# 同じメッセージ（テンプレート）のエラーを出力できる件数（INTERVAL秒あたり）
+RATE_LIMIT_BURST = 5
+RATE_LIMIT_INTERVAL = 10.0
+# レート制限のために保持するテンプレート数の上限
+RATE_LIMIT_KEYS = 1000
+# キュー経由にするロガー（cruds・routersは'uvicorn'ロガーを使う）
+LOGGER_NAMES = ("uvicorn", "uvicorn.access")
+
+# メッセージのテンプレートごとにエラーの出力件数を制限し、抑制した件数を次に出力するログに付記する
+# テンプレートで識別するため、ログは logger.error("... %s", value) の形式で出力すること。
+class RateLimitFilter(logging.Filter):
+    def __init__(self, burst: int = RATE_LIMIT_BURST, interval: float = RATE_LIMIT_INTERVAL, level: int = logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.level = level
+        self._lock = threading.Lock()
+        # テンプレート -> (期間の開始時刻, 期間内の出力件数, 抑制した件数)
+        self._windows: "OrderedDict[Tuple[str, int, str], Tuple[float, int, int]]" = OrderedDict()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < self.level:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            startedAt, emitted, suppressed = self._windows.pop(key, (now, 0, 0))
+            if now - startedAt >= self.interval:
+                startedAt, emitted = now, 0
+            if emitted >= self.burst:
+                self._windows[key] = (startedAt, emitted, suppressed + 1)
+                metrics.inc("log_records_suppressed_total", level=record.levelname)
+                return False
+            self._windows[key] = (startedAt, emitted + 1, 0)
+            while len(self._windows) > RATE_LIMIT_KEYS:
+                self._windows.popitem(last=False)
+        if suppressed != 0:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar messages)"
+        return True
+
+# キューが一杯の場合はログを破棄する（イベントループを止めない）
+class NonBlockingQueueHandler(QueueHandler):
+    # 同一プロセス内のキューなので整形はリスナー側のハンドラーに任せる（uvicornのアクセスログのフォーマッターはargsを参照する）
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc("log_records_dropped_total", level=record.levelname)
+
+# ロガーの出力をキューに積み、実際の書き込みはリスナーのスレッドで行う
+class QueueLogging:
+    def __init__(self, loggerNames: Tuple[str, ...] = LOGGER_NAMES, queueSize: int = QUEUE_SIZE):
+        self.loggerNames = loggerNames
+        self.queueSize = queueSize
+        self._listeners: List[QueueListener] = []
+        # ロガー名 -> 差し替える前のハンドラー
+        self._handlers: Dict[str, List[logging.Handler]] = {}
+
+    @property
+    def running(self) -> bool:
+        return len(self._listeners) != 0
+
+    # uvicornがロガーを設定した後（startup）に呼び出す
+    def start(self):
+        if self.running:
+            return
+        for name in self.loggerNames:
+            logger = logging.getLogger(name)
+            handlers = list(logger.handlers)
+            if len(handlers) == 0:
+                continue
+            logQueue = queue.Queue(self.queueSize)
+            queueHandler = NonBlockingQueueHandler(logQueue)
+            queueHandler.addFilter(RateLimitFilter())
+            listener = QueueListener(logQueue, *handlers, respect_handler_level=True)
+            self._handlers[name] = handlers
+            logger.handlers = [queueHandler]
+            listener.start()
+            self._listeners.append(listener)
+        metrics.gauge("log_queue_depth", lambda: sum(listener.queue.qsize() for listener in self._listeners))
+
+    # キューに残ったログを書き出してから元のハンドラーに戻す
+    def stop(self):
+        for listener in self._listeners:
+            listener.stop()
+        for name, handlers in self._handlers.items():
+            logging.getLogger(name).handlers = handlers
+        self._listeners = []
+        self._handlers = {}
@@ -1,6 +1,53 @@
+from typing import Optional
 from fastapi import FastAPI
-from api.routers import auth, mylist
+from api.routers import auth, metrics, mylist
+from api.admission import AdmissionController, AdmissionMiddleware
+from api.deadline import DeadlineMiddleware
+from api.db import CircuitBreaker, CircuitOpenError, circuitOpenHandler, createEngine, createSessionFactory, warmUp
+from api.context import AppContext
+from api.lifecycle import InFlight, InFlightMiddleware
+from api.ratelimit import RateLimitMiddleware, createBackend
+from api.responsecache import ResponseCacheMiddleware
+from api.settings import Settings
 
-app = FastAPI()
-app.include_router(mylist.router)
-app.include_router(auth.router)
+# アプリケーションを作成する（DBのエンジンは起動時に作成し、停止時に破棄する）
+def create_app(settings: Optional[Settings] = None) -> FastAPI:
+    settings = settings or Settings()
+    app = FastAPI()
+    app.state.settings = settings
+    app.state.context = AppContext(settings)
+    app.state.inFlight = InFlight()
+    app.state.admission = AdmissionController.fromSettings(settings)
+    app.state.circuitBreaker = CircuitBreaker.fromSettings(settings)
+    app.add_exception_handler(CircuitOpenError, circuitOpenHandler)
+    app.add_middleware(AdmissionMiddleware, controller=app.state.admission, retryAfter=settings.admission_retry_after)
+    app.add_middleware(DeadlineMiddleware)
+    if settings.response_cache_enabled:
+        # キャッシュから返すリクエストは同時処理数（DBの接続）に数えない
+        app.add_middleware(ResponseCacheMiddleware, cache=app.state.context.responseCache)
+    if settings.rate_limit_enabled:
+        app.add_middleware(RateLimitMiddleware, backend=createBackend(settings))
+    app.add_middleware(InFlightMiddleware, inFlight=app.state.inFlight)
+    app.include_router(mylist.router)
+    app.include_router(auth.router)
+    app.include_router(metrics.router)
+
+    @app.on_event("startup")
+    async def startup():
+        app.state.context.queueLogging.start()
+        app.state.engine = createEngine(settings, app.state.circuitBreaker)
+        app.state.sessionFactory = createSessionFactory(app.state.engine, {"context": app.state.context})
+        await warmUp(app.state.engine, settings.db_warmup_connections)
+        await app.state.context.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        # 処理中のリクエストとバックグラウンド処理が終わってから接続を閉じる
+        await app.state.inFlight.drain(settings.shutdown_drain_timeout)
+        await app.state.context.stop()
+        await app.state.engine.dispose()
+        app.state.context.queueLogging.stop()
+
+    return app
+
+app = create_app()
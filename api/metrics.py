@@ -0,0 +1,77 @@
+import threading
+from typing import Callable, Dict, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# プロセス内のメトリクス（Prometheusのテキスト形式で/metricsから公開する）
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._gaugeFunctions: Dict[Tuple[str, Labels], Callable[[], float]] = {}
+        self._summaries: Dict[Tuple[str, Labels], Tuple[int, float, float]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, toLabels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, toLabels(labels))] = value
+
+    # 値を取得時に計算するゲージ（キューの長さなど）
+    def gauge(self, name: str, function: Callable[[], float], **labels):
+        with self._lock:
+            self._gaugeFunctions[(name, toLabels(labels))] = function
+
+    # 件数・合計・最大値を記録する（レイテンシなど）
+    def observe(self, name: str, value: float, **labels):
+        key = (name, toLabels(labels))
+        with self._lock:
+            count, total, maximum = self._summaries.get(key, (0, 0.0, 0.0))
+            self._summaries[key] = (count + 1, total + value, max(maximum, value))
+
+    def value(self, name: str, **labels) -> float:
+        key = (name, toLabels(labels))
+        with self._lock:
+            if key in self._gaugeFunctions:
+                return self._gaugeFunctions[key]()
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def summary(self, name: str, **labels) -> Tuple[int, float, float]:
+        with self._lock:
+            return self._summaries.get((name, toLabels(labels)), (0, 0.0, 0.0))
+
+    def render(self) -> str:
+        with self._lock:
+            lines = []
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}{formatLabels(labels)} {value}")
+            gauges = dict(self._gauges)
+            for key, function in self._gaugeFunctions.items():
+                gauges[key] = function()
+            for (name, labels), value in sorted(gauges.items()):
+                lines.append(f"{name}{formatLabels(labels)} {value}")
+            for (name, labels), (count, total, maximum) in sorted(self._summaries.items()):
+                lines.append(f"{name}_count{formatLabels(labels)} {count}")
+                lines.append(f"{name}_sum{formatLabels(labels)} {total}")
+                lines.append(f"{name}_max{formatLabels(labels)} {maximum}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._summaries.clear()
+
+def toLabels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def formatLabels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+metrics = Metrics()
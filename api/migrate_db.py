@@ -1,18 +1,29 @@
-from sqlalchemy import create_engine
+import asyncio
+from api.db import createEngine
 from api.models.user import Base as Base4User
 from api.models.mylist import Base as Base4Mylist
 from api.models.auth import Base as Base4Auth
+from api.models.pick import Base as Base4Pick
+from api.models.idempotency import Base as Base4Idempotency
+from api.settings import Settings
 
-DB_URL = "mysql+pymysql://root@db:3306/topickdb?charset=utf8mb4"
-engine = create_engine(DB_URL, echo=True)
-
-def reset_database():
-    Base4User.metadata.drop_all(bind=engine)
-    Base4Mylist.metadata.drop_all(bind=engine)
-    Base4Auth.metadata.drop_all(bind=engine)
-    Base4User.metadata.create_all(bind=engine)
-    Base4Mylist.metadata.create_all(bind=engine)
-    Base4Auth.metadata.create_all(bind=engine)
+# 接続先はアプリケーションと同じ設定（TOPICK_DB_URL）を使う
+async def reset_database():
+    engine = createEngine(Settings(db_echo=True))
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(Base4Pick.metadata.drop_all)
+            await conn.run_sync(Base4Idempotency.metadata.drop_all)
+            await conn.run_sync(Base4User.metadata.drop_all)
+            await conn.run_sync(Base4Mylist.metadata.drop_all)
+            await conn.run_sync(Base4Auth.metadata.drop_all)
+            await conn.run_sync(Base4User.metadata.create_all)
+            await conn.run_sync(Base4Mylist.metadata.create_all)
+            await conn.run_sync(Base4Auth.metadata.create_all)
+            await conn.run_sync(Base4Pick.metadata.create_all)
+            await conn.run_sync(Base4Idempotency.metadata.create_all)
+    finally:
+        await engine.dispose()
 
 if __name__ == "__main__":
-    reset_database()
\ No newline at end of file
+    asyncio.run(reset_database())
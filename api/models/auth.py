@@ -1,5 +1,4 @@
 import datetime
-from xmlrpc.client import Boolean
 from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime
 from api.db import Base
 
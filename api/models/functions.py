@@ -0,0 +1,13 @@
+from sqlalchemy import Integer
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import GenericFunction
+
+# JSON配列の要素数を返す関数
+# SQLite(テスト)ではjson_array_length、MySQLではJSON_LENGTHに変換する。
+class json_array_length(GenericFunction):
+    type = Integer()
+    inherit_cache = True
+
+@compiles(json_array_length, "mysql")
+def _compileJsonArrayLengthForMysql(element, compiler, **kw):
+    return "JSON_LENGTH(%s)" % compiler.process(element.clauses, **kw)
@@ -0,0 +1,12 @@
+from sqlalchemy import Column, String, JSON, DateTime
+from api.db import Base
+
+# Idempotency-Keyごとのレスポンスの記録（responseがNULLの間は処理中）
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_key"
+    endpoint = Column(String(32), primary_key=True)
+    idempotency_key = Column(String(64), primary_key=True)
+    # リクエストボディのハッシュ（同じキーで内容の異なるリクエストを区別する）
+    request_hash = Column(String(64), nullable=False)
+    response = Column(JSON())
+    created_at = Column(DateTime, nullable=False)
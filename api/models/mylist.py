@@ -1,6 +1,7 @@
 import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, JSON, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, JSON, DateTime, Index, Computed, literal_column
 from api.db import Base
+from api.models.functions import json_array_length
 
 class MyList(Base):
     __tablename__ = "my_list"
@@ -10,11 +11,29 @@ class MyList(Base):
     theme_type = Column(String(3))
     # topic = Column(String(8500))
     topic = Column(JSON())
+    # トピック数（topicから自動計算される生成列。並び替え・絞り込みでJSONを解析しないために持つ）
+    topic_count = Column(Integer, Computed(json_array_length(topic, literal_column("'$.topic'")), persisted=True))
     is_private = Column(Boolean, default=False)
     created_at = Column(DateTime, nullable=False)
     updated_at = Column(DateTime, onupdate=datetime.datetime.now, nullable=False)
 
+    __table_args__ = (
+        # 公開マイリストのフィード再構築用（is_private = False を updated_at の降順で取得）
+        Index("ix_my_list_is_private_updated_at", "is_private", "updated_at"),
+        # ユーザーごとの差分同期用（user_id で絞り込み、updated_at がカーソル以降のものを取得）
+        Index("ix_my_list_user_id_updated_at", "user_id", "updated_at"),
+        # ユーザーごとのトピック数での並び替え・絞り込み用
+        Index("ix_my_list_user_id_topic_count", "user_id", "topic_count"),
+    )
 
-    
+# 削除されたマイリストの記録（マイリストは物理削除のため、差分同期で削除を通知するために残す）
+class MyListDeletion(Base):
+    __tablename__ = "my_list_deletion"
+    deletion_id = Column(Integer, primary_key=True, autoincrement=True, unique=True)
+    user_id = Column(Integer, ForeignKey('m_user.user_id'), nullable=False)
+    my_list_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False)
 
-    
\ No newline at end of file
+    __table_args__ = (
+        Index("ix_my_list_deletion_user_id_deleted_at", "user_id", "deleted_at"),
+    )
@@ -0,0 +1,12 @@
+import datetime
+from sqlalchemy import Column, Integer, ForeignKey, JSON, DateTime
+from api.db import Base
+
+# 重複なし抽選の状態（シャッフル済みのトピックのインデックス順と、次に引く位置）
+class PickState(Base):
+    __tablename__ = "pick_state"
+    my_list_id = Column(Integer, ForeignKey('my_list.my_list_id', ondelete="CASCADE"), primary_key=True)
+    permutation = Column(JSON(), nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, onupdate=datetime.datetime.now, nullable=False)
@@ -1,11 +1,23 @@
 import datetime
-from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON
 from api.db import Base
 
 
 class User(Base):
     __tablename__ = "m_user"
     user_id = Column(Integer, primary_key=True, autoincrement=True, unique=True)
+    # 作成時に端末へ発行したトークンのハッシュ（マイリスト移行時に移行元の端末であることを確認する）
+    device_token_hash = Column(String(64))
     created_at = Column(DateTime, nullable=False)
     updated_at = Column(DateTime, onupdate=datetime.datetime.now, nullable=False)
-    
\ No newline at end of file
+    
+
+# ユーザーごとのマイリストの集計（書き込みのたびに差分で更新し、ずれはrebuild_summaryで再集計する）
+class UserSummary(Base):
+    __tablename__ = "user_summary"
+    user_id = Column(Integer, ForeignKey('m_user.user_id'), primary_key=True)
+    list_count = Column(Integer, nullable=False, default=0)
+    private_count = Column(Integer, nullable=False, default=0)
+    topic_count = Column(Integer, nullable=False, default=0)
+    theme_histogram = Column(JSON(), nullable=False)
+    updated_at = Column(DateTime, nullable=False)
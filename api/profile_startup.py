@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+# 起動時間の上限（秒）（テストで超えていないことを確認する）
+IMPORT_BUDGET = 2.0
+FIRST_REQUEST_BUDGET = 3.0
+# 計測用のDB（MySQLに接続しない）
+PROFILE_DB_URL = "sqlite+aiosqlite:///:memory:"
+FIRST_REQUEST_PATH = "/mylist/feed/public"
+
+# python -X importtime の出力からモジュールごとの読み込み時間（マイクロ秒）を取得
+def importTimes() -> List[Tuple[str, int, int]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import api.main"],
+        capture_output=True, text=True, check=True
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        selfTime, cumulative, name = line[len("import time:"):].split("|")
+        times.append((name.strip(), int(selfTime), int(cumulative)))
+    return times
+
+# トップレベルのパッケージごとに合計する
+def byPackage(times: List[Tuple[str, int, int]]) -> Dict[str, int]:
+    packages: Dict[str, int] = {}
+    for name, selfTime, _ in times:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + selfTime
+    return packages
+
+# ASGIアプリケーションにリクエストを1件送り、ステータスコードを返す
+async def request(app, path: str) -> int:
+    messages = []
+    requested = False
+    completed = asyncio.Event()
+
+    # ボディを渡した後は、レスポンスを返し終えるまで待ってから切断を返す
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await completed.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.body" and not message.get("more_body", False):
+            completed.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "headers": [(b"host", b"profile")], "client": ("127.0.0.1", 0), "server": ("profile", 80),
+    }
+    await app(scope, receive, send)
+    return messages[0]["status"]
+
+# 新しいプロセスで、インポートから最初のリクエストまでの各段階の時間（秒）を計測する
+def phases() -> Dict[str, float]:
+    startedAt = time.perf_counter()
+    from api.main import create_app
+    from api.db import Base
+    from api.settings import Settings
+    imported = time.perf_counter()
+    app = create_app(Settings(db_url=PROFILE_DB_URL, db_warmup_connections=1))
+    created = time.perf_counter()
+
+    async def serve():
+        await app.router.startup()
+        started = time.perf_counter()
+        async with app.state.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        # テーブル作成の時間は除く
+        tablesCreated = time.perf_counter()
+        status = await request(app, FIRST_REQUEST_PATH)
+        responded = time.perf_counter()
+        await app.router.shutdown()
+        return started, responded - tablesCreated, status
+
+    started, firstRequest, status = asyncio.run(serve())
+    if status != 200:
+        raise RuntimeError(f"First request to {FIRST_REQUEST_PATH} returned {status}")
+    return {
+        "import": imported - startedAt,
+        "create_app": created - imported,
+        "startup": started - created,
+        "first_request": firstRequest,
+        "time_to_first_request": started - startedAt + firstRequest,
+    }
+
+def profile(top: int) -> dict:
+    result = subprocess.run([sys.executable, "-m", "api.profile_startup", "--phases"], capture_output=True, text=True, check=True)
+    times = importTimes()
+    return {
+        "phases": json.loads(result.stdout),
+        "modules": [
+            {"module": name, "self_us": selfTime, "cumulative_us": cumulative}
+            for name, selfTime, cumulative in sorted(times, key=lambda t: t[2], reverse=True)[:top]
+        ],
+        "packages": dict(sorted(byPackage(times).items(), key=lambda p: p[1], reverse=True)[:top]),
+    }
+
+def printReport(report: dict):
+    print("Startup phases (s)")
+    for name, seconds in report["phases"].items():
+        print(f"  {name:<24}{seconds:>8.3f}")
+    print("\nSlowest imports (cumulative ms / self ms)")
+    for module in report["modules"]:
+        print(f"  {module['cumulative_us'] / 1000:>8.1f} {module['self_us'] / 1000:>8.1f}  {module['module']}")
+    print("\nImport time by package (self ms)")
+    for package, selfTime in report["packages"].items():
+        print(f"  {selfTime / 1000:>8.1f}  {package}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="起動時間の計測（モジュールごとの読み込み時間と最初のリクエストまでの時間）")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--phases", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.phases:
+        print(json.dumps(phases()))
+        return
+    report = profile(args.top)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        printReport(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from starlette.responses import JSONResponse
+
+from api.metrics import metrics
+from api.settings import Settings
+
+logger = logging.getLogger('uvicorn')
+
+# メモリに保持するキー数の上限（超えた場合は最も古いキーから削除する）
+MAX_KEYS = 100000
+# 制限が解除されたキーを削除する間隔（秒）
+SWEEP_INTERVAL = 60.0
+# キーの値を取得するために読み込むリクエストボディの上限（バイト）
+MAX_BODY_SIZE = 64 * 1024
+
+# 制限の単位（対象のリクエストと、キーにする値）
+class Rule:
+    def __init__(self, name: str, methods: Set[str], path: str, rate: float, burst: int, key: str, failOpen: bool = True):
+        self.name = name
+        self.methods = methods
+        # 末尾が"/"の場合は前方一致、それ以外は完全一致
+        self.path = path
+        # 1秒あたりのリクエスト数と、連続して受け付ける数
+        self.rate = rate
+        self.burst = burst
+        # "ip"、またはリクエストボディの項目名（"user_id"、"auth_id"）。ボディに無い場合はIPアドレス
+        self.key = key
+        # 共有のストアが使えない場合に受け付けるか（総当たり対策の制限は受け付けない）
+        self.failOpen = failOpen
+
+    def matches(self, method: str, path: str) -> bool:
+        if method not in self.methods:
+            return False
+        return path.startswith(self.path) if self.path.endswith("/") else path == self.path
+
+RULES = [
+    # 認証コードの総当たりを防ぐ（認証と移行で同じ認証IDの試行回数を共有する）
+    Rule("auth_id", {"POST"}, "/auth/authenticate", rate=5 / 60, burst=5, key="auth_id", failOpen=False),
+    Rule("auth_id", {"POST"}, "/auth/migrate", rate=5 / 60, burst=5, key="auth_id", failOpen=False),
+    Rule("auth_ip", {"POST"}, "/auth/", rate=30 / 60, burst=30, key="ip"),
+    # 不具合のあるクライアントからの連続した更新を防ぐ
+    Rule("mylist_write", {"POST", "PUT", "DELETE"}, "/mylist/", rate=10, burst=20, key="user_id"),
+    Rule("mylist_write_ip", {"POST", "PUT", "DELETE"}, "/mylist/", rate=50, burst=100, key="ip"),
+]
+
+# GCRA（キーごとに次の理論上の到着時刻だけを保持する）
+# (受け付けたか, 再試行までの秒数, 保存する到着時刻)を返す
+def gcra(tat: Optional[float], now: float, rate: float, burst: int) -> Tuple[bool, float, Optional[float]]:
+    interval = 1 / rate
+    newTat = max(tat or now, now) + interval
+    allowAt = newTat - interval * burst
+    if now < allowAt:
+        return False, allowAt - now, tat
+    return True, 0.0, newTat
+
+# プロセス内の状態（ワーカーごとに独立）
+class MemoryBackend:
+    def __init__(self, maxKeys: int = MAX_KEYS):
+        self.maxKeys = maxKeys
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+        self._sweptAt = time.time()
+        metrics.gauge("rate_limit_keys", lambda: len(self._tats))
+
+    async def hit(self, key: str, rate: float, burst: int) -> Optional[Tuple[bool, float]]:
+        now = time.time()
+        if now - self._sweptAt >= SWEEP_INTERVAL:
+            self.sweep(now)
+        allowed, retryAfter, tat = gcra(self._tats.get(key), now, rate, burst)
+        if allowed:
+            self._tats[key] = tat
+            self._tats.move_to_end(key)
+            while len(self._tats) > self.maxKeys:
+                self._tats.popitem(last=False)
+        return allowed, retryAfter
+
+    # 理論上の到着時刻を過ぎたキーは新規のキーと同じ状態なので削除する
+    def sweep(self, now: float):
+        self._sweptAt = now
+        for key in [key for key, tat in self._tats.items() if tat <= now]:
+            del self._tats[key]
+
+# 同一ホストの複数ワーカーで状態を共有する（SQLiteのファイル）
+# ファイルの読み書きやロック待ちでイベントループを止めないよう、スレッドプールで実行する。
+class SqliteBackend:
+    BUSY_TIMEOUT = 0.05
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rate_limit (key TEXT PRIMARY KEY, tat REAL NOT NULL) WITHOUT ROWID")
+        self._sweptAt = time.time()
+
+    # ストアが使えない場合はNoneを返す（受け付けるかはルールごとに決める）
+    async def hit(self, key: str, rate: float, burst: int) -> Optional[Tuple[bool, float]]:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self._hit, key, rate, burst)
+        except sqlite3.Error:
+            logger.warning("rate limit store %s is unavailable", self.path)
+            metrics.inc("rate_limit_store_errors_total")
+            return None
+
+    def _hit(self, key: str, rate: float, burst: int) -> Tuple[bool, float]:
+        now = time.time()
+        with self._lock:
+            if now - self._sweptAt >= SWEEP_INTERVAL:
+                self._sweptAt = now
+                self._conn.execute("DELETE FROM rate_limit WHERE tat <= ?", (now,))
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tat FROM rate_limit WHERE key = ?", (key,)).fetchone()
+                allowed, retryAfter, tat = gcra(row[0] if row else None, now, rate, burst)
+                if allowed:
+                    self._conn.execute(
+                        "INSERT INTO rate_limit (key, tat) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET tat = excluded.tat",
+                        (key, tat)
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return allowed, retryAfter
+
+def createBackend(settings: Settings):
+    if settings.rate_limit_store:
+        return SqliteBackend(settings.rate_limit_store)
+    return MemoryBackend()
+
+# レート制限のASGIミドルウェア（DBのセッションを取得する前に制限する）
+class RateLimitMiddleware:
+    def __init__(self, app, backend, rules: List[Rule] = RULES):
+        self.app = app
+        self.backend = backend
+        self.rules = rules
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rules = [rule for rule in self.rules if rule.matches(scope["method"], scope["path"])]
+        if not rules:
+            await self.app(scope, receive, send)
+            return
+
+        body = None
+        if any(rule.key != "ip" for rule in rules):
+            body, receive = await readBody(receive)
+        fields = parseFields(body)
+        client = scope["client"][0] if scope.get("client") else "unknown"
+        for rule in rules:
+            key = f"{rule.name}:ip:{client}"
+            if rule.key != "ip" and fields.get(rule.key) is not None:
+                value = normalizeId(fields[rule.key])
+                if value is None:
+                    # 検証で拒否される値は、DBに届く前にここで拒否する（表記揺れで別のキーにしない）
+                    response = JSONResponse(status_code=422, content={"detail": f"Invalid {rule.key}"})
+                    await response(scope, receive, send)
+                    return
+                key = f"{rule.name}:{rule.key}:{value}"
+            result = await self.backend.hit(key, rule.rate, rule.burst)
+            allowed, retryAfter = result if result is not None else (rule.failOpen, 1.0)
+            if not allowed:
+                metrics.inc("rate_limit_rejected_total", rule=rule.name)
+                response = JSONResponse(
+                    status_code=429, content={"detail": "Too many requests"},
+                    headers={"Retry-After": str(math.ceil(retryAfter))}
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+# リクエストボディを読み込み、アプリケーションに同じ内容を渡すreceiveを返す
+async def readBody(receive):
+    messages = []
+    size = 0
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        size += len(message.get("body", b""))
+        if not message.get("more_body", False) or size > MAX_BODY_SIZE:
+            break
+    body = b"".join(message.get("body", b"") for message in messages) if size <= MAX_BODY_SIZE else None
+
+    async def replay():
+        if messages:
+            return messages.pop(0)
+        return await receive()
+    return body, replay
+
+def parseFields(body: Optional[bytes]) -> Dict[str, object]:
+    if not body:
+        return {}
+    try:
+        fields = json.loads(body)
+    except ValueError:
+        return {}
+    return fields if isinstance(fields, dict) else {}
+
+# IDをスキーマの検証（pydanticのint）と同じ規則で整数にする（"001"や1.0も1として扱う）。変換できない場合はNone
+def normalizeId(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
@@ -0,0 +1,42 @@
+import asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+import api.models.user as user_model
+from api.cruds.summary import rebuildUserSummary
+from api.db import createEngine, retryTransaction
+from api.settings import Settings
+
+# 全ユーザーの集計をマイリストから再集計する（差分更新のずれを補正するための定期実行用）
+# 1ユーザーずつ、集計の行をロックして数え直したトランザクションで保存する（実行中の書き込みの差分を上書きしない）。
+async def rebuild_summary(engine: AsyncEngine, batch_size: int = 1000):
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        lastUserId = 0
+        while True:
+            userIds = (await session.execute(
+                select(user_model.User.user_id)
+                .filter(user_model.User.user_id > lastUserId)
+                .order_by(user_model.User.user_id)
+                .limit(batch_size)
+            )).scalars().all()
+            await session.commit()
+            if len(userIds) == 0:
+                return
+            for user_id in userIds:
+                await rebuildAndCommit(session, user_id)
+            lastUserId = userIds[-1]
+
+# 書き込み中のユーザーの行ロックと競合した場合は、そのユーザーだけ再実行する
+@retryTransaction
+async def rebuildAndCommit(session: AsyncSession, user_id: int):
+    await rebuildUserSummary(session, user_id)
+    await session.commit()
+
+async def main():
+    engine = createEngine(Settings())
+    try:
+        await rebuild_summary(engine)
+    finally:
+        await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(main())
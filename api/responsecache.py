@@ -0,0 +1,159 @@
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from api.metrics import metrics
+from api.ratelimit import normalizeId
+from api.settings import Settings
+
+# 無効化した記録を保持するタグ数の上限（超えた場合は古い記録を削除し、それより前に始まったリクエストの結果は保存しない）
+MAX_INVALIDATIONS = 10000
+
+# キャッシュの対象のルート（GETのみ。パスの末尾の値をタグにする）
+class CacheRule:
+    def __init__(self, path: str, tag: str):
+        # 前方一致
+        self.path = path
+        # タグの種類（"user"の場合はパスの末尾のuser_idごとに無効化する）
+        self.tag = tag
+
+    def tagFor(self, path: str) -> Optional[str]:
+        if not path.startswith(self.path):
+            return None
+        value = normalizeId(path[len(self.path):])
+        return None if value is None else f"{self.tag}:{value}"
+
+CACHED_ROUTES = [
+    CacheRule("/mylist/retrieve/all/", tag="user"),
+]
+
+def userTag(user_id: int) -> str:
+    return f"user:{user_id}"
+
+class CacheEntry:
+    __slots__ = ("status", "headers", "body", "tag", "expiresAt", "size")
+
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], body: bytes, tag: str, expiresAt: float):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.tag = tag
+        self.expiresAt = expiresAt
+        self.size = len(body) + sum(len(name) + len(value) for name, value in headers)
+
+# シリアライズ済みのレスポンスのプロセス内LRU（合計のバイト数で上限を決める）
+# 書き込みのコミット後に、変更されたユーザーのタグ（userTag）でまとめて無効化する（InvalidationBus参照）。
+class ResponseCache:
+    def __init__(self, maxBytes: int = 32 * 1024 * 1024, ttl: float = 30.0):
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._tags: Dict[str, Set[str]] = {}
+        # 無効化のたびに増やす番号と、タグごとの最後に無効化した番号
+        # 読み込み中に無効化されたタグのレスポンスは、古い内容の可能性があるため保存しない。
+        self.version = 0
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self._floor = 0
+        metrics.gauge("response_cache_bytes", lambda: self.size)
+        metrics.gauge("response_cache_entries", lambda: len(self._entries))
+
+    @classmethod
+    def fromSettings(cls, settings: Settings) -> "ResponseCache":
+        return cls(settings.response_cache_max_bytes, settings.response_cache_ttl)
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expiresAt <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    # versionはリクエストの処理を始めた時点のself.version
+    def put(self, key: str, entry: CacheEntry, version: int) -> bool:
+        # 1件で容量の大半を占めるレスポンスは保存しない
+        if entry.size > self.maxBytes // 4 or not self.isFresh(entry.tag, version):
+            return False
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._tags.setdefault(entry.tag, set()).add(key)
+        self.size += entry.size
+        while self.size > self.maxBytes:
+            self._remove(next(iter(self._entries)))
+            metrics.inc("response_cache_evictions_total")
+        return True
+
+    def isFresh(self, tag: str, version: int) -> bool:
+        return version >= self._floor and self._invalidated.get(tag, 0) <= version
+
+    def invalidate(self, tag: str):
+        self.version += 1
+        self._invalidated[tag] = self.version
+        self._invalidated.move_to_end(tag)
+        while len(self._invalidated) > MAX_INVALIDATIONS:
+            _, self._floor = self._invalidated.popitem(last=False)
+        for key in list(self._tags.get(tag, ())):
+            self._remove(key)
+
+    def clear(self):
+        self.version += 1
+        self._floor = self.version
+        self._invalidated.clear()
+        self._entries.clear()
+        self._tags.clear()
+        self.size = 0
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        keys = self._tags[entry.tag]
+        keys.discard(key)
+        if not keys:
+            del self._tags[entry.tag]
+
+# キャッシュの対象のルートのレスポンスを保存し、次からはアプリケーションを呼ばずに返すASGIミドルウェア
+# ヒットした場合は、DBへの問い合わせもレスポンスの検証・シリアライズも行わない。
+class ResponseCacheMiddleware:
+    def __init__(self, app, cache: ResponseCache, rules: List[CacheRule] = CACHED_ROUTES):
+        self.app = app
+        self.cache = cache
+        self.rules = rules
+
+    async def __call__(self, scope, receive, send):
+        tag = None
+        if scope["type"] == "http" and scope["method"] == "GET":
+            tag = next((tag for tag in (rule.tagFor(scope["path"]) for rule in self.rules) if tag is not None), None)
+        if tag is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = scope["path"] + "?" + scope["query_string"].decode("latin-1")
+        entry = self.cache.get(key)
+        if entry is not None:
+            metrics.inc("response_cache_total", result="hit")
+            await send({"type": "http.response.start", "status": entry.status, "headers": entry.headers + [(b"x-cache", b"HIT")]})
+            await send({"type": "http.response.body", "body": entry.body})
+            return
+        metrics.inc("response_cache_total", result="miss")
+
+        version = self.cache.version
+        start = None
+        chunks = []
+
+        async def sendAndCapture(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-cache", b"MISS")]}
+            elif message["type"] == "http.response.body" and start is not None and start["status"] == 200:
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    self.cache.put(key, CacheEntry(
+                        start["status"], list(start.get("headers", [])), b"".join(chunks), tag, time.monotonic() + self.cache.ttl
+                    ), version)
+            await send(message)
+        await self.app(scope, receive, sendAndCapture)
@@ -1,12 +1,12 @@
 import logging
 from fastapi import APIRouter, Depends
-from api.db import get_db
+from api.db import UnitOfWorkRoute, get_db
 from api.schemas import auth as authSchema
 from sqlalchemy.ext.asyncio import AsyncSession
 import api.cruds.auth as authCrud
 import api.cruds.common as common
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 logger = logging.getLogger('uvicorn')
 
 # 認証コードを発行
@@ -21,3 +21,7 @@ async def createAuthCode(body: authSchema.createAuthCodeParam, db: AsyncSession
 async def authenticate(body: authSchema.authenticateParam, db: AsyncSession = Depends(get_db)):    
     return await authCrud.authenticate(db, body)
 
+# 認証した上で、仮ユーザーのマイリストを認証したユーザーへ一括で移行
+@router.post("/auth/migrate", response_model=authSchema.migrateResponse)
+async def migrateMylists(body: authSchema.migrateParam, db: AsyncSession = Depends(get_db)):
+    return await authCrud.migrateMylists(db, body)
@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from api.metrics import metrics
+
+router = APIRouter()
+
+# メトリクスをPrometheusのテキスト形式で取得
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def retrieveMetrics():
+    return metrics.render()
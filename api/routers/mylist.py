@@ -1,36 +1,132 @@
+import datetime
 import logging
-from typing import List
+from typing import List, Optional, Union
 from api.genericCode import UpdateTargetType
-from fastapi import APIRouter, Depends, HTTPException
-from api.db import get_db
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.utils import create_response_field
+from pydantic import ValidationError
+from api.db import UnitOfWorkRoute, get_db
 from api.schemas import mylist as mylistSchema
 from sqlalchemy.ext.asyncio import AsyncSession
 import api.cruds.mylist as mylist_crud
+import api.cruds.pick as pick_crud
+import api.cruds.batch as batch_crud
+import api.cruds.idempotency as idempotency_crud
+import api.cruds.summary as summary_crud
+import api.cruds.common as common
+import api.events as events
 
-router = APIRouter()
+router = APIRouter(route_class=UnitOfWorkRoute)
 logger = logging.getLogger('uvicorn')
 
+# fieldsを指定しない場合のマイリスト取得レスポンスの検証用
+MYLISTS_RESPONSE = create_response_field(name="response", type_=List[mylistSchema.Mylist])
+
+# response_modelはドキュメント用のUnion（どちらかに合えば通ってしまう）のため、List[Mylist]として検証する
+# Mylistの項目はJSONの型そのままなので、jsonable_encoderを通さずに検証後の値をそのままエンコードする。
+def validateMylists(rows) -> List[dict]:
+    mylists, errors = MYLISTS_RESPONSE.validate(rows, {}, loc=("response",))
+    if errors:
+        raise ValidationError(errors if isinstance(errors, list) else [errors], MYLISTS_RESPONSE.type_)
+    return [dict(mylist) for mylist in mylists]
+
 #　ユーザーの全マイリストを取得
-@router.get("/mylist/retrieve/all/{user_id}", response_model=List[mylistSchema.Mylist])
-async def retrieveAllMylists(user_id: int, db: AsyncSession = Depends(get_db)):    
-    return await mylist_crud.retrieveAllMyListsByUserId(db, user_id)
+# fieldsを指定した場合は指定した項目だけを返す（例: fields=my_list_id,title,topic_count）
+# sort=topic_count / -topic_count でトピック数順、min_topics / max_topics でトピック数の範囲で絞り込む
+# レスポンスはfieldsを指定しない場合はMylist、指定した場合はMylistFields（指定した項目のみ）のリスト
+@router.get(
+    "/mylist/retrieve/all/{user_id}",
+    response_model=Union[List[mylistSchema.Mylist], List[mylistSchema.MylistFields]],
+    response_description="fieldsを指定しない場合はMylistのリスト、指定した場合は指定した項目だけのMylistFieldsのリスト"
+)
+async def retrieveAllMylists(
+    user_id: int,
+    fields: Optional[str] = Query(None),
+    sort: Optional[str] = Query(None, regex="^-?topic_count$"),
+    min_topics: Optional[int] = Query(None, ge=0),
+    max_topics: Optional[int] = Query(None, ge=0),
+    db: AsyncSession = Depends(get_db)
+):    
+    if fields is None:
+        if sort is None and min_topics is None and max_topics is None:
+            rows = await mylist_crud.retrieveAllMylistRows(db, user_id)
+        else:
+            rows = await mylist_crud.retrieveAllMyListsByUserId(db, user_id, sort=sort, min_topics=min_topics, max_topics=max_topics)
+        return JSONResponse(validateMylists(rows))
+    names = mylist_crud.parseFields(fields)
+    rows = await mylist_crud.retrieveAllMyListsByUserId(db, user_id, names, sort, min_topics, max_topics)
+    # 一部の項目だけなのでMylistではなくMylistFieldsで検証し、指定した項目だけを返す
+    return JSONResponse([mylistSchema.MylistFields.from_orm(row).dict(include=set(names)) for row in rows])
+
+# ユーザーのマイリスト集計（件数、公開/非公開の内訳、テーマごとの件数、トピック数の合計）
+@router.get("/mylist/summary/{user_id}", response_model=mylistSchema.userSummaryResponse)
+async def retrieveSummary(user_id: int, db: AsyncSession = Depends(get_db)):
+    return await summary_crud.getUserSummary(db, user_id)
+
+# 差分同期（sinceは前回レスポンスのcursor。省略時は全件。有効期間を過ぎたカーソルは410を返すため、省略して全件を取得し直す）
+@router.get("/mylist/changes/{user_id}", response_model=mylistSchema.mylistChangesResponse)
+async def retrieveChanges(user_id: int, since: Optional[datetime.datetime] = Query(None), db: AsyncSession = Depends(get_db)):
+    return await mylist_crud.retrieveChangesByUserId(db, user_id, since)
+
+# 他端末での変更をServer-Sent Eventsで通知（ポーリングの代わりに使う）
+@router.get("/mylist/events/{user_id}")
+async def streamEvents(user_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    await common.checkIfUserExist(db, user_id)
+    # ストリーム中はDB接続を保持しない
+    await db.close()
+    hub = request.app.state.context.eventHub
+    subscription = hub.subscribe(user_id)
+    return StreamingResponse(
+        events.streamEvents(request, hub, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# 最近更新された公開マイリストを取得
+@router.get("/mylist/feed/public", response_model=List[mylistSchema.Mylist])
+async def retrievePublicFeed(offset: int = Query(0, ge=0), limit: int = Query(20, ge=1, le=100), db: AsyncSession = Depends(get_db)):
+    return await mylist_crud.retrievePublicFeed(db, offset, limit)
+
+# トピックを抽選（weightsはトピックのインデックス順の重み、no_repeatは一周するまで重複なし）
+@router.get("/mylist/{mylist_id}/pick", response_model=mylistSchema.pickTopicResponse)
+async def pickTopics(
+    mylist_id: int,
+    count: int = Query(1, ge=1, le=100),
+    weights: Optional[List[float]] = Query(None),
+    no_repeat: bool = Query(False),
+    db: AsyncSession = Depends(get_db)
+):
+    return await pick_crud.pickTopics(db, mylist_id, count, weights, no_repeat)
 
 # 初回のマイリスト作成（ユーザー情報がないため、新規ユーザーを作成してからマイリスト作成する。）
+# 作成系はIdempotency-Keyヘッダーを指定すると、再送時に重複して作成されない
 @router.post("/mylist/create-user", response_model=mylistSchema.createUserThenMylistResponse)
-async def createUserThenMyList(body: mylistSchema.createUserThenMylistParam, db: AsyncSession = Depends(get_db)):
-    return await mylist_crud.createUserAndNewList(db, body)
+async def createUserThenMyList(body: mylistSchema.createUserThenMylistParam, idempotency_key: Optional[str] = Header(None, max_length=64), db: AsyncSession = Depends(get_db)):
+    return await idempotency_crud.runIdempotent(
+        db, idempotency_key, "mylist/create-user", body,
+        lambda: mylist_crud.createUserAndNewList(db, body), mylistSchema.createUserThenMylistResponse
+    )
 
 # 新規マイリスト作成
 @router.post("/mylist/create", response_model=mylistSchema.createMylistResponse)
-async def createMyList(body: mylistSchema.createMylistParam, db: AsyncSession = Depends(get_db)):
-    return await mylist_crud.createNewList(db, body)
+async def createMyList(body: mylistSchema.createMylistParam, idempotency_key: Optional[str] = Header(None, max_length=64), db: AsyncSession = Depends(get_db)):
+    return await idempotency_crud.runIdempotent(
+        db, idempotency_key, "mylist/create", body,
+        lambda: mylist_crud.createNewList(db, body), mylistSchema.createMylistResponse
+    )
+
+# オフライン中の操作を一括で適用
+@router.post("/mylist/batch", response_model=mylistSchema.batchSyncResponse)
+async def applyBatch(body: mylistSchema.batchSyncParam, db: AsyncSession = Depends(get_db)):
+    return await batch_crud.applyBatch(db, body)
 
 # タイトル更新
 @router.put("/mylist/title/{mylist_id}", response_model=mylistSchema.createMylistResponse)
 async def updateTitle(mylist_id: int, body: mylistSchema.updateTitleParam, db: AsyncSession = Depends(get_db)):
     listInDb = await mylist_crud.getMylistById(db, mylist_id=mylist_id)
     if listInDb is None: 
-        logger.error(f"Mylist with id {mylist_id} not found")
+        logger.error("Mylist with id %s not found", mylist_id)
         raise HTTPException(status_code=404, detail=f"Mylist with id {mylist_id} not found")
     return await mylist_crud.updateMyList(db, body, original=listInDb, target=UpdateTargetType.TITLE)
 
@@ -39,7 +135,7 @@ async def updateTitle(mylist_id: int, body: mylistSchema.updateTitleParam, db: A
 async def updateTheme(mylist_id: int, body: mylistSchema.updateThemeParam, db: AsyncSession = Depends(get_db)):
     listInDb = await mylist_crud.getMylistById(db, mylist_id=mylist_id)
     if listInDb is None: 
-        logger.error(f"Mylist with id {mylist_id} not found")
+        logger.error("Mylist with id %s not found", mylist_id)
         raise HTTPException(status_code=404, detail=f"Mylist with id {mylist_id} not found")
     return await mylist_crud.updateMyList(db, body, original=listInDb, target=UpdateTargetType.THEME)
 
@@ -48,7 +144,7 @@ async def updateTheme(mylist_id: int, body: mylistSchema.updateThemeParam, db: A
 async def updateTopic(mylist_id: int, body: mylistSchema.updateTopicParam, db: AsyncSession = Depends(get_db)):
     listInDb = await mylist_crud.getMylistById(db, mylist_id=mylist_id)
     if listInDb is None: 
-        logger.error(f"Mylist with id {mylist_id} not found")
+        logger.error("Mylist with id %s not found", mylist_id)
         raise HTTPException(status_code=404, detail=f"Mylist with id {mylist_id} not found")
     return await mylist_crud.updateMyList(db, body, original=listInDb, target=UpdateTargetType.TOPIC)
 
@@ -57,7 +153,7 @@ async def updateTopic(mylist_id: int, body: mylistSchema.updateTopicParam, db: A
 async def updatePravateFlag(mylist_id: int, body: mylistSchema.updatePrivateFlagParam, db: AsyncSession = Depends(get_db)):
     listInDb = await mylist_crud.getMylistById(db, mylist_id=mylist_id)
     if listInDb is None: 
-        logger.error(f"Mylist with id {mylist_id} not found")
+        logger.error("Mylist with id %s not found", mylist_id)
         raise HTTPException(status_code=404, detail=f"Mylist with id {mylist_id} not found")
     return await mylist_crud.updateMyList(db, body, original=listInDb, target=UpdateTargetType.PRIVATE_FLAG)
 
@@ -66,6 +162,6 @@ async def updatePravateFlag(mylist_id: int, body: mylistSchema.updatePrivateFlag
 async def deleteMylist(mylist_id: int, db: AsyncSession = Depends(get_db)):
     listInDb = await mylist_crud.getMylistById(db, mylist_id=mylist_id)
     if listInDb is None: 
-        logger.error(f"Mylist with id {mylist_id} not found")
+        logger.error("Mylist with id %s not found", mylist_id)
         raise HTTPException(status_code=404, detail=f"Mylist with id {mylist_id} not found")
     return await mylist_crud.deleteMylist(db, original=listInDb)
\ No newline at end of file
@@ -19,4 +19,16 @@ class authenticateParam(Auth):
 
 # 認証レスポンス
 class authenticateResponse(BaseModel):
-    user_id: int
\ No newline at end of file
+    user_id: int
+
+# マイリスト移行リクエストパラメータ（認証IDとコードで認証し、from_user_idのマイリストを認証したユーザーへ移す）
+# 移行元のユーザーの端末であることを、作成時に発行されたトークンで確認する
+class migrateParam(Auth):
+    from_user_id: int
+    from_device_token: str = Field(..., max_length=64, description="移行元のユーザーの作成時に発行された端末のトークン")
+    delete_source_user: Optional[bool] = Field(False, description="移行後に移行元のユーザーを削除するか")
+
+# マイリスト移行レスポンス
+class migrateResponse(BaseModel):
+    user_id: int
+    migrated_count: int
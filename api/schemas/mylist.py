@@ -1,6 +1,7 @@
-from typing import List, Optional, Union
-from xmlrpc.client import boolean
-from pydantic import BaseModel, Field, validator
+import datetime
+from typing import Any, Dict, List, Optional, Union
+from pydantic import BaseModel, Field, validator, root_validator
+from api.genericCode import BatchOperationType
 
 
 # 全マイリスト取得リクエストパラメータ
@@ -28,6 +29,26 @@ class Mylist(BaseModel):
     class Config:
         orm_mode = True
 
+# 項目を指定したマイリスト取得レスポンス（指定されなかった項目は含まない）
+class MylistFields(BaseModel):
+    my_list_id: Optional[int]
+    title: Optional[str] = Field(None, min_length=1, max_length=30, description="マイリストのタイトル")
+    theme_type: Optional[str] = Field(None, min_length=3, max_length=3, description="マイリストのサムネイルイラストコード")
+    topic: Optional[dict] = Field(None, description="トピックのリスト")
+    is_private: Optional[bool] = Field(None, description="非公開フラグ")
+    topic_count: Optional[int] = Field(None, description="トピック数")
+
+    @validator("topic")
+    def check_topic_format(cls, dictvalue: dict)-> Union[str, ValueError]:
+        if dictvalue is not None and 'topic' not in dictvalue:
+            raise ValueError("topic dict should have a key with name 'topic'")
+        elif dictvalue is not None and type(dictvalue["topic"]) is not list:
+            raise ValueError("type of value for topic dict is not list")
+        return dictvalue
+
+    class Config:
+        orm_mode = True
+
 # 初回マイリスト作成リクエストパラメータ
 class createUserThenMylistParam(BaseModel):
     title: str = Field(..., min_length=1, max_length=30, description="マイリストのタイトル")
@@ -91,11 +112,79 @@ class updatePrivateFlagParam(BaseModel):
 # 初回マイリスト作成レスポンス
 class createUserThenMylistResponse(Mylist):
     user_id: int
+    # マイリストを別のユーザーへ移行する際に、この端末のユーザーであることを示す（/auth/migrate参照）
+    device_token: Optional[str] = Field(None, description="端末のトークン（再発行されないため端末に保存する）")
 
 # マイリスト作成レスポンス
 class createMylistResponse(Mylist):
     pass
 
+# トピック抽選レスポンス
+class pickTopicResponse(BaseModel):
+    my_list_id: int
+    topic: List[Any] = Field(..., description="抽選されたトピックのリスト")
+    remaining: Optional[int] = Field(None, description="重複なしモードで現在の周回に残っているトピック数")
+
+# 差分同期レスポンス
+class mylistChangesResponse(BaseModel):
+    created: List[Mylist] = Field(..., description="カーソル以降に作成されたマイリスト")
+    updated: List[Mylist] = Field(..., description="カーソル以降に更新されたマイリスト")
+    deleted: List[int] = Field(..., description="カーソル以降に削除されたマイリストのID")
+    cursor: Optional[datetime.datetime] = Field(None, description="次回の差分同期で指定するカーソル")
+
+# 一括同期の操作（createはtemp_idで仮IDを付け、update/deleteはmy_list_idか同じバッチ内のtemp_idで対象を指定する）
+class batchOperation(BaseModel):
+    op: BatchOperationType
+    my_list_id: Optional[int] = Field(None, description="更新・削除対象のマイリストID")
+    temp_id: Optional[str] = Field(None, min_length=1, max_length=64, description="クライアント側の仮ID")
+    title: Optional[str] = Field(None, min_length=1, max_length=30, description="マイリストのタイトル")
+    theme_type: Optional[str] = Field(None, min_length=3, max_length=3, description="マイリストのサムネイルイラストコード")
+    topic: Optional[dict] = Field(None, description="トピックのリスト")
+    is_private: Optional[bool] = Field(None, description="非公開フラグ")
 
+    @validator("topic")
+    def check_topic_format(cls, dictvalue: dict)-> Union[str, ValueError]:
+        if dictvalue is not None and 'topic' not in dictvalue:
+            raise ValueError("topic dict should have a key with name 'topic'")
+        elif dictvalue is not None and type(dictvalue["topic"]) is not list:
+            raise ValueError("type of value for topic dict is not list")
+        return dictvalue
 
-    
\ No newline at end of file
+    @root_validator(skip_on_failure=True)
+    def check_operation(cls, values: dict) -> dict:
+        if values["op"] == BatchOperationType.CREATE:
+            if values["temp_id"] is None:
+                raise ValueError("create operation requires temp_id")
+            if values["title"] is None or values["theme_type"] is None:
+                raise ValueError("create operation requires title and theme_type")
+        elif values["my_list_id"] is None and values["temp_id"] is None:
+            raise ValueError(f"{values['op'].value} operation requires my_list_id or temp_id")
+        return values
+
+# 一括同期リクエストパラメータ
+class batchSyncParam(BaseModel):
+    user_id: int
+    operations: List[batchOperation] = Field(..., min_items=1, max_items=500)
+
+# 一括同期の操作ごとの結果
+class batchOperationResult(BaseModel):
+    index: int
+    op: BatchOperationType
+    status: str = Field(..., description="ok または error")
+    my_list_id: Optional[int] = None
+    temp_id: Optional[str] = None
+    detail: Optional[str] = None
+
+# 一括同期レスポンス
+class batchSyncResponse(BaseModel):
+    results: List[batchOperationResult]
+    id_map: Dict[str, int] = Field(..., description="仮IDと採番されたマイリストIDの対応")
+
+# ユーザーのマイリスト集計レスポンス
+class userSummaryResponse(BaseModel):
+    user_id: int
+    list_count: int = Field(..., description="マイリスト数")
+    public_count: int = Field(..., description="公開マイリスト数")
+    private_count: int = Field(..., description="非公開マイリスト数")
+    topic_count: int = Field(..., description="全マイリストのトピック数の合計")
+    theme_histogram: Dict[str, int] = Field(..., description="テーマごとのマイリスト数")
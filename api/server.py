@@ -0,0 +1,253 @@
+import argparse
+import logging
+import math
+import os
+import random
+import signal
+import sys
+import time
+from importlib.util import find_spec
+from typing import Dict, List, Optional, Tuple
+
+import uvicorn
+
+from api.background import DRAIN_TIMEOUT
+from api.settings import Settings
+
+logger = logging.getLogger('uvicorn.error')
+
+APP = "api.main:app"
+# 待ち受けキューの長さ
+BACKLOG = 2048
+# Keep-Aliveの接続を維持する時間（秒）
+KEEP_ALIVE = 5
+# 全ワーカーが同時に再起動しないように上限をずらす幅
+MAX_REQUESTS_JITTER = 1000
+# 停止時にワーカーの終了を待つ時間のうち、処理中のリクエストとバックグラウンド処理を待った後の接続・ログの後始末の分（秒）
+GRACEFUL_MARGIN = 5
+# 終了したワーカーの確認と、代わりのワーカーの起動を行う間隔（秒）
+SUPERVISE_INTERVAL = 0.1
+# 起動直後に終了したワーカーの再起動を待つ時間（秒）（起動に失敗し続ける場合の連続再起動を防ぐ）
+MIN_WORKER_LIFETIME = 1.0
+# ワーカーの起動に失敗した場合の終了コード
+STARTUP_FAILURE = 3
+# リクエスト数の上限で終了した（代わりのワーカーは起動済み）場合の終了コード
+RECYCLED = 4
+
+# コンテナに割り当てられたCPU数（cgroupのクォータ、CPUアフィニティの順に確認する）
+def availableCpus() -> int:
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    try:
+        # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            cpus = min(cpus, int(quota) // int(period))
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                quota = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if quota > 0:
+                cpus = min(cpus, quota // period)
+        except (OSError, ValueError):
+            pass
+    return max(cpus, 1)
+
+# 既定値はSettings（環境変数 TOPICK_<項目名>）から取得する
+def parseArgs(settings: Settings, argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="ToPick APIサーバー")
+    parser.add_argument("--host", default=settings.host)
+    parser.add_argument("--port", type=int, default=settings.port)
+    parser.add_argument("--workers", type=int, default=settings.workers, help="0の場合はCPU数")
+    parser.add_argument("--backlog", type=int, default=BACKLOG)
+    parser.add_argument("--keep-alive", type=int, default=KEEP_ALIVE)
+    parser.add_argument("--max-requests", type=int, default=settings.max_requests, help="0の場合は再起動しない")
+    parser.add_argument("--max-requests-jitter", type=int, default=MAX_REQUESTS_JITTER)
+    parser.add_argument("--dev", action="store_true", default=settings.dev, help="1プロセスで起動し、ファイルの変更時に再読み込みする")
+    return parser.parse_args(argv)
+
+# uvloopとhttptoolsがインストールされていない環境では標準の実装を使う
+def loopAndHttp():
+    loop = "uvloop" if find_spec("uvloop") is not None else "asyncio"
+    http = "httptools" if find_spec("httptools") is not None else "h11"
+    if loop != "uvloop" or http != "httptools":
+        logger.warning("uvloop or httptools is not installed, using %s and %s", loop, http)
+    return loop, http
+
+# ワーカーのサーバー
+# リクエスト数の上限で停止する場合は、接続の終了を待つ前に親プロセスへ通知して代わりのワーカーを起動させる。
+# SSEの接続は最大1時間続くため、停止の開始時に終了させる（クライアントは再接続する）。
+class WorkerServer(uvicorn.Server):
+    recycled = False
+
+    async def shutdown(self, sockets=None):
+        if not self.should_exit:
+            self.recycled = True
+            os.kill(os.getppid(), signal.SIGUSR1)
+        # uvicornが追加したミドルウェアの内側のアプリケーションの通知を終了させる
+        app = self.config.loaded_app
+        while app is not None and not hasattr(app, "state"):
+            app = getattr(app, "app", None)
+        if app is not None:
+            app.state.context.eventHub.close()
+        await super().shutdown(sockets)
+
+# ソケットとアプリケーションを読み込んでからワーカーをforkし、終了したワーカーは再起動する
+class Supervisor:
+    def __init__(self, args: argparse.Namespace, settings: Settings):
+        self.args = args
+        self.settings = settings
+        self.workers = args.workers or availableCpus()
+        loop, http = loopAndHttp()
+        self.config = uvicorn.Config(
+            APP,
+            host=args.host,
+            port=args.port,
+            loop=loop,
+            http=http,
+            backlog=args.backlog,
+            timeout_keep_alive=args.keep_alive,
+            proxy_headers=True,
+        )
+        # ワーカーのpid -> 起動時刻
+        self.children: Dict[int, float] = {}
+        self.shouldExit = False
+        # シグナルのハンドラーはフラグを立てるだけにして、ワーカーの起動はメインループで行う
+        self.recycleRequested = False
+
+    def run(self):
+        # forkする前にアプリケーションを読み込む（読み込みに失敗した場合はワーカーを起動しない）
+        self.config.load()
+        self.socket = self.config.bind_socket()
+        signal.signal(signal.SIGTERM, self.handleExit)
+        signal.signal(signal.SIGINT, self.handleExit)
+        signal.signal(signal.SIGUSR1, self.handleRecycle)
+        logger.info("Starting %s workers (pid %s)", self.workers, os.getpid())
+        if self.workers > 1:
+            warnPerProcessState(self.settings)
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            self.supervise()
+            time.sleep(SUPERVISE_INTERVAL)
+        self.socket.close()
+
+    # 再起動の通知があれば代わりのワーカーを先に起動し、終了したワーカーの分を起動してワーカー数を保つ
+    # 通知のシグナルはまとめて届く（回数が分からない）ことがあるため、終了時にも不足分を起動する。
+    # 再起動中のワーカーの代わりを先に起動した場合は、そのワーカーが終了するまで一時的にワーカー数を超える。
+    def supervise(self):
+        if self.recycleRequested:
+            self.recycleRequested = False
+            if not self.shouldExit:
+                logger.info("Worker reached max requests, starting a replacement")
+                self.spawn()
+        diedEarly = False
+        for pid, status in self.reap():
+            startedAt = self.children.pop(pid, None)
+            if startedAt is None:
+                continue
+            exitcode = os.waitstatus_to_exitcode(status)
+            if exitcode != RECYCLED and not self.shouldExit:
+                logger.info("Worker %s exited with status %s, restarting", pid, exitcode)
+            diedEarly = diedEarly or (exitcode != RECYCLED and time.monotonic() - startedAt < MIN_WORKER_LIFETIME)
+        if self.shouldExit or len(self.children) >= self.workers:
+            return
+        if diedEarly:
+            time.sleep(MIN_WORKER_LIFETIME)
+        while not self.shouldExit and len(self.children) < self.workers:
+            self.spawn()
+
+    # 終了したワーカーの(pid, 終了ステータス)
+    def reap(self) -> List[Tuple[int, int]]:
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return exited
+            if pid == 0:
+                return exited
+            exited.append((pid, status))
+
+    def spawn(self):
+        limit = self.args.max_requests + random.randint(0, self.args.max_requests_jitter) if self.args.max_requests > 0 else None
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = time.monotonic()
+            return
+        # ワーカー（シグナルはuvicornが処理する）
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        self.config.limit_max_requests = limit
+        status = 0
+        try:
+            server = WorkerServer(self.config)
+            server.run(sockets=[self.socket])
+            if not server.started:
+                status = STARTUP_FAILURE
+            elif server.recycled:
+                status = RECYCLED
+        except BaseException:
+            logger.exception("Worker %s failed", os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    # 上限に達したワーカーが停止を始めたら、終了を待たずに代わりのワーカーを起動する（supervise参照）
+    def handleRecycle(self, sig, frame):
+        self.recycleRequested = True
+
+    # ワーカーに終了を通知し、処理中のリクエストを待ってから終了する
+    def handleExit(self, sig, frame):
+        if self.shouldExit:
+            # 二度目のシグナルでは待たずに終了する
+            self.forceExit(sig, frame)
+            return
+        self.shouldExit = True
+        logger.info("Shutting down %s workers", len(self.children))
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGTERM)
+        signal.signal(signal.SIGALRM, self.forceExit)
+        signal.alarm(gracefulTimeout(self.settings))
+
+    def forceExit(self, sig, frame):
+        logger.error("Killing %s workers", len(self.children))
+        for pid in list(self.children):
+            self.kill(pid, signal.SIGKILL)
+
+    def kill(self, pid: int, sig: int):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            self.children.pop(pid, None)
+
+# 停止時にワーカーの終了を待つ時間（秒）
+# ワーカーは処理中のリクエスト（shutdown_drain_timeout）、バックグラウンド処理（DRAIN_TIMEOUT）の順に完了を待つ。
+def gracefulTimeout(settings: Settings) -> int:
+    return math.ceil(settings.shutdown_drain_timeout + DRAIN_TIMEOUT) + GRACEFUL_MARGIN
+
+# プロセスごとに持つ状態は、複数ワーカーでは共有されない
+def warnPerProcessState(settings: Settings):
+    if settings.rate_limit_enabled and not settings.rate_limit_store:
+        logger.warning("TOPICK_RATE_LIMIT_STORE is not set, rate limits are enforced per worker")
+    if not settings.event_socket_dir:
+        logger.warning(
+            "TOPICK_EVENT_SOCKET_DIR is not set, events, the public feed and response cache invalidations are not shared between workers"
+        )
+
+def main(argv: Optional[list] = None):
+    settings = Settings()
+    args = parseArgs(settings, argv)
+    if args.dev:
+        # 開発用：1プロセスでファイルの変更を監視して再読み込みする
+        uvicorn.run(APP, host=args.host, port=args.port, reload=True)
+        return
+    Supervisor(args, settings).run()
+
+if __name__ == "__main__":
+    sys.exit(main())
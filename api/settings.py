@@ -0,0 +1,46 @@
+from typing import Optional
+from pydantic import BaseSettings
+
+# アプリケーションの設定（環境変数 TOPICK_<項目名> で上書きする）
+class Settings(BaseSettings):
+    db_url: str = "mysql+aiomysql://root@db:3306/topickdb?charset=utf8mb4"
+    # 発行したSQLをログに出力する（開発用）
+    db_echo: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    # MySQLのwait_timeoutより短くして、切断済みの接続を使わないようにする（秒）
+    db_pool_recycle: int = 3600
+    # DBのサーキットブレーカー（連続した失敗の回数、遅延とみなすクエリの時間（秒）、試行を再開するまでの時間（秒））
+    db_circuit_failure_threshold: int = 5
+    db_circuit_slow_threshold: float = 2.0
+    db_circuit_reset_timeout: float = 10.0
+    # 起動時に開いておく接続数（最初のリクエストで接続を待たないようにする）
+    db_warmup_connections: int = 5
+    # 同時処理数（接続プールのサイズ）を超えたリクエストの待ち行列の長さと、待ち時間の上限（秒）
+    admission_queue_size: int = 100
+    admission_max_wait: float = 1.0
+    # 受け付けなかったリクエストに返すRetry-After（秒）
+    admission_retry_after: int = 1
+    # レート制限（複数ワーカーで共有する場合は状態を保存するSQLiteのファイルを指定）
+    rate_limit_enabled: bool = True
+    rate_limit_store: Optional[str] = None
+    # レスポンスのキャッシュ（GET /mylist/retrieve/all/{user_id}。合計のバイト数の上限と有効期間（秒））
+    response_cache_enabled: bool = True
+    response_cache_max_bytes: int = 32 * 1024 * 1024
+    response_cache_ttl: float = 30.0
+    # 停止時に処理中のリクエストの完了を待つ時間（秒）
+    shutdown_drain_timeout: float = 30.0
+    # 複数ワーカー間で変更通知とキャッシュの無効化を共有するUnixソケットのディレクトリ（未設定なら同一プロセス内のみ）
+    event_socket_dir: Optional[str] = None
+    # サーバー（api.server）の設定（コマンドライン引数で上書きできる）
+    host: str = "0.0.0.0"
+    port: int = 8000
+    # ワーカー数（0の場合はCPU数）
+    workers: int = 0
+    # ワーカーが処理するリクエスト数の上限（超えたら再起動してメモリの増加を抑える。0の場合は再起動しない）
+    max_requests: int = 10000
+    # 1プロセスで起動し、ファイルの変更時に再読み込みする（開発用）
+    dev: bool = False
+
+    class Config:
+        env_prefix = "TOPICK_"
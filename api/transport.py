@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger('uvicorn')
+
+# ワーカー間でメッセージを配信するトランスポート
+# LocalTransportは同一プロセス内のみ。複数ワーカーで動かす場合はUnixSocketTransportを使う。
+class LocalTransport:
+    def __init__(self):
+        self._handlers: Dict[str, List[Callable[[dict], None]]] = {}
+
+    def subscribe(self, channel: str, handler: Callable[[dict], None]):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def publish(self, channel: str, message: dict):
+        self.deliver(channel, message)
+
+    def deliver(self, channel: str, message: dict):
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(message)
+            except Exception:
+                logger.exception("transport handler failed")
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+# 同一ホストのワーカー間でUnixドメインソケット（データグラム）を使って配信する
+# 各ワーカーが共有ディレクトリに自分のソケットを作成し、publish時は自分以外の全ソケットへ送信する。
+# 送信はノンブロッキングで、相手の受信バッファが一杯の場合は破棄する（イベントループを止めない）。
+class UnixSocketTransport(LocalTransport):
+    # 他ワーカーのソケット一覧を読み直す間隔（秒）
+    PEER_REFRESH_INTERVAL = 1.0
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        self.path: Optional[str] = None
+        self.dropped = 0
+        self._sock: Optional[socket.socket] = None
+        self._peers: List[str] = []
+        self._peersLoadedAt = 0.0
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # fork前に作成したインスタンスでもワーカーごとに別のソケットになるよう、起動時にパスを決める
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        self._sock.bind(self.path)
+        asyncio.get_running_loop().add_reader(self._sock.fileno(), self._onReadable)
+
+    async def stop(self):
+        if self._sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def publish(self, channel: str, message: dict):
+        self.deliver(channel, message)
+        if self._sock is None:
+            return
+        data = json.dumps({"channel": channel, "message": message}, default=str).encode()
+        for peer in self._currentPeers():
+            try:
+                self._sock.sendto(data, peer)
+            except BlockingIOError:
+                self.dropped += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 終了したワーカーのソケットが残っている場合は削除する
+                self._removeStalePeer(peer)
+            except OSError:
+                self.dropped += 1
+                logger.exception("failed to send to %s", peer)
+
+    def _currentPeers(self) -> List[str]:
+        now = time.monotonic()
+        if now - self._peersLoadedAt > self.PEER_REFRESH_INTERVAL:
+            self._peers = [
+                entry.path for entry in os.scandir(self.directory)
+                if entry.name.endswith(".sock") and entry.path != self.path
+            ]
+            self._peersLoadedAt = now
+        return self._peers
+
+    def _removeStalePeer(self, peer: str):
+        try:
+            os.unlink(peer)
+        except OSError:
+            pass
+        if peer in self._peers:
+            self._peers.remove(peer)
+
+    def _onReadable(self):
+        while self._sock is not None:
+            try:
+                data = self._sock.recv(65536)
+            except BlockingIOError:
+                return
+            try:
+                payload = json.loads(data)
+            except ValueError:
+                logger.error("invalid transport message")
+                continue
+            self.deliver(payload["channel"], payload["message"])
+
+def createTransport(socket_dir: Optional[str]) -> LocalTransport:
+    if socket_dir:
+        return UnixSocketTransport(socket_dir)
+    return LocalTransport()
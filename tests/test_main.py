@@ -1,57 +1,92 @@
-from datetime import timedelta
+import asyncio
+import hashlib
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
 from pydantic import ValidationError
 import pytest
 import pytest_asyncio
+from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from pydantic import BaseModel
+import httpx
 from httpx import AsyncClient
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession
 import starlette.status
-from sqlalchemy import select
-
-from api.db import get_db, Base
-from api.main import app
+from sqlalchemy import event, func, select, delete
+
+from api.db import Base
+from api.main import create_app
+from api.settings import Settings
+from api.lifecycle import InFlight
+import api.profile_startup as profile_startup
+import api.bench_reads as bench_reads
+from api.admission import AdmissionController, RequestClass
+from api.ratelimit import MemoryBackend, SqliteBackend, RateLimitMiddleware
+from fastapi.responses import JSONResponse
+import api.deadline as deadline
+from api.db import CircuitState, LazySession, RetryBudget, UnitOfWorkRoute, get_db
+from starlette.requests import Request
 
 import api.models.mylist as mylist_model
 import api.models.auth as auth_model
 import api.cruds.mylist as mylist_crud
+import api.cruds.summary as summary_crud
+import api.cruds.common as common
+import api.cruds.pick as pick_crud
+import api.models.pick as pick_model
+from api.rebuild_summary import rebuild_summary
+from api.cruds.feed import PublicFeed
+from api.events import EventHub, streamEvents
+from api.transport import UnixSocketTransport
+from api.responsecache import CacheEntry, ResponseCache
+import api.invalidation as invalidation
+import api.models.user as user_model
+import api.models.idempotency as idempotency_model
+import api.schemas.mylist as mylistSchema
+import api.cruds.idempotency as idempotency_crud
+from api.background import BackgroundExecutor, Priority
+from api.metrics import metrics
+from api.logconfig import QueueLogging, RateLimitFilter
+import logging
+import threading
 
 ASYNC_DB_URL = "sqlite+aiosqlite:///:memory:"
 
 class ClientWithDBSession:
     client: AsyncClient
     dbsession: AsyncSession
+    app: FastAPI
 
-    def __init__(self, client, dbsession):
+    def __init__(self, client, dbsession, app):
         self.client = client
         self.dbsession = dbsession
+        self.app = app
 
 # テストの前準備（ジェネレータとして定義）
 @pytest_asyncio.fixture
 async def async_client() -> AsyncClient:
-    # Async用のengineとsessionを作成
-    async_engine = create_async_engine(ASYNC_DB_URL, echo=True)
-    async_session = sessionmaker(
-        autocommit=False, autoflush=False, bind=async_engine, class_=AsyncSession
-    )
+    # テスト用のDBに接続するアプリケーションを作成し、起動処理を実行
+    # レート制限はtest_rate_limitで確認する（認証の異常系を同じ認証IDで繰り返すため無効にする）
+    app = create_app(Settings(db_url=ASYNC_DB_URL, db_warmup_connections=1, rate_limit_enabled=False))
+    await app.router.startup()
 
     # テスト用にオンメモリのSQLiteテーブルを初期化（関数ごとにリセット）
-    async with async_engine.begin() as conn:
+    async with app.state.engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
 
-    # DIを使ってFastAPIのDBの向き先をテスト用DBに変更
-    async def get_test_db():
-        async with async_session() as session:
-            yield session
-
-    app.dependency_overrides[get_db] = get_test_db
-
     # テスト用に非同期HTTPクライアントを返却
     # TODO 非同期処理がネストしているので並列で処理するように書きたい
     async with AsyncClient(app=app, base_url="http://test") as client:
         # yield client
-        async with async_session() as session:
-            yield ClientWithDBSession(client=client, dbsession=session)
+        async with app.state.sessionFactory() as session:
+            yield ClientWithDBSession(client=client, dbsession=session, app=app)
+    await app.router.shutdown()
 
 
 # 【正常系】マイリスト作成(ユーザー作成)
@@ -64,13 +99,16 @@ async def test_mylist_user_create(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 1
     assert response_obj["title"] == "ユーザーなし作成テスト"
     assert response_obj["theme_type"] == "001"
     assert response_obj["topic"] == {"topic" : []}
     assert response_obj["is_private"] == False
     assert response_obj["user_id"] == 1
+    # 端末のトークンはハッシュだけを保存する
+    userInDb = await async_client.dbsession.get(user_model.User, 1)
+    assert userInDb.device_token_hash == hashlib.sha256(response_obj["device_token"].encode()).hexdigest()
 
     # ケース2 1トピックありで作成（新規顧客）
     response = await async_client.client.post("/mylist/create-user", json={
@@ -80,7 +118,7 @@ async def test_mylist_user_create(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 2
     assert response_obj["title"] == "ユーザーなし作成テスト2"
     assert response_obj["theme_type"] == "002"
@@ -95,7 +133,7 @@ async def test_mylist_user_create(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 3
     assert response_obj["title"] == "ユーザーなし作成テスト3"
     assert response_obj["theme_type"] == "002"
@@ -110,7 +148,7 @@ async def test_mylist_user_create(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 4
     assert response_obj["title"] == "123456789012345678901234567890"
     assert response_obj["theme_type"] == "002"
@@ -126,7 +164,7 @@ async def test_mylist_user_create(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 5
     assert response_obj["title"] == "ユーザーなし作成テスト4"
     assert response_obj["theme_type"] == "002"
@@ -142,7 +180,7 @@ async def test_mylist_user_create(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 6
     assert response_obj["title"] == "123456789012345678901234567890"
     assert response_obj["theme_type"] == "002"
@@ -783,7 +821,7 @@ async def test_mylist_user_create_border(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 1
     assert response_obj["title"] == "a"
     assert response_obj["theme_type"] == "001"
@@ -798,7 +836,7 @@ async def test_mylist_user_create_border(async_client):
     })
     assert response.status_code == starlette.status.HTTP_200_OK
     response_obj = response.json()
-    assert len(response_obj) == 6
+    assert len(response_obj) == 7
     assert response_obj["my_list_id"] == 2
     assert response_obj["title"] == "123456789012345678901234567890"
     assert response_obj["theme_type"] == "001"
@@ -1956,6 +1994,1604 @@ async def test_mylist_retrieve_validation(async_client):
     assert "response -> 0 -> is_private" in str(e.value)
     assert "none is not an allowed value (type=type_error.none.not_allowed)" in str(e.value)
 
+# 公開マイリストのフィード
+@pytest.mark.asyncio
+async def test_mylist_public_feed(async_client):
+    # ケース1 正常系_マイリストがない場合は空
+    response = await async_client.client.get("/mylist/feed/public")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json() == []
+
+    # 公開2件、非公開1件を作っておく
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "公開1",
+        "theme_type": "001",
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "非公開",
+        "theme_type": "002",
+        "is_private": True
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "公開2",
+        "theme_type": "003",
+        "topic": {"topic" : ["話題１"]},
+    })
+
+    # ケース2 正常系_公開マイリストのみ新しい順
+    response = await async_client.client.get("/mylist/feed/public")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert [mylist["my_list_id"] for mylist in response.json()] == [3, 1]
+
+    # ケース3 正常系_更新したマイリストが先頭に来る
+    await async_client.client.put("/mylist/title/1", json={"title": "公開1更新"})
+    response = await async_client.client.get("/mylist/feed/public")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [1, 3]
+    assert response.json()[0]["title"] == "公開1更新"
+
+    # ケース4 正常系_ページング
+    response = await async_client.client.get("/mylist/feed/public?offset=1&limit=1")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [3]
+
+    # ケース5 正常系_非公開に変更したマイリストは除外、公開に変更したマイリストは先頭に追加
+    await async_client.client.put("/mylist/privateflag/1", json={"is_private": True})
+    await async_client.client.put("/mylist/privateflag/2", json={"is_private": False})
+    response = await async_client.client.get("/mylist/feed/public")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [2, 3]
+
+    # ケース6 正常系_削除したマイリストは除外
+    await async_client.client.delete("/mylist/2")
+    response = await async_client.client.get("/mylist/feed/public")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [3]
+
+    # ケース7 正常系_フィードをリセットしてもDBから同じ内容が再構築される
+    async_client.app.state.context.publicFeed.reset()
+    response = await async_client.client.get("/mylist/feed/public")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [3]
+
+    # ケース8 異常系_limitの上限違反
+    response = await async_client.client.get("/mylist/feed/public?limit=101")
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+
+# トピック抽選
+@pytest.mark.asyncio
+async def test_mylist_pick(async_client):
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "抽選テスト",
+        "theme_type": "001",
+        "topic": {"topic" : ["話題１", "話題２", "話題３", "話題４"]},
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "トピックなし",
+        "theme_type": "001",
+    })
+    topics = ["話題１", "話題２", "話題３", "話題４"]
+
+    # ケース1 正常系_1件抽選
+    response = await async_client.client.get("/mylist/1/pick")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    response_obj = response.json()
+    assert response_obj["my_list_id"] == 1
+    assert len(response_obj["topic"]) == 1
+    assert response_obj["topic"][0] in topics
+    assert response_obj["remaining"] is None
+
+    # ケース2 正常系_複数件抽選（重複なし、トピック数が上限）
+    response = await async_client.client.get("/mylist/1/pick?count=10")
+    assert sorted(response.json()["topic"]) == sorted(topics)
+
+    # ケース3 正常系_重み付き抽選（重み0のトピックは選ばれない）
+    for _ in range(5):
+        response = await async_client.client.get("/mylist/1/pick?count=2&weights=0&weights=1&weights=0&weights=1")
+        assert sorted(response.json()["topic"]) == ["話題２", "話題４"]
+
+    # ケース4 正常系_重複なしモードでは一周するまで同じトピックを返さない
+    picked = []
+    for remaining in [3, 2, 1, 0]:
+        response = await async_client.client.get("/mylist/1/pick?no_repeat=true")
+        assert response.json()["remaining"] == remaining
+        picked += response.json()["topic"]
+    assert sorted(picked) == sorted(topics)
+    # 二周目に入る
+    response = await async_client.client.get("/mylist/1/pick?no_repeat=true&count=2")
+    assert response.json()["remaining"] == 2
+
+    # ケース5 正常系_トピック更新後は新しいトピックで周回をやり直す
+    await async_client.client.put("/mylist/topic/1", json={"topic": {"topic": ["新話題１", "新話題２"]}})
+    response = await async_client.client.get("/mylist/1/pick?no_repeat=true&count=2")
+    assert sorted(response.json()["topic"]) == ["新話題１", "新話題２"]
+    assert response.json()["remaining"] == 0
+
+    # ケース6 正常系_トピックなしのマイリスト
+    response = await async_client.client.get("/mylist/2/pick")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json()["topic"] == []
+
+    # ケース7 異常系_存在しないマイリスト
+    response = await async_client.client.get("/mylist/3/pick")
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+    assert response.json() == {
+        "detail": "Mylist with id 3 not found"
+    }
+
+    # ケース8 異常系_重複なしモードと重み付きの併用
+    response = await async_client.client.get("/mylist/1/pick?no_repeat=true&weights=1")
+    assert response.status_code == starlette.status.HTTP_400_BAD_REQUEST
+
+    # ケース9 異常系_負の重み
+    response = await async_client.client.get("/mylist/1/pick?weights=-1")
+    assert response.status_code == starlette.status.HTTP_400_BAD_REQUEST
+
+    # ケース10 正常系_初回の抽選が同時に届き、ロックを取る前に別のリクエストが抽選状態を作成した場合も失敗しない
+    await async_client.client.put("/mylist/topic/1", json={"topic": {"topic": ["話題A", "話題B", "話題C"]}})
+    async_client.dbsession.add(pick_model.PickState(my_list_id=1, permutation=[2, 0, 1], position=1, created_at=datetime.now(), updated_at=datetime.now()))
+    await async_client.dbsession.commit()
+    async_client.dbsession.expunge_all()
+    get = async_client.dbsession.get
+    calls = []
+
+    async def getMissingFirst(*args, **kwargs):
+        calls.append(args)
+        return None if len(calls) == 1 else await get(*args, **kwargs)
+    async_client.dbsession.get = getMissingFirst
+    picked, remaining = await pick_crud.nextFromPermutation(async_client.dbsession, 1, 3, 1)
+    await async_client.dbsession.commit()
+    async_client.dbsession.get = get
+    assert (picked, remaining) == ([0], 1)
+
+# 差分同期
+@pytest.mark.asyncio
+async def test_mylist_changes(async_client):
+    # ケース1 異常系_存在しないユーザー
+    response = await async_client.client.get("/mylist/changes/1")
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+    assert response.json() == {
+        "detail": "User with id 1 not found"
+    }
+
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "差分同期1",
+        "theme_type": "001",
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "差分同期2",
+        "theme_type": "001",
+    })
+
+    # ケース2 正常系_カーソルなし（初回同期）は全件がcreatedで返る
+    response = await async_client.client.get("/mylist/changes/1")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    response_obj = response.json()
+    assert [mylist["my_list_id"] for mylist in response_obj["created"]] == [1, 2]
+    assert response_obj["updated"] == []
+    assert response_obj["deleted"] == []
+    cursor = response_obj["cursor"]
+    assert cursor is not None
+
+    # 前回のカーソル以降の変更を作る
+    await async_client.client.put("/mylist/title/1", json={"title": "差分同期1更新"})
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "差分同期3",
+        "theme_type": "001",
+    })
+    await async_client.client.delete("/mylist/2")
+
+    # ケース3 正常系_カーソル以降の作成・更新・削除のみ返る
+    response = await async_client.client.get("/mylist/changes/1", params={"since": cursor})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    response_obj = response.json()
+    assert [mylist["my_list_id"] for mylist in response_obj["created"]] == [3]
+    assert [mylist["my_list_id"] for mylist in response_obj["updated"]] == [1]
+    assert response_obj["updated"][0]["title"] == "差分同期1更新"
+    assert response_obj["deleted"] == [2]
+    assert response_obj["cursor"] > cursor
+
+    # ケース4 正常系_変更がなくても、カーソルより前の一定時間（CURSOR_MARGIN）の変更は再送される
+    cursor = response_obj["cursor"]
+    response = await async_client.client.get("/mylist/changes/1", params={"since": cursor})
+    response_obj = response.json()
+    assert response_obj["created"] == []
+    assert [mylist["my_list_id"] for mylist in response_obj["updated"]] == [1, 3]
+    assert response_obj["deleted"] == [2]
+    assert response_obj["cursor"] == cursor
+
+    # ケース4-2 正常系_カーソルより前の時刻でコミットされた変更（長いトランザクション）も取りこぼさない
+    lateCommit = await async_client.dbsession.get(mylist_model.MyList, 1)
+    lateCommit.title = "遅れてコミット"
+    lateCommit.updated_at = datetime.fromisoformat(cursor) - timedelta(seconds=30)
+    await async_client.dbsession.commit()
+    response = await async_client.client.get("/mylist/changes/1", params={"since": cursor})
+    assert [mylist["title"] for mylist in response.json()["updated"] if mylist["my_list_id"] == 1] == ["遅れてコミット"]
+
+    # ケース4-3 正常系_CURSOR_MARGINより前の変更は再送しない
+    response = await async_client.client.get("/mylist/changes/1", params={
+        "since": (datetime.fromisoformat(cursor) + mylist_crud.CURSOR_MARGIN + timedelta(seconds=1)).isoformat()
+    })
+    response_obj = response.json()
+    assert response_obj["created"] == [] and response_obj["updated"] == [] and response_obj["deleted"] == []
+
+    # ケース4-4 正常系_さかのぼって取得した変更だけの場合も、カーソルは前回より戻らない
+    since = (datetime.fromisoformat(cursor) + timedelta(seconds=30)).isoformat()
+    response = await async_client.client.get("/mylist/changes/1", params={"since": since})
+    response_obj = response.json()
+    assert [mylist["my_list_id"] for mylist in response_obj["updated"]] == [1, 3]
+    assert response_obj["cursor"] == since
+
+    # ケース5 異常系_カーソルの形式が不正
+    response = await async_client.client.get("/mylist/changes/1", params={"since": "不正"})
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # ケース6 異常系_有効期間を過ぎたカーソル（削除の記録が残っていないため、全件の同期からやり直す）
+    response = await async_client.client.get("/mylist/changes/1", params={
+        "since": (datetime.now() - mylist_crud.CURSOR_MAX_AGE - timedelta(seconds=1)).isoformat()
+    })
+    assert response.status_code == starlette.status.HTTP_410_GONE
+
+    # ケース7 正常系_有効期間を過ぎた削除の記録は削除し、有効期間内の記録は残す
+    async_client.dbsession.add(mylist_model.MyListDeletion(
+        user_id=1, my_list_id=99, deleted_at=datetime.now() - mylist_crud.CURSOR_MAX_AGE - mylist_crud.CURSOR_MARGIN - timedelta(seconds=1)
+    ))
+    await async_client.dbsession.commit()
+    await mylist_crud.purgeDeletions(async_client.dbsession)
+    deleted = (await async_client.dbsession.execute(select(mylist_model.MyListDeletion.my_list_id))).scalars().all()
+    assert deleted == [2]
+
+# 変更通知
+@pytest.mark.asyncio
+async def test_mylist_events(async_client, tmp_path):
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "変更通知",
+        "theme_type": "001",
+    })
+    eventHub = async_client.app.state.context.eventHub
+    subscription = eventHub.subscribe(1)
+    otherUser = eventHub.subscribe(2)
+
+    # ケース1 正常系_書き込みごとに通知される
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "変更通知2",
+        "theme_type": "001",
+    })
+    await async_client.client.put("/mylist/title/1", json={"title": "変更通知更新"})
+    await async_client.client.delete("/mylist/2")
+    events = [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+    assert events == [
+        {"type": "created", "my_list_id": 2, "user_id": 1},
+        {"type": "updated", "my_list_id": 1, "user_id": 1},
+        {"type": "deleted", "my_list_id": 2, "user_id": 1},
+    ]
+    # 他のユーザーには通知されない
+    assert otherUser.queue.empty()
+
+    # ケース2 正常系_失敗した書き込み（コミットされない）は通知されない
+    await async_client.client.put("/mylist/title/3", json={"title": "存在しない"})
+    assert subscription.queue.empty()
+
+    # ケース3 正常系_キューが溢れた場合は再同期を促す通知に置き換わる
+    for _ in range(subscription.queue.maxsize + 1):
+        eventHub.publish(1, {"type": "updated", "my_list_id": 1})
+    assert subscription.queue.qsize() == 1
+    assert subscription.queue.get_nowait() == {"type": "resync", "user_id": 1}
+    eventHub.unsubscribe(subscription)
+    eventHub.unsubscribe(otherUser)
+
+    # ケース4 異常系_ユーザーごとの同時接続数の上限
+    subscriptions = [eventHub.subscribe(1) for _ in range(eventHub.max_subscribers)]
+    response = await async_client.client.get("/mylist/events/1")
+    assert response.status_code == starlette.status.HTTP_429_TOO_MANY_REQUESTS
+    for subscription in subscriptions:
+        eventHub.unsubscribe(subscription)
+
+    # ケース5 異常系_存在しないユーザー
+    response = await async_client.client.get("/mylist/events/2")
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+
+    # ケース6 正常系_SSE形式で送信され、終了時に購読解除される
+    class DummyRequest:
+        async def is_disconnected(self):
+            return False
+    hub = EventHub(eventHub.transport.__class__())
+    subscription = hub.subscribe(1)
+    stream = streamEvents(DummyRequest(), hub, subscription)
+    assert await stream.__anext__() == "retry: 3000\n\n"
+    hub.publish(1, {"type": "updated", "my_list_id": 1})
+    assert await stream.__anext__() == 'event: updated\ndata: {"type": "updated", "my_list_id": 1, "user_id": 1}\n\n'
+    await stream.aclose()
+    assert hub._subscribers == {}
+
+    # ケース7 正常系_Unixソケット経由で別ワーカーのハブにも配信される
+    worker1 = EventHub(UnixSocketTransport(str(tmp_path)))
+    worker2 = EventHub(UnixSocketTransport(str(tmp_path)))
+    await worker1.transport.start()
+    await worker2.transport.start()
+    subscription = worker2.subscribe(1)
+    worker1.publish(1, {"type": "created", "my_list_id": 1})
+    event = await asyncio.wait_for(subscription.queue.get(), timeout=1)
+    assert event == {"type": "created", "my_list_id": 1, "user_id": 1}
+    await worker1.transport.stop()
+    await worker2.transport.stop()
+
+    # ケース8 正常系_停止時にSSEの接続を終了し、新しい接続は受け付けない
+    hub = EventHub(eventHub.transport.__class__())
+    subscription = hub.subscribe(1)
+    stream = streamEvents(DummyRequest(), hub, subscription)
+    assert await stream.__anext__() == "retry: 3000\n\n"
+    hub.publish(1, {"type": "updated", "my_list_id": 1})
+    hub.close()
+    with pytest.raises(StopAsyncIteration):
+        await asyncio.wait_for(stream.__anext__(), timeout=1)
+    assert hub._subscribers == {}
+    with pytest.raises(HTTPException) as error:
+        hub.subscribe(1)
+    assert error.value.status_code == 503
+
+# 一括同期
+@pytest.mark.asyncio
+async def test_mylist_batch(async_client):
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "一括同期1",
+        "theme_type": "001",
+        "topic": {"topic" : ["話題１"]},
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "一括同期2",
+        "theme_type": "001",
+    })
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "別ユーザー",
+        "theme_type": "001",
+    })
+
+    # ケース1 正常系_作成・更新・削除をまとめて適用（仮IDでの参照を含む）
+    response = await async_client.client.post("/mylist/batch", json={
+        "user_id": 1,
+        "operations": [
+            {"op": "create", "temp_id": "a", "title": "新規A", "theme_type": "002"},
+            {"op": "update", "temp_id": "a", "topic": {"topic": ["話題A"]}},
+            {"op": "create", "temp_id": "b", "title": "新規B", "theme_type": "002"},
+            {"op": "delete", "temp_id": "b"},
+            {"op": "update", "my_list_id": 1, "title": "一括同期1更新", "is_private": True},
+            {"op": "delete", "my_list_id": 2},
+            {"op": "delete", "my_list_id": 2},
+            {"op": "update", "my_list_id": 3, "title": "他人のマイリスト"},
+            {"op": "create", "temp_id": "a", "title": "重複", "theme_type": "002"},
+        ]
+    })
+    assert response.status_code == starlette.status.HTTP_200_OK
+    response_obj = response.json()
+    assert response_obj["id_map"] == {"a": 4}
+    assert [(result["status"], result["my_list_id"]) for result in response_obj["results"]] == [
+        ("ok", 4), ("ok", 4), ("ok", None), ("ok", None), ("ok", 1), ("ok", 2),
+        ("error", 2), ("error", 3), ("error", None),
+    ]
+    assert response_obj["results"][6]["detail"] == "Mylist with id 2 not found"
+    assert response_obj["results"][8]["detail"] == "temp_id a is already used"
+
+    response = await async_client.client.get("/mylist/retrieve/all/1")
+    assert response.json() == [
+        {
+            "my_list_id": 1,
+            "title": "一括同期1更新",
+            "theme_type": "001",
+            "topic": {"topic" : ["話題１"]},
+            "is_private": True
+        },
+        {
+            "my_list_id": 4,
+            "title": "新規A",
+            "theme_type": "002",
+            "topic": {"topic" : ["話題A"]},
+            "is_private": False
+        },
+    ]
+    # 他のユーザーのマイリストは変更されない
+    response = await async_client.client.get("/mylist/retrieve/all/2")
+    assert response.json()[0]["title"] == "別ユーザー"
+    # 削除は差分同期で通知される
+    response = await async_client.client.get("/mylist/changes/1", params={"since": (datetime.now() - timedelta(hours=1)).isoformat()})
+    assert response.json()["deleted"] == [2]
+
+    # ケース2 異常系_createにtemp_idがない
+    response = await async_client.client.post("/mylist/batch", json={
+        "user_id": 1,
+        "operations": [{"op": "create", "title": "新規", "theme_type": "002"}]
+    })
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # ケース3 異常系_update対象の指定がない
+    response = await async_client.client.post("/mylist/batch", json={
+        "user_id": 1,
+        "operations": [{"op": "update", "title": "更新"}]
+    })
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # ケース4 異常系_存在しないユーザー
+    response = await async_client.client.post("/mylist/batch", json={
+        "user_id": 9,
+        "operations": [{"op": "delete", "my_list_id": 1}]
+    })
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+
+# 作成系のIdempotency-Key
+@pytest.mark.asyncio
+async def test_mylist_idempotency(async_client):
+    # ケース1 正常系_同じキーで再送しても作成は一度だけ
+    first = await async_client.client.post("/mylist/create-user", json={
+        "title": "冪等性テスト",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-1"})
+    assert first.status_code == starlette.status.HTTP_200_OK
+    second = await async_client.client.post("/mylist/create-user", json={
+        "title": "冪等性テスト",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-1"})
+    assert second.status_code == starlette.status.HTTP_200_OK
+    assert second.json() == first.json()
+    users = await async_client.dbsession.execute(select(user_model.User))
+    assert len(users.all()) == 1
+    await async_client.dbsession.close()
+
+    # ケース2 正常系_プロセス内のキャッシュがなくてもDBの記録から同じレスポンスを返す（端末のトークンはDBに保存しないため返さない）
+    async_client.app.state.context.idempotencyCache.clear()
+    third = await async_client.client.post("/mylist/create-user", json={
+        "title": "冪等性テスト",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-1"})
+    assert third.json() == {**first.json(), "device_token": None}
+
+    # ケース3 正常系_同じキーでもエンドポイントが違えば別のリクエスト
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "冪等性テスト2",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-1"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json()["my_list_id"] == 2
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "冪等性テスト2",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-1"})
+    assert response.json()["my_list_id"] == 2
+
+    # ケース4 正常系_キーなしの場合は毎回作成される
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "冪等性テスト3",
+        "theme_type": "001",
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "冪等性テスト3",
+        "theme_type": "001",
+    })
+    response = await async_client.client.get("/mylist/retrieve/all/1")
+    assert len(response.json()) == 4
+
+    # ケース5 異常系_失敗したリクエストは記録されず、同じキーで再試行できる
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 2,
+        "title": "冪等性テスト4",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-2"})
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "冪等性テスト4",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-2"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json()["title"] == "冪等性テスト4"
+
+    # ケース6 異常系_処理中のキーでの再送
+    body = {"user_id": 1, "title": "冪等性テスト5", "theme_type": "001"}
+    async_client.dbsession.add(idempotency_model.IdempotencyKey(
+        endpoint="mylist/create", idempotency_key="key-3",
+        request_hash=idempotency_crud.requestHash(mylistSchema.createMylistParam(**body)), created_at=datetime.now()
+    ))
+    await async_client.dbsession.commit()
+    await async_client.dbsession.close()
+    response = await async_client.client.post("/mylist/create", json=body, headers={"Idempotency-Key": "key-3"})
+    assert response.status_code == starlette.status.HTTP_409_CONFLICT
+
+    # ケース7 異常系_別のユーザーが同じキーを送信（他のユーザーのマイリストを返さない）
+    response = await async_client.client.post("/mylist/create-user", json={
+        "title": "冪等性テスト6",
+        "theme_type": "001",
+    })
+    otherUserId = response.json()["user_id"]
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "非公開のリスト",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-4"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    for _ in range(2):
+        # キャッシュとDBの記録のどちらでも拒否する
+        response = await async_client.client.post("/mylist/create", json={
+            "user_id": otherUserId,
+            "title": "非公開のリスト",
+            "theme_type": "001",
+        }, headers={"Idempotency-Key": "key-4"})
+        assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+        async_client.app.state.context.idempotencyCache.clear()
+
+    # ケース8 異常系_同じユーザーが同じキーで内容の異なるリクエストを送信
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "別のタイトル",
+        "theme_type": "001",
+    }, headers={"Idempotency-Key": "key-4"})
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # ケース9 正常系_端末のトークンはDBの記録に保存せず、プロセス内のキャッシュからのみ再送する
+    body = {"title": "冪等性テスト9", "theme_type": "001"}
+    first = await async_client.client.post("/mylist/create-user", json=body, headers={"Idempotency-Key": "key-5"})
+    assert first.status_code == starlette.status.HTTP_200_OK
+    token = first.json()["device_token"]
+    record = await async_client.dbsession.get(idempotency_model.IdempotencyKey, ("mylist/create-user", "key-5"))
+    assert "device_token" not in record.response
+    assert token not in json.dumps(record.response)
+    await async_client.dbsession.close()
+    response = await async_client.client.post("/mylist/create-user", json=body, headers={"Idempotency-Key": "key-5"})
+    assert response.json() == first.json()
+    async_client.app.state.context.idempotencyCache.clear()
+    response = await async_client.client.post("/mylist/create-user", json=body, headers={"Idempotency-Key": "key-5"})
+    assert response.json() == {**first.json(), "device_token": None}
+
+# マイリスト集計
+@pytest.mark.asyncio
+async def test_mylist_summary(async_client):
+    # ケース1 異常系_存在しないユーザー
+    response = await async_client.client.get("/mylist/summary/1")
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+    assert response.json() == {
+        "detail": "User with id 1 not found"
+    }
+
+    # ケース2 正常系_作成時に集計される
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "集計1",
+        "theme_type": "001",
+        "topic": {"topic" : ["話題１", "話題２"]},
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "集計2",
+        "theme_type": "002",
+        "topic": {"topic" : ["話題１"]},
+        "is_private": True
+    })
+    response = await async_client.client.get("/mylist/summary/1")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json() == {
+        "user_id": 1,
+        "list_count": 2,
+        "public_count": 1,
+        "private_count": 1,
+        "topic_count": 3,
+        "theme_histogram": {"001": 1, "002": 1}
+    }
+
+    # ケース3 正常系_更新・削除・一括同期が反映される
+    await async_client.client.put("/mylist/theme/1", json={"theme_type": "002"})
+    await async_client.client.put("/mylist/topic/1", json={"topic": {"topic": ["話題１", "話題２", "話題３"]}})
+    await async_client.client.put("/mylist/privateflag/2", json={"is_private": False})
+    await async_client.client.post("/mylist/batch", json={
+        "user_id": 1,
+        "operations": [
+            {"op": "create", "temp_id": "a", "title": "集計3", "theme_type": "003", "topic": {"topic": ["話題１"]}},
+            {"op": "update", "my_list_id": 2, "topic": {"topic": []}},
+        ]
+    })
+    await async_client.client.delete("/mylist/1")
+    expected = {
+        "user_id": 1,
+        "list_count": 2,
+        "public_count": 2,
+        "private_count": 0,
+        "topic_count": 1,
+        "theme_histogram": {"002": 1, "003": 1}
+    }
+    response = await async_client.client.get("/mylist/summary/1")
+    assert response.json() == expected
+
+    # ケース4 正常系_再集計しても差分更新の結果と一致する
+    summary = await summary_crud.rebuildUserSummary(async_client.dbsession, 1)
+    assert summary_crud.toResponse(summary).dict() == expected
+    await async_client.dbsession.rollback()
+    await async_client.dbsession.close()
+
+    # ケース5 正常系_集計がないユーザーはその場で再集計される
+    await async_client.dbsession.execute(delete(user_model.UserSummary))
+    await async_client.dbsession.commit()
+    await async_client.dbsession.close()
+    response = await async_client.client.get("/mylist/summary/1")
+    assert response.json() == expected
+    await async_client.client.delete("/mylist/2")
+    response = await async_client.client.get("/mylist/summary/1")
+    assert response.json()["list_count"] == 1
+
+    # ケース6 正常系_定期実行の再集計でずれが補正される
+    await async_client.client.post("/mylist/create-user", json={"title": "集計4", "theme_type": "001"})
+    summary = await async_client.dbsession.get(user_model.UserSummary, 1)
+    summary.list_count = 99
+    await async_client.dbsession.commit()
+    await rebuild_summary(async_client.app.state.engine, batch_size=1)
+    await async_client.dbsession.close()
+    response = await async_client.client.get("/mylist/summary/1")
+    assert response.json()["list_count"] == 1
+    response = await async_client.client.get("/mylist/summary/2")
+    assert response.json()["list_count"] == 1
+
+# 項目を指定したマイリスト取得
+@pytest.mark.asyncio
+async def test_mylist_retrieve_fields(async_client):
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "項目指定1",
+        "theme_type": "001",
+        "topic": {"topic" : ["話題１", "話題２"]},
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "項目指定2",
+        "theme_type": "002",
+        "is_private": True
+    })
+
+    # ケース1 正常系_指定した項目とトピック数のみ
+    response = await async_client.client.get("/mylist/retrieve/all/1?fields=my_list_id,title,topic_count")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json() == [
+        {"my_list_id": 1, "title": "項目指定1", "topic_count": 2},
+        {"my_list_id": 2, "title": "項目指定2", "topic_count": 0},
+    ]
+
+    # ケース2 正常系_全項目を指定（空白・重複は無視）
+    response = await async_client.client.get("/mylist/retrieve/all/1?fields=my_list_id, theme_type,topic,is_private,is_private")
+    assert response.json()[1] == {"my_list_id": 2, "theme_type": "002", "topic": {"topic": []}, "is_private": True}
+
+    # ケース3 正常系_指定しない場合は従来通り
+    response = await async_client.client.get("/mylist/retrieve/all/1")
+    assert len(response.json()[0]) == 5
+
+    # ケース4 異常系_存在しない項目
+    response = await async_client.client.get("/mylist/retrieve/all/1?fields=title,user_id")
+    assert response.status_code == starlette.status.HTTP_400_BAD_REQUEST
+    assert response.json() == {"detail": "Invalid fields: user_id"}
+
+    # ケース5 異常系_項目が空
+    response = await async_client.client.get("/mylist/retrieve/all/1?fields=,")
+    assert response.status_code == starlette.status.HTTP_400_BAD_REQUEST
+
+    # ケース6 異常系_存在しないユーザー
+    response = await async_client.client.get("/mylist/retrieve/all/3?fields=title")
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+
+    # ケース7 正常系_OpenAPIのスキーマに両方のレスポンスが記載される
+    response = await async_client.client.get("/openapi.json")
+    schema = response.json()["paths"]["/mylist/retrieve/all/{user_id}"]["get"]["responses"]["200"]["content"]["application/json"]["schema"]
+    assert [option["items"]["$ref"] for option in schema["anyOf"]] == ["#/components/schemas/Mylist", "#/components/schemas/MylistFields"]
+
+# トピック数での並び替え・絞り込み
+@pytest.mark.asyncio
+async def test_mylist_retrieve_topic_count(async_client):
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "トピック2件",
+        "theme_type": "001",
+        "topic": {"topic" : ["話題１", "話題２"]},
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "トピックなし",
+        "theme_type": "001",
+    })
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 1,
+        "title": "トピック1件",
+        "theme_type": "001",
+        "topic": {"topic" : ["話題１"]},
+    })
+
+    # ケース1 正常系_作成時にトピック数が保存される
+    original = await mylist_crud.getMylistById(async_client.dbsession, mylist_id=1)
+    assert original.topic_count == 2
+    await async_client.dbsession.close()
+
+    # ケース2 正常系_トピック数の降順・昇順
+    response = await async_client.client.get("/mylist/retrieve/all/1?sort=-topic_count&fields=my_list_id,topic_count")
+    assert response.json() == [
+        {"my_list_id": 1, "topic_count": 2},
+        {"my_list_id": 3, "topic_count": 1},
+        {"my_list_id": 2, "topic_count": 0},
+    ]
+    response = await async_client.client.get("/mylist/retrieve/all/1?sort=topic_count")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [2, 3, 1]
+
+    # ケース3 正常系_トピック更新後はトピック数も更新される
+    await async_client.client.put("/mylist/topic/2", json={"topic": {"topic": ["話題１", "話題２", "話題３"]}})
+    response = await async_client.client.get("/mylist/retrieve/all/1?sort=-topic_count")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [2, 1, 3]
+
+    # ケース4 正常系_トピック数の範囲で絞り込み
+    response = await async_client.client.get("/mylist/retrieve/all/1?min_topics=1&max_topics=2")
+    assert [mylist["my_list_id"] for mylist in response.json()] == [1, 3]
+
+    # ケース5 異常系_不正な並び順
+    response = await async_client.client.get("/mylist/retrieve/all/1?sort=title")
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    # ケース6 異常系_負のトピック数
+    response = await async_client.client.get("/mylist/retrieve/all/1?min_topics=-1")
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+
+# 【正常系】バックグラウンド処理
+@pytest.mark.asyncio
+async def test_background_executor(async_client):
+    executor = BackgroundExecutor(workers=1, queue_size=2, direct_limit=1)
+    order = []
+    gate = asyncio.Event()
+
+    async def blocker():
+        await gate.wait()
+
+    async def record(name):
+        order.append(name)
+
+    # ケース１ 優先度の高いタスクから実行する
+    await executor.start()
+    assert executor.submit(blocker) is True
+    await asyncio.sleep(0)
+    assert executor.submit(record, "low", priority=Priority.LOW) is True
+    assert executor.submit(record, "high", priority=Priority.HIGH) is True
+    assert executor.depth() == 2
+
+    # ケース２ キューが一杯の場合、LOWは破棄し、それ以外は上限までその場で実行する（上限を超えたら破棄する）
+    assert executor.submit(record, "dropped", priority=Priority.LOW) is False
+    assert executor.submit(record, "direct", priority=Priority.NORMAL) is False
+    assert executor.submit(record, "rejected", priority=Priority.HIGH) is False
+    await asyncio.sleep(0)
+    assert order == ["direct"]
+    assert metrics.value("background_tasks_total", status="rejected", priority="HIGH") == 1
+
+    # ケース３ 停止時にキューに残ったタスクを実行し終える
+    gate.set()
+    await executor.stop()
+    assert order == ["direct", "high", "low"]
+    assert executor.running is False
+
+    # ケース４ メトリクスを公開する
+    response = await async_client.client.get("/metrics")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert 'background_tasks_total{priority="LOW",status="dropped"}' in response.text
+    assert "background_queue_depth 0" in response.text
+    assert "background_task_run_seconds_count" in response.text
+
+    # ケース５ 期限切れの冪等キーの記録を削除する
+    now = datetime.now()
+    async_client.dbsession.add_all([
+        idempotency_model.IdempotencyKey(endpoint="create", idempotency_key="old", request_hash="", created_at=now - timedelta(days=2)),
+        idempotency_model.IdempotencyKey(endpoint="create", idempotency_key="new", request_hash="", created_at=now),
+    ])
+    await async_client.dbsession.commit()
+    await idempotency_crud.purgeExpired(async_client.dbsession)
+    keys = (await async_client.dbsession.execute(select(idempotency_model.IdempotencyKey.idempotency_key))).scalars().all()
+    assert keys == ["new"]
+
+# 【正常系】キュー経由のログ出力
+@pytest.mark.asyncio
+async def test_queue_logging(async_client):
+    class CollectingHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.records = []
+            self.threads = set()
+
+        def emit(self, record):
+            self.records.append(record.getMessage())
+            self.threads.add(threading.get_ident())
+
+    logger = logging.getLogger("test.queuelogging")
+    logger.propagate = False
+    handler = CollectingHandler()
+    logger.handlers = [handler]
+    queueLogging = QueueLogging(loggerNames=("test.queuelogging",))
+    queueLogging.start()
+    try:
+        # ケース１ 書き込みはイベントループとは別のスレッドで行う
+        logger.error("Mylist with id %s not found", 1)
+        # ケース２ 同じテンプレートのエラーは件数を制限する（値が違っても同じテンプレートとして扱う）
+        for i in range(2, 20):
+            logger.error("Mylist with id %s not found", i)
+        # ケース３ 別のテンプレートは制限されない
+        logger.error("Auth with id %s not found", 1)
+    finally:
+        queueLogging.stop()
+    assert threading.get_ident() not in handler.threads
+    assert handler.records == [f"Mylist with id {i} not found" for i in range(1, 6)] + ["Auth with id 1 not found"]
+    assert logger.handlers == [handler]
+    assert metrics.value("log_records_suppressed_total", level="ERROR") >= 14
+
+    # ケース４ 期間が過ぎたら、抑制した件数を付記して再び出力する
+    rateLimit = RateLimitFilter(burst=1, interval=0.05)
+    records = [logger.makeRecord(logger.name, logging.ERROR, __file__, 0, "Mylist with id %s not found", (i,), None) for i in range(3)]
+    assert rateLimit.filter(records[0]) is True
+    assert rateLimit.filter(records[1]) is False
+    await asyncio.sleep(0.06)
+    assert rateLimit.filter(records[2]) is True
+    assert records[2].getMessage() == "Mylist with id 2 not found (suppressed 1 similar messages)"
+
+# 【正常系】アプリケーションの起動・停止
+@pytest.mark.asyncio
+async def test_app_lifecycle(async_client, tmp_path):
+    # ケース１ 同一プロセス内のアプリケーションはそれぞれ別のDBに接続する
+    other = create_app(Settings(db_url=ASYNC_DB_URL, db_warmup_connections=1, event_socket_dir=str(tmp_path)))
+    await other.router.startup()
+    async with other.state.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    response = await async_client.client.post("/mylist/create-user", json={"title": "アプリ1", "theme_type": "001"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    async with AsyncClient(app=other, base_url="http://test") as client:
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+        response = await client.post("/mylist/create-user", json={"title": "アプリ2", "theme_type": "001"})
+        assert response.json()["my_list_id"] == 1
+    response = await async_client.client.get("/mylist/retrieve/all/1")
+    assert [mylist["title"] for mylist in response.json()] == ["アプリ1"]
+
+    # ケース２ 停止時は処理中のリクエストの完了を待ってから接続を閉じる
+    assert other.state.inFlight.count == 0
+    pool = other.state.engine.pool
+    await other.router.shutdown()
+    # dispose()で接続プールが作り直されている
+    assert other.state.engine.pool is not pool
+
+    # ケース３ アプリケーションごとの設定で作成した状態を持ち、停止時は自分が作成したものだけを停止する
+    context = async_client.app.state.context
+    assert other.state.context.eventHub is not context.eventHub
+    assert other.state.context.eventHub.transport.directory == str(tmp_path)
+    assert os.listdir(tmp_path) == []
+    assert other.state.context.backgroundExecutor.running is False
+    assert context.backgroundExecutor.running is True
+    response = await async_client.client.post("/mylist/create", json={"user_id": 1, "title": "アプリ1-2", "theme_type": "001"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    response = await async_client.client.get("/mylist/feed/public")
+    assert [mylist["title"] for mylist in response.json()] == ["アプリ1-2", "アプリ1"]
+
+    # ケース４ 処理中のリクエストが終わらない場合はタイムアウトする
+    inFlight = InFlight()
+    inFlight.count = 1
+    assert await inFlight.drain(0.1) is False
+    asyncio.get_running_loop().call_later(0.05, lambda: setattr(inFlight, "count", 0))
+    assert await inFlight.drain(1) is True
+
+# 【正常系】起動時間が上限を超えていないこと
+def test_startup_budget():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-m", "api.profile_startup", "--json", "--top", "1000"],
+        cwd=root, capture_output=True, text=True, check=True
+    )
+    report = json.loads(result.stdout)
+    assert report["phases"]["import"] < profile_startup.IMPORT_BUDGET
+    assert report["phases"]["time_to_first_request"] < profile_startup.FIRST_REQUEST_BUDGET
+    assert report["modules"][0]["module"] == "api.main"
+    # ドライバや使用しない依存は読み込まない
+    modules = [module["module"] for module in report["modules"]]
+    for module in ["aiomysql", "pymysql", "passlib", "xmlrpc.client", "api.migrate_db", "uvicorn"]:
+        assert module not in modules
+
+# 【正常系】一覧取得の高速経路の計測（ORM経路と同じレスポンスを返す）
+def test_read_benchmark():
+    report = bench_reads.benchmark(rows=50, topics=3, repeat=2)
+    assert set(report["paths"]) == {"orm", "fast"}
+    assert report["paths"]["fast"]["bytes"] == report["paths"]["orm"]["bytes"] > 0
+    assert all(result["cpu_ms"] >= 0 and result["peak_kib"] > 0 for result in report["paths"].values())
+
+# 【正常系】流量制御
+@pytest.mark.asyncio
+async def test_admission_control(async_client):
+    limits = {RequestClass.READ: 2, RequestClass.WRITE: 1, RequestClass.HEAVY: 1}
+    controller = AdmissionController(capacity=2, limits=limits, queueSize=2, maxWait=1.0)
+
+    # ケース１ 上限まではすぐに受け付ける（更新は種類ごとの上限まで）
+    assert await controller.acquire(RequestClass.WRITE) is True
+    assert await controller.acquire(RequestClass.READ) is True
+    assert controller.active == 2
+
+    # ケース２ 空きができたら読み取りを更新より先に受け付ける
+    write = asyncio.create_task(controller.acquire(RequestClass.WRITE))
+    await asyncio.sleep(0)
+    read = asyncio.create_task(controller.acquire(RequestClass.READ))
+    await asyncio.sleep(0)
+    controller.release(RequestClass.READ)
+    assert await read is True
+    assert write.done() is False
+
+    # ケース３ 待ち行列が一杯の場合、優先度の低いリクエストを押し出す
+    heavy = asyncio.create_task(controller.acquire(RequestClass.HEAVY))
+    await asyncio.sleep(0)
+    assert await controller.acquire(RequestClass.HEAVY) is False
+    read2 = asyncio.create_task(controller.acquire(RequestClass.READ))
+    await asyncio.sleep(0)
+    assert await heavy is False
+    controller.release(RequestClass.WRITE)
+    await asyncio.sleep(0.01)
+    assert read2.done() is True and read2.result() is True
+    controller.release(RequestClass.READ)
+    assert await write is True
+    controller.release(RequestClass.READ)
+    controller.release(RequestClass.WRITE)
+    assert controller.active == 0
+
+    # ケース４ 待ち時間の上限を超えたら503を返す
+    admission = async_client.app.state.admission
+    admission.maxWait = 0.05
+    for _ in range(admission.capacity):
+        await admission.acquire(RequestClass.READ)
+    before = {result: metrics.value("admission_requests_total", result=result, request_class="READ") for result in ["admitted", "rejected"]}
+    queuedBefore = metrics.value("admission_queued_total", request_class="READ")
+    response = await async_client.client.get("/mylist/feed/public")
+    assert response.status_code == starlette.status.HTTP_503_SERVICE_UNAVAILABLE
+    # 待ち行列に入ったリクエストも結果は1回だけ数える
+    assert metrics.value("admission_requests_total", result="rejected", request_class="READ") == before["rejected"] + 1
+    assert metrics.value("admission_requests_total", result="admitted", request_class="READ") == before["admitted"]
+    assert metrics.value("admission_queued_total", request_class="READ") == queuedBefore + 1
+    assert response.headers["Retry-After"] == "1"
+    # DB接続を使わないパスは対象外
+    response = await async_client.client.get("/metrics")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert 'admission_requests_total{request_class="READ",result="rejected"}' in response.text
+    for _ in range(admission.capacity):
+        admission.release(RequestClass.READ)
+    response = await async_client.client.get("/mylist/feed/public")
+    assert response.status_code == starlette.status.HTTP_200_OK
+
+# 【正常系】レート制限
+@pytest.mark.asyncio
+async def test_rate_limit(async_client, tmp_path):
+    app = create_app(Settings(db_url=ASYNC_DB_URL, db_warmup_connections=1))
+    await app.router.startup()
+    async with app.state.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        # ケース１ 同じ認証IDの試行は5回まで（認証と移行で共有する）
+        for _ in range(4):
+            response = await client.post("/auth/authenticate", json={"auth_id": 1, "auth_code": "abcdef"})
+            assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+        response = await client.post("/auth/migrate", json={"auth_id": 1, "auth_code": "abcdef", "from_user_id": 1, "from_device_token": "token"})
+        assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+        response = await client.post("/auth/authenticate", json={"auth_id": 1, "auth_code": "abcdef"})
+        assert response.status_code == starlette.status.HTTP_429_TOO_MANY_REQUESTS
+        assert int(response.headers["Retry-After"]) > 0
+        # ケース２ 別の認証IDは制限されない
+        response = await client.post("/auth/authenticate", json={"auth_id": 2, "auth_code": "abcdef"})
+        assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+        # 検証で同じ認証IDになる表記（"001"、1.0）も同じキーとして制限する
+        for auth_id in ["001", 1.0, " 1 "]:
+            response = await client.post("/auth/authenticate", json={"auth_id": auth_id, "auth_code": "abcdef"})
+            assert response.status_code == starlette.status.HTTP_429_TOO_MANY_REQUESTS
+        # 整数にできない値は拒否する
+        response = await client.post("/auth/authenticate", json={"auth_id": "1.0", "auth_code": "abcdef"})
+        assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+        # ケース３ キーを取得するためにボディを読み込んだリクエストも正しく処理される
+        response = await client.post("/mylist/create-user", json={"title": "レート制限", "theme_type": "001"})
+        assert response.status_code == starlette.status.HTTP_200_OK
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_200_OK
+    await app.router.shutdown()
+
+    # ケース４ 制限が解除されたキーは削除する
+    backend = MemoryBackend()
+    assert await backend.hit("user:1", rate=1000, burst=1) == (True, 0.0)
+    assert (await backend.hit("user:1", rate=1000, burst=1))[0] is False
+    await asyncio.sleep(0.01)
+    backend.sweep(datetime.now().timestamp())
+    assert len(backend._tats) == 0
+
+    # ケース５ 共有のストアでは複数ワーカーで状態を共有する
+    path = str(tmp_path / "ratelimit.db")
+    first, second = SqliteBackend(path), SqliteBackend(path)
+    assert (await first.hit("auth_id:1", rate=1 / 60, burst=2))[0] is True
+    assert (await second.hit("auth_id:1", rate=1 / 60, burst=2))[0] is True
+    allowed, retryAfter = await first.hit("auth_id:1", rate=1 / 60, burst=2)
+    assert allowed is False and 0 < retryAfter <= 60
+
+    # ケース６ ストアが使えない場合、総当たり対策の制限は受け付けない
+    class BrokenBackend:
+        async def hit(self, key, rate, burst):
+            return None
+
+    statuses = []
+
+    async def okApp(scope, receive, send):
+        await JSONResponse({})(scope, receive, send)
+
+    async def collect(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+    middleware = RateLimitMiddleware(okApp, BrokenBackend())
+    for path, body in [("/auth/authenticate", b'{"auth_id": 1}'), ("/mylist/create", b'{"user_id": 1}')]:
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return messages.pop(0) if messages else {"type": "http.disconnect"}
+        await middleware({"type": "http", "method": "POST", "path": path, "client": ("127.0.0.1", 0), "headers": []}, receive, collect)
+    assert statuses == [429, 200]
+
+# 【正常系】処理時間の上限とクライアント切断時のキャンセル
+@pytest.mark.asyncio
+async def test_deadline(async_client, monkeypatch):
+    monkeypatch.setitem(deadline.ROUTE_TIMEOUTS, RequestClass.READ, 0.05)
+    cancelled = []
+
+    async def slowApp(scope, receive, send):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(scope["path"])
+            raise
+
+    def request(path, disconnectAfter=None):
+        sent = []
+        received = []
+
+        async def receive():
+            if not received:
+                received.append(True)
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.sleep(disconnectAfter if disconnectAfter is not None else 10)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": path, "headers": [], "query_string": b""}
+        return scope, receive, send, sent
+
+    middleware = deadline.DeadlineMiddleware(slowApp)
+
+    # ケース１ 処理時間の上限を超えたらキャンセルして504を返す
+    timeouts = metrics.value("request_cancelled_total", reason="timeout")
+    scope, receive, send, sent = request("/mylist/feed/public")
+    await middleware(scope, receive, send)
+    assert cancelled == ["/mylist/feed/public"]
+    assert sent[0]["status"] == 504
+    assert scope["state"]["statement_timeout"] == 0.05
+    assert metrics.value("request_cancelled_total", reason="timeout") == timeouts + 1
+
+    # ケース２ クライアントが切断したらキャンセルする（レスポンスは返さない）
+    disconnects = metrics.value("request_cancelled_total", reason="disconnect")
+    scope, receive, send, sent = request("/mylist/summary/1", disconnectAfter=0.01)
+    await middleware(scope, receive, send)
+    assert cancelled == ["/mylist/feed/public", "/mylist/summary/1"]
+    assert sent == []
+    assert metrics.value("request_cancelled_total", reason="disconnect") == disconnects + 1
+
+    # ケース３ 受信が切断以外をすぐに返し続けても、ループを占有しない
+    async def fastApp(scope, receive, send):
+        await asyncio.sleep(0.01)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def busyReceive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    sent = []
+
+    async def collect(message):
+        sent.append(message)
+    await asyncio.wait_for(deadline.DeadlineMiddleware(fastApp)(
+        {"type": "http", "method": "GET", "path": "/mylist/feed/public", "headers": []}, busyReceive, collect
+    ), 1)
+    assert sent[0]["status"] == 200
+
+    # ケース４ キャンセルされたリクエストのDB接続は破棄する
+    app = create_app(Settings(db_url=ASYNC_DB_URL, db_warmup_connections=1))
+    await app.router.startup()
+    invalidated = metrics.value("db_connections_invalidated_total")
+    dependency = get_db(Request({"type": "http", "app": app, "state": {"statement_timeout": 5.0}}))
+    session = await dependency.__anext__()
+    assert session.sync_session.info["statement_timeout"] == 5.0
+    await session.execute(select(1))
+    raw = (await session.connection()).sync_connection.connection.dbapi_connection
+    with pytest.raises(asyncio.CancelledError):
+        await dependency.athrow(asyncio.CancelledError())
+    # プールに戻さずに破棄し、次は新しい接続を使う
+    async with app.state.engine.connect() as conn:
+        assert (await conn.get_raw_connection()).dbapi_connection is not raw
+    assert metrics.value("db_connections_invalidated_total") == invalidated + 1
+    await app.router.shutdown()
+
+# 【正常系】DBセッションの遅延取得と早期返却
+@pytest.mark.asyncio
+async def test_lazy_session(async_client):
+    # ケース１ DBを使わずに返すリクエスト（バリデーションエラー）ではセッションを作成しない
+    opened = metrics.value("db_sessions_opened_total")
+    response = await async_client.client.get("/mylist/retrieve/all/不正")
+    assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert metrics.value("db_sessions_opened_total") == opened
+
+    # ケース２ DBを使うリクエストでは作成し、接続の保持時間を計測する
+    holds = metrics.summary("db_connection_hold_seconds")[0]
+    response = await async_client.client.get("/mylist/feed/public")
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert metrics.value("db_sessions_opened_total") == opened + 1
+    assert metrics.summary("db_connection_hold_seconds")[0] > holds
+
+    # ケース３ レスポンスのシリアライズ前に接続を返す
+    app = FastAPI()
+    app.state.sessionFactory = async_client.app.state.sessionFactory
+    router = APIRouter(route_class=UnitOfWorkRoute)
+    inTransaction = []
+
+    class Probe:
+        @property
+        def value(self):
+            inTransaction.append(session.in_transaction())
+            return 1
+
+    class ProbeResponse(BaseModel):
+        value: int
+
+        class Config:
+            orm_mode = True
+
+    @router.get("/probe", response_model=ProbeResponse)
+    async def probe(db=Depends(get_db)):
+        nonlocal session
+        session = db
+        await db.execute(select(1))
+        assert db.in_transaction()
+        return Probe()
+    session = None
+    app.include_router(router)
+    async with AsyncClient(app=app, base_url="http://test") as client:
+        response = await client.get("/probe")
+    assert response.json() == {"value": 1}
+    assert inTransaction == [False]
+
+# 【正常系】リクエスト単位のトランザクション（コミットは1回、コミット後に読み直さない）
+@pytest.mark.asyncio
+async def test_unit_of_work(async_client):
+    counts = {"statements": 0, "commits": 0}
+
+    def countStatement(*args):
+        counts["statements"] += 1
+
+    def countCommit(*args):
+        counts["commits"] += 1
+    engine = async_client.app.state.engine.sync_engine
+    event.listen(engine, "before_cursor_execute", countStatement)
+    event.listen(engine, "commit", countCommit)
+
+    # ケース１ エンドポイントごとの文の数とコミット数（コミット後のrefreshのSELECTを発行しない）
+    calls = [
+        ("post", "/mylist/create-user", {"json": {"title": "作成", "theme_type": "001"}}, 3, 1),
+        ("post", "/mylist/create", {"json": {"user_id": 1, "title": "作成2", "theme_type": "001"}}, 4, 1),
+        ("post", "/mylist/create", {"json": {"user_id": 1, "title": "作成3", "theme_type": "001"}, "headers": {"Idempotency-Key": "uow"}}, 7, 1),
+        ("put", "/mylist/title/1", {"json": {"title": "更新"}}, 2, 1),
+        ("delete", "/mylist/2", {}, 5, 1),
+        ("post", "/auth/create", {"json": {"user_id": 1}}, 3, 1),
+        # 読み取りのみの場合はコミットしない
+        ("get", "/mylist/retrieve/all/1", {}, 2, 0),
+    ]
+    for method, path, kwargs, statements, commits in calls:
+        counts.update(statements=0, commits=0)
+        response = await getattr(async_client.client, method)(path, **kwargs)
+        assert response.status_code == starlette.status.HTTP_200_OK
+        assert (path, counts["statements"], counts["commits"]) == (path, statements, commits)
+
+    # ケース２ 例外の場合はコミットせず、途中の書き込み（冪等キーの予約）もロールバックする
+    counts.update(statements=0, commits=0)
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 9, "title": "存在しない", "theme_type": "001"
+    }, headers={"Idempotency-Key": "uow-404"})
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+    assert counts["commits"] == 0
+    assert await async_client.dbsession.get(idempotency_model.IdempotencyKey, ("mylist/create", "uow-404")) is None
+    event.remove(engine, "before_cursor_execute", countStatement)
+    event.remove(engine, "commit", countCommit)
+
+    # ケース３ コミットの開始後にキャンセルされても、コミットとコミット後の処理を終えてからキャンセルを伝える
+    session = LazySession(async_client.app.state.sessionFactory, {})
+    session.add(user_model.User(created_at=datetime.now(), updated_at=datetime.now()))
+    callbacks = []
+    common.afterCommit(session, lambda: callbacks.append("after_commit"))
+    commit = session.session.commit
+
+    async def slowCommit():
+        await asyncio.sleep(0.05)
+        await commit()
+    session.session.commit = slowCommit
+    task = asyncio.create_task(session.complete())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert callbacks == ["after_commit"]
+    assert session.session.in_transaction() is False
+    users = (await async_client.dbsession.execute(select(func.count()).select_from(user_model.User))).scalar()
+    assert users == 2
+
+# DBの障害を再現する（ドライバーでの文の実行を失敗させる、または遅延させる）
+# ブレーカーが開いている間は文を実行しないため呼ばれない。
+# matchを指定した場合はその文字列で始まる文だけ、remainingを指定した場合はその回数だけ失敗させる。
+class FaultInjector:
+    def __init__(self, engine):
+        self.mode = None
+        self.delay = 0.0
+        self.message = "injected failure"
+        self.match = None
+        self.remaining = None
+        self.calls = 0
+        for name in ("do_execute", "do_execute_no_params", "do_executemany"):
+            event.listen(engine, name, self._inject)
+        event.listen(engine, "do_connect", self._injectConnect)
+
+    # 接続の作成も失敗させる（文を指定していない場合のみ）
+    def _injectConnect(self, dialect, connection_record, cargs, cparams):
+        if self.mode == "fail" and self.match is None:
+            self.calls += 1
+            raise sqlite3.OperationalError("injected connection failure")
+
+    def _inject(self, cursor, statement, *args):
+        self.calls += 1
+        if self.match is not None and not statement.startswith(self.match):
+            return
+        if self.mode == "fail" and self.remaining != 0:
+            if self.remaining is not None:
+                self.remaining -= 1
+            raise sqlite3.OperationalError(self.message)
+        if self.mode == "slow":
+            time.sleep(self.delay)
+
+# 【正常系】DBの障害時のサーキットブレーカー
+@pytest.mark.asyncio
+async def test_circuit_breaker(async_client, tmp_path):
+    app = create_app(Settings(
+        db_url=ASYNC_DB_URL, db_warmup_connections=1, rate_limit_enabled=False, response_cache_enabled=False,
+        db_circuit_failure_threshold=2, db_circuit_slow_threshold=0.05, db_circuit_reset_timeout=0.2
+    ))
+    await app.router.startup()
+    async with app.state.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    breaker = app.state.circuitBreaker
+    faults = FaultInjector(app.state.engine.sync_engine)
+    opened = metrics.value("db_circuit_transitions_total", from_state="CLOSED", to_state="OPEN")
+    reopened = metrics.value("db_circuit_transitions_total", from_state="HALF_OPEN", to_state="OPEN")
+    rejected = metrics.value("db_circuit_rejected_total")
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/mylist/create-user", json={"title": "障害", "theme_type": "001"})
+        assert response.status_code == starlette.status.HTTP_200_OK
+
+        # ケース１ 連続して失敗したら開く
+        faults.mode = "fail"
+        for _ in range(2):
+            response = await client.get("/mylist/retrieve/all/1")
+            assert response.status_code == starlette.status.HTTP_500_INTERNAL_SERVER_ERROR
+        assert breaker.state == CircuitState.OPEN
+
+        # ケース２ 開いている間はDBに問い合わせずに503を返す
+        calls = faults.calls
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_503_SERVICE_UNAVAILABLE
+        assert int(response.headers["Retry-After"]) >= 1
+        assert faults.calls == calls
+
+        # ケース３ 一定時間後の試行が成功したら閉じる
+        faults.mode = None
+        await asyncio.sleep(0.25)
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_200_OK
+        assert breaker.state == CircuitState.CLOSED
+
+        # ケース４ 遅延も失敗として数える
+        faults.mode, faults.delay = "slow", 0.06
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_200_OK
+        assert breaker.state == CircuitState.OPEN
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_503_SERVICE_UNAVAILABLE
+
+        # ケース５ 試行が失敗したら再び開く
+        faults.mode = "fail"
+        await asyncio.sleep(0.25)
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_500_INTERNAL_SERVER_ERROR
+        assert breaker.state == CircuitState.OPEN
+    faults.mode = None
+    await app.router.shutdown()
+
+    # ケース６ 状態の遷移と拒否した数を記録する
+    assert metrics.value("db_circuit_transitions_total", from_state="CLOSED", to_state="OPEN") == opened + 2
+    assert metrics.value("db_circuit_transitions_total", from_state="HALF_OPEN", to_state="OPEN") == reopened + 1
+    assert metrics.value("db_circuit_rejected_total") == rejected + 2
+
+    # ケース７ リクエストごとに接続を作成する場合（NullPool）も、試行のリクエストで閉じる
+    app = create_app(Settings(
+        db_url=f"sqlite+aiosqlite:///{tmp_path / 'circuit.db'}", db_warmup_connections=1, rate_limit_enabled=False,
+        response_cache_enabled=False, db_circuit_failure_threshold=2, db_circuit_reset_timeout=0.2
+    ))
+    await app.router.startup()
+    async with app.state.engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    breaker = app.state.circuitBreaker
+    faults = FaultInjector(app.state.engine.sync_engine)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/mylist/create-user", json={"title": "再接続", "theme_type": "001"})
+        assert response.status_code == starlette.status.HTTP_200_OK
+        # 接続の失敗で開き、開いている間は接続も作成しない
+        faults.mode = "fail"
+        for _ in range(2):
+            response = await client.get("/mylist/retrieve/all/1")
+            assert response.status_code == starlette.status.HTTP_500_INTERNAL_SERVER_ERROR
+        assert breaker.state == CircuitState.OPEN
+        calls = faults.calls
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_503_SERVICE_UNAVAILABLE
+        assert faults.calls == calls
+        faults.mode = None
+        await asyncio.sleep(0.25)
+        response = await client.get("/mylist/retrieve/all/1")
+        assert response.status_code == starlette.status.HTTP_200_OK
+        assert breaker.state == CircuitState.CLOSED
+    await app.router.shutdown()
+
+# 【正常系】デッドロック・ロック待ちで失敗した書き込みのトランザクションの再実行
+@pytest.mark.asyncio
+async def test_retry_transaction(async_client):
+    faults = FaultInjector(async_client.app.state.engine.sync_engine)
+    transport = httpx.ASGITransport(app=async_client.app, raise_app_exceptions=False)
+
+    async def countMylists():
+        return (await async_client.dbsession.execute(select(func.count()).select_from(mylist_model.MyList))).scalar()
+    response = await async_client.client.post("/mylist/create-user", json={"title": "再実行", "theme_type": "001"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    retried = metrics.value("db_retries_total", reason="locked")
+    gaveUp = metrics.value("db_retry_giveups_total", reason="locked", cause="attempts")
+    faults.mode, faults.message, faults.match = "fail", "database is locked", "INSERT INTO my_list "
+
+    # ケース１ 冪等キーの予約を含めてトランザクション全体を再実行し、1件だけ作成する
+    faults.remaining = 2
+    response = await async_client.client.post("/mylist/create", json={
+        "user_id": 1, "title": "再実行2", "theme_type": "001"
+    }, headers={"Idempotency-Key": "retry"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert await countMylists() == 2
+    record = await async_client.dbsession.get(idempotency_model.IdempotencyKey, ("mylist/create", "retry"))
+    assert record.response["my_list_id"] == response.json()["my_list_id"]
+    assert metrics.value("db_retries_total", reason="locked") == retried + 2
+
+    # ケース２ 回数の上限を超えたら諦め、何も書き込まない
+    faults.remaining = 3
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/mylist/create", json={
+            "user_id": 1, "title": "再実行3", "theme_type": "001"
+        }, headers={"Idempotency-Key": "retry-2"})
+    assert response.status_code == starlette.status.HTTP_500_INTERNAL_SERVER_ERROR
+    assert await countMylists() == 2
+    assert await async_client.dbsession.get(idempotency_model.IdempotencyKey, ("mylist/create", "retry-2")) is None
+    assert metrics.value("db_retry_giveups_total", reason="locked", cause="attempts") == gaveUp + 1
+
+    # ケース３ 再実行しても解消しないエラーは再実行しない
+    faults.remaining, faults.message = 1, "injected failure"
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/mylist/create", json={"user_id": 1, "title": "再実行4", "theme_type": "001"})
+    assert response.status_code == starlette.status.HTTP_500_INTERNAL_SERVER_ERROR
+    assert metrics.value("db_retries_total", reason="locked") == retried + 4
+    faults.mode = None
+
+    # ケース４ 再実行は実行回数の一定の割合まで
+    budget = RetryBudget(ratio=0.5, maxTokens=1)
+    assert budget.withdraw() is True
+    assert budget.withdraw() is False
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw() is True
+
+# 【正常系】マイリスト取得のレスポンスのキャッシュ
+@pytest.mark.asyncio
+async def test_response_cache(async_client):
+    counts = {"statements": 0}
+
+    def countStatement(*args):
+        counts["statements"] += 1
+    engine = async_client.app.state.engine.sync_engine
+    event.listen(engine, "before_cursor_execute", countStatement)
+    for title in ["キャッシュ", "別のユーザー"]:
+        response = await async_client.client.post("/mylist/create-user", json={"title": title, "theme_type": "001"})
+        assert response.status_code == starlette.status.HTTP_200_OK
+
+    # ケース１ 2回目からはDBに問い合わせずに同じ内容を返す
+    first = await async_client.client.get("/mylist/retrieve/all/1")
+    assert first.headers["x-cache"] == "MISS"
+    counts["statements"] = 0
+    hits = metrics.value("response_cache_total", result="hit")
+    second = await async_client.client.get("/mylist/retrieve/all/1")
+    assert second.headers["x-cache"] == "HIT"
+    assert second.content == first.content
+    assert second.headers["content-type"] == "application/json"
+    assert counts["statements"] == 0
+    assert metrics.value("response_cache_total", result="hit") == hits + 1
+    # クエリ文字列が異なる場合は別のレスポンスとして保存する
+    response = await async_client.client.get("/mylist/retrieve/all/1?fields=title")
+    assert response.headers["x-cache"] == "MISS"
+    assert response.json() == [{"title": "キャッシュ"}]
+    response = await async_client.client.get("/mylist/retrieve/all/2")
+    assert response.headers["x-cache"] == "MISS"
+
+    # ケース２ 書き込みのコミット後に、そのユーザーのレスポンスだけを無効化する
+    response = await async_client.client.put("/mylist/title/1", json={"title": "更新"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    for path in ["/mylist/retrieve/all/1", "/mylist/retrieve/all/1?fields=title"]:
+        response = await async_client.client.get(path)
+        assert response.headers["x-cache"] == "MISS"
+        assert response.json()[0]["title"] == "更新"
+    response = await async_client.client.get("/mylist/retrieve/all/2")
+    assert response.headers["x-cache"] == "HIT"
+    response = await async_client.client.post("/mylist/create", json={"user_id": 2, "title": "追加", "theme_type": "001"})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    response = await async_client.client.get("/mylist/retrieve/all/2")
+    assert response.headers["x-cache"] == "MISS"
+    assert len(response.json()) == 2
+
+    # ケース３ 200以外のレスポンスは保存しない
+    for _ in range(2):
+        response = await async_client.client.get("/mylist/retrieve/all/1?sort=title")
+        assert response.status_code == starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+        assert response.headers["x-cache"] == "MISS"
+    event.remove(engine, "before_cursor_execute", countStatement)
+
+    # ケース４ 合計のバイト数を超えたら最も古いレスポンスから削除し、有効期間を過ぎたレスポンスは返さない
+    cache = ResponseCache(maxBytes=400, ttl=0.05)
+
+    def entry(tag):
+        return CacheEntry(200, [], b"x" * 100, tag, time.monotonic() + cache.ttl)
+    for key in ["a", "b", "c", "d"]:
+        assert cache.put(key, entry("user:1"), cache.version) is True
+    assert cache.get("a") is not None
+    assert cache.put("e", entry("user:2"), cache.version) is True
+    assert cache.get("b") is None and cache.get("a") is not None and cache.size == 400
+    # 容量の1/4を超えるレスポンスは保存しない
+    assert cache.put("f", CacheEntry(200, [], b"x" * 101, "user:2", time.monotonic() + 1), cache.version) is False
+    await asyncio.sleep(0.06)
+    assert cache.get("a") is None
+
+    # ケース５ 読み込み中に無効化されたユーザーのレスポンスは保存しない
+    version = cache.version
+    cache.invalidate("user:1")
+    assert cache.put("g", entry("user:1"), version) is False
+    assert cache.put("h", entry("user:2"), version) is True
+
+    # ケース６ アプリケーションごとに設定の容量・有効期間でキャッシュを作成し、そのアプリケーションの書き込みで無効化する
+    context = async_client.app.state.context
+    other = create_app(Settings(db_url=ASYNC_DB_URL, response_cache_max_bytes=1024, response_cache_ttl=5.0))
+    assert (other.state.context.responseCache.maxBytes, other.state.context.responseCache.ttl) == (1024, 5.0)
+    assert other.state.context.responseCache is not context.responseCache
+    assert other.state.context.invalidationBus.cache is other.state.context.responseCache
+    assert context.invalidationBus.cache is context.responseCache
+
+# 【正常系】ワーカー間のキャッシュの無効化
+@pytest.mark.asyncio
+async def test_invalidation_bus(tmp_path, monkeypatch):
+    monkeypatch.setattr(invalidation, "HEARTBEAT_INTERVAL", 0.05)
+    transports = [UnixSocketTransport(str(tmp_path)) for _ in range(2)]
+    caches = [ResponseCache() for _ in range(2)]
+    feeds = [PublicFeed() for _ in range(2)]
+    buses = [invalidation.InvalidationBus(transport, cache, feed) for transport, cache, feed in zip(transports, caches, feeds)]
+    for transport, bus in zip(transports, buses):
+        await transport.start()
+        await bus.start()
+
+    def put(cache, key, tag):
+        cache.put(key, CacheEntry(200, [], b"[]", tag, time.monotonic() + 60), cache.version)
+
+    async def waitUntilRemoved(cache, key):
+        for _ in range(100):
+            if cache.get(key) is None:
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"{key} was not invalidated")
+
+    # ケース１ 自分のワーカーには同期的に、他のワーカーにはソケット経由で反映される
+    for cache in caches:
+        put(cache, "/mylist/retrieve/all/1?", "user:1")
+        put(cache, "/mylist/retrieve/all/2?", "user:2")
+    buses[0].invalidate(["user:1"])
+    assert caches[0].get("/mylist/retrieve/all/1?") is None
+    await waitUntilRemoved(caches[1], "/mylist/retrieve/all/1?")
+    assert caches[1].get("/mylist/retrieve/all/2?") is not None
+
+    # ケース２ 番号が飛んだ（取りこぼした）場合はキャッシュ全体を破棄する
+    gaps = metrics.value("cache_invalidation_gaps_total")
+    buses[0].seq += 1
+    buses[0].invalidate(["user:3"])
+    await waitUntilRemoved(caches[1], "/mylist/retrieve/all/2?")
+    assert metrics.value("cache_invalidation_gaps_total") == gaps + 1
+
+    # ケース３ 最後の無効化を取りこぼした場合も、ハートビートで検知する
+    put(caches[1], "/mylist/retrieve/all/2?", "user:2")
+    buses[0].seq += 1
+    await waitUntilRemoved(caches[1], "/mylist/retrieve/all/2?")
+    assert metrics.value("cache_invalidation_gaps_total") == gaps + 2
+    # 取りこぼしがなければ破棄しない
+    put(caches[1], "/mylist/retrieve/all/2?", "user:2")
+    await asyncio.sleep(0.15)
+    assert caches[1].get("/mylist/retrieve/all/2?") is not None
+
+    # ケース４ 公開フィードの更新も同じ番号で配信される
+    for feed in feeds:
+        feed._loaded = True
+    put(caches[1], "/mylist/retrieve/all/1?", "user:1")
+    buses[0].invalidate(["user:1"], feed=[{"type": "touch", "my_list_id": 5, "is_private": False}])
+    assert list(feeds[0]._ids) == [5]
+    await waitUntilRemoved(caches[1], "/mylist/retrieve/all/1?")
+    assert list(feeds[1]._ids) == [5]
+
+    # ケース５ 番号が飛んだ場合は、フィードも次回取得時にDBから再構築する
+    buses[0].seq += 1
+    buses[0].invalidate(["user:1"], feed=[{"type": "discard", "my_list_id": 5}])
+    await waitUntilRemoved(caches[1], "/mylist/retrieve/all/2?")
+    assert feeds[1]._loaded is False and list(feeds[1]._ids) == []
+    for transport, bus in zip(transports, buses):
+        await bus.stop()
+        await transport.stop()
+
+# 【正常系】サーバーの起動設定
+def test_server_settings(monkeypatch):
+    import api.server as server
+    # ケース１ 既定値は環境変数（Settings）から取得する
+    monkeypatch.setenv("TOPICK_WORKERS", "3")
+    monkeypatch.setenv("TOPICK_MAX_REQUESTS", "0")
+    monkeypatch.setenv("TOPICK_DEV", "1")
+    args = server.parseArgs(Settings(), [])
+    assert (args.workers, args.max_requests, args.dev, args.port) == (3, 0, True, 8000)
+
+    # ケース２ コマンドライン引数が優先される
+    args = server.parseArgs(Settings(), ["--workers", "2", "--port", "9000"])
+    assert (args.workers, args.port) == (2, 9000)
+
+    # ケース３ 停止時はリクエストとバックグラウンド処理の完了を待つ時間より長く待つ
+    assert server.gracefulTimeout(Settings(shutdown_drain_timeout=30)) >= 30 + server.DRAIN_TIMEOUT
+    assert server.gracefulTimeout(Settings(shutdown_drain_timeout=60)) >= 60 + server.DRAIN_TIMEOUT
+
+    # ケース４ 再起動の通知がまとめて届いても、終了したワーカーの分を起動してワーカー数を保つ
+    supervisor = server.Supervisor(args, Settings())
+    pids = iter(range(100, 200))
+    exited = []
+    monkeypatch.setattr(supervisor, "spawn", lambda: supervisor.children.__setitem__(next(pids), time.monotonic() - 60))
+    monkeypatch.setattr(supervisor, "reap", lambda: [exited.pop() for _ in range(len(exited))])
+    for _ in range(supervisor.workers):
+        supervisor.spawn()
+    # 2つのワーカーの通知が1回にまとまった場合
+    supervisor.handleRecycle(signal.SIGUSR1, None)
+    supervisor.handleRecycle(signal.SIGUSR1, None)
+    supervisor.supervise()
+    assert sorted(supervisor.children) == [100, 101, 102]
+    exited.extend([(100, server.RECYCLED << 8), (101, server.RECYCLED << 8)])
+    supervisor.supervise()
+    assert sorted(supervisor.children) == [102, 103]
+    # 異常終了したワーカーも起動し直す
+    exited.append((102, 1 << 8))
+    supervisor.supervise()
+    assert sorted(supervisor.children) == [103, 104]
+    # 停止中は起動しない
+    supervisor.shouldExit = True
+    supervisor.handleRecycle(signal.SIGUSR1, None)
+    exited.append((103, 0))
+    supervisor.supervise()
+    assert sorted(supervisor.children) == [104]
+
 #################################################################################################
 #############################認証関連のテスト#########################################################
 #################################################################################################
@@ -2384,4 +4020,106 @@ async def test_auth_create(async_client):
     authRecord = await async_client.dbsession.get(auth_model.Auth, 2)
     assert authRecord.is_authenticated == True
     assert authRecord.created_at != None and authRecord.updated_at != None and (authRecord.created_at < authRecord.updated_at)
-    await async_client.dbsession.close()
\ No newline at end of file
+    await async_client.dbsession.close()
+
+
+# マイリスト移行
+@pytest.mark.asyncio
+async def test_auth_migrate(async_client):
+    # 旧端末のユーザー1（マイリスト1件）と新端末の仮ユーザー2（マイリスト2件）を作っておく
+    await async_client.client.post("/mylist/create-user", json={
+        "title": "旧端末",
+        "theme_type": "001",
+    })
+    response = await async_client.client.post("/mylist/create-user", json={
+        "title": "新端末1",
+        "theme_type": "001",
+    })
+    deviceToken = response.json()["device_token"]
+    await async_client.client.post("/mylist/create", json={
+        "user_id": 2,
+        "title": "新端末2",
+        "theme_type": "001",
+        "is_private": True
+    })
+    response = await async_client.client.post("/auth/create", json={"user_id": 1})
+    auth = response.json()
+
+    # ケース1 異常系_認証コード誤り
+    response = await async_client.client.post("/auth/migrate", json={
+        "auth_id": auth["auth_id"],
+        "auth_code": "000000" if auth["auth_code"] != "000000" else "111111",
+        "from_user_id": 2,
+        "from_device_token": deviceToken
+    })
+    assert response.status_code == starlette.status.HTTP_401_UNAUTHORIZED
+    assert response.json() == {
+        "detail": f"Wrong auth_code for Auth with id {auth['auth_id']}"
+    }
+
+    # ケース2 異常系_移行元と移行先が同じ
+    response = await async_client.client.post("/auth/migrate", json={**auth, "from_user_id": 1, "from_device_token": deviceToken})
+    assert response.status_code == starlette.status.HTTP_400_BAD_REQUEST
+
+    # ケース3 異常系_存在しない移行元ユーザー
+    response = await async_client.client.post("/auth/migrate", json={**auth, "from_user_id": 9, "from_device_token": deviceToken})
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND
+
+    # ケース3-2 異常系_移行元の端末のトークンではない（他のユーザーのマイリストは移行・削除できない）
+    for token in ["wrong", None]:
+        response = await async_client.client.post("/auth/migrate", json={
+            **auth, "from_user_id": 2, "from_device_token": token, "delete_source_user": True
+        })
+        assert response.status_code == starlette.status.HTTP_403_FORBIDDEN if token else starlette.status.HTTP_422_UNPROCESSABLE_ENTITY
+    response = await async_client.client.get("/mylist/retrieve/all/2")
+    assert len(response.json()) == 2
+
+    # ここまでの呼び出しで認証データが使用済みになっていないこと
+    authRecord = await async_client.dbsession.get(auth_model.Auth, auth["auth_id"])
+    assert authRecord.is_authenticated == False
+    await async_client.dbsession.close()
+
+    # ケース4 正常系_仮ユーザーのマイリストを全て移行
+    response = await async_client.client.post("/auth/migrate", json={**auth, "from_user_id": 2, "from_device_token": deviceToken})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json() == {"user_id": 1, "migrated_count": 2}
+    response = await async_client.client.get("/mylist/retrieve/all/1")
+    assert [mylist["title"] for mylist in response.json()] == ["旧端末", "新端末1", "新端末2"]
+    response = await async_client.client.get("/mylist/retrieve/all/2")
+    assert response.json() == []
+    # 移行元の端末には削除として通知される
+    response = await async_client.client.get("/mylist/changes/2", params={"since": (datetime.now() - timedelta(hours=1)).isoformat()})
+    assert sorted(response.json()["deleted"]) == [2, 3]
+    # 公開マイリストのフィードには影響しない
+    response = await async_client.client.get("/mylist/feed/public")
+    assert sorted(mylist["my_list_id"] for mylist in response.json()) == [1, 2]
+    # 集計も移行される
+    response = await async_client.client.get("/mylist/summary/1")
+    assert response.json()["list_count"] == 3
+    assert response.json()["private_count"] == 1
+    response = await async_client.client.get("/mylist/summary/2")
+    assert response.json()["list_count"] == 0
+
+    # ケース5 異常系_使用済みの認証データ
+    response = await async_client.client.post("/auth/migrate", json={**auth, "from_user_id": 2, "from_device_token": deviceToken})
+    assert response.status_code == starlette.status.HTTP_401_UNAUTHORIZED
+    assert response.json() == {
+        "detail": f"Auth with id {auth['auth_id']} has already been used"
+    }
+
+    # ケース6 正常系_移行後に移行元のユーザーを削除
+    response = await async_client.client.post("/mylist/create-user", json={
+        "title": "新端末3",
+        "theme_type": "001",
+    })
+    deviceToken = response.json()["device_token"]
+    await async_client.client.post("/auth/create", json={"user_id": 3})
+    response = await async_client.client.post("/auth/create", json={"user_id": 1})
+    auth = response.json()
+    response = await async_client.client.post("/auth/migrate", json={**auth, "from_user_id": 3, "from_device_token": deviceToken, "delete_source_user": True})
+    assert response.status_code == starlette.status.HTTP_200_OK
+    assert response.json() == {"user_id": 1, "migrated_count": 1}
+    response = await async_client.client.get("/mylist/retrieve/all/1")
+    assert len(response.json()) == 4
+    response = await async_client.client.get("/mylist/retrieve/all/3")
+    assert response.status_code == starlette.status.HTTP_404_NOT_FOUND